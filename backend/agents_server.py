@@ -2,28 +2,42 @@
 # José Manuel García Zumaya A01784238
 # 20 noviembre 2024
 
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 from traffic_base.model import CityModel
 from traffic_base.agent import Road, Traffic_Light, Obstacle, Destination, Car
+from traffic_base.stream import SimulationStream
+from traffic_base.sessions import SessionRegistry
+from traffic_base.static_layers import build_static_layers
 from flask_cors import CORS, cross_origin
 import requests
+import queue
 
 # Size of the board:
 number_agents = 10
 width = 28
 height = 28
-randomModel = None
-currentStep = 0
+verbose = False # Imprime cada petición a /init y /update, las métricas se consultan en /metrics
+
+# Cada /init crea una sesión con su propio modelo, los clientes mandan su id en el parámetro "session" o en el header X-Session-Id
+# Las sesiones menos usadas se eliminan cuando hay demasiadas o usan demasiada memoria, y los modelos se avanzan en un pool de hilos
+registry = SessionRegistry()
 
 # This application will be used to interact with Unity
 app = Flask("Traffic example")
 
+def getSession():
+    '''Regresa la sesión del cliente, o la última creada si no manda ninguna, como cuando solo había un modelo.'''
+    return registry.get(request.args.get('session') or request.headers.get('X-Session-Id'))
+
+def sessionNotFound():
+    return {"error": "unknown session, it may have been evicted, call /init again"}, 404
+
 # This route will be used to send the parameters of the simulation to the server.
 # The servers expects a POST request with the parameters in a form.
 @app.route('/init', methods=['POST'])
 @cross_origin(origins="*")  # Permitir solicitudes desde cualquier origen
 def initModel():
-    global currentStep, randomModel, number_agents, width, height
+    global number_agents, width, height
     
     # print("Request received", request.json)  # Muestra el JSON recibido
 
@@ -40,181 +54,340 @@ def initModel():
         except ValueError:
             return {"error": "number_agents must be a valid integer"}, 400
 
-        print("Number of agents:", number_agents)
-        currentStep = 0
+        router = data.get('router', 'bfs') # "bfs" or "astar", for comparing the routing strategies
+        if router not in ('bfs', 'astar'):
+            return {"error": "router must be 'bfs' or 'astar'"}, 400
+
+        engine = data.get('engine', 'agents') # "agents", "events" (los coches detenidos no se ejecutan), "vectorized" o "partitioned" (el mapa se divide entre varios procesos)
+        if engine not in ('agents', 'events', 'vectorized', 'partitioned') or (engine in ('vectorized', 'partitioned') and router != 'bfs'):
+            return {"error": "engine must be 'agents', 'events', 'vectorized' or 'partitioned', and the vectorized and partitioned engines only support the 'bfs' router"}, 400
+
+        try:
+            tick_rate = float(data.get('tick_rate', 2)) # Pasos por segundo del stream
+        except (TypeError, ValueError):
+            return {"error": "tick_rate must be a number"}, 400
+        if tick_rate <= 0:
+            return {"error": "tick_rate must be positive"}, 400
+
+        seed = data.get('seed') # Semilla opcional, la misma semilla con los mismos parámetros repite la simulación
+        if seed is not None and (isinstance(seed, bool) or not isinstance(seed, int)):
+            return {"error": "seed must be an integer"}, 400
+
+        demand = data.get('demand') # Demanda opcional con celdas de entrada, matriz origen-destino y tasas (ver traffic_base/demand.py), por defecto un coche en cada esquina cada 2 pasos
+        if demand is not None and not isinstance(demand, dict):
+            return {"error": "demand must be an object"}, 400
 
-        # Crear el modelo utilizando los parámetros
-        randomModel = CityModel(2)
+        if verbose:
+            print("Number of agents:", number_agents)
+
+        # Crear el modelo utilizando los parámetros, en una sesión nueva para no afectar a los demás clientes
+        try:
+            model = CityModel(2, router, engine, seed=seed, demand=demand)
+        except ValueError as error:
+            return {"error": str(error)}, 400
+        session = createSession(model, tick_rate)
         
-        width = randomModel.width
-        height = randomModel.height
+        width = session.model.width
+        height = session.model.height
 
         # Devolver un mensaje indicando éxito
-        return jsonify({"message": "Parameters received, model initiated.", "width": width, "height": height})
+        return jsonify({"message": "Parameters received, model initiated.", "width": width, "height": height, "session": session.session_id, "seed": session.model._seed})
+
+def createSession(model: CityModel, tick_rate: float):
+    '''Crea una sesión para el modelo, con su stream y sus capas estáticas.'''
+    return startSession(registry.create(model), tick_rate)
+
+def startSession(session, tick_rate: float):
+    session.stream = SimulationStream(session.model, session.lock, tick_rate, step=lambda: registry.step(session))
+    session.static_layers = build_static_layers(session.model)
+    return session
+
+# This route copies the model of a session on its current step into a new session, so several what-if branches can run from the same state
+# Without a seed the new session takes the same steps as the original one, with a seed (POST {"seed": 7}) its random numbers start from it
+@app.route('/fork', methods=['POST'])
+@cross_origin(origins="*")  # Permitir solicitudes desde cualquier origen
+def forkModel():
+    session = getSession()
+    if session is None:
+        return sessionNotFound()
+
+    seed = (request.get_json(silent=True) or {}).get('seed')
+    if seed is not None and (isinstance(seed, bool) or not isinstance(seed, int)):
+        return {"error": "seed must be an integer"}, 400
+
+    try:
+        with session.lock:
+            model = session.model.fork(seed)
+            current_step = session.current_step
+    except ValueError as error: # Models on the partitioned engine can't be forked
+        return {"error": str(error)}, 409
+    forked = createSession(model, session.stream.tick_rate)
+    forked.current_step = current_step
+    return jsonify({"message": "Model forked.", "session": forked.session_id, "parent": session.session_id, "seed": model._seed, "currentStep": current_step})
     
 
 
 @app.route('/getCars', methods=['GET'])
 @cross_origin(origins="*")  # Permitir solicitudes desde cualquier origen
 def getCars():
-    global randomModel
+    session = getSession()
+    if session is None:
+        return sessionNotFound()
 
     if request.method == 'GET':
-        # Lista para almacenar las posiciones de los agentes de tipo Car
+        # Si el cliente acepta binario, se manda el buffer de columnas que el modelo mantiene actualizado (ver CarStateBuffer)
+        if request.accept_mimetypes.best_match(['application/json', 'application/octet-stream']) == 'application/octet-stream':
+            # WSGI solo acepta bytes, asi que el buffer se copia una vez completo, sin recorrer los coches
+            with session.lock:
+                payload = bytes(session.model.car_states.payload())
+            return Response(payload, mimetype='application/octet-stream')
+
+        # Lista para almacenar las posiciones de los coches, sin importar el motor que los mueve
         car_positions = []
-        seen_ids = set()
         
-        # Iterar sobre la grilla del modelo
-        for cell_contents, (x, z) in randomModel.grid.coord_iter():
-            for agent in cell_contents:
-                if isinstance(agent, Car):
-                    if agent.unique_id not in seen_ids:
-                        seen_ids.add(agent.unique_id)
-                        car_positions.append({
-                            "id": str(agent.unique_id),
-                            "position": {
-                                "x": x,
-                                "y": 1,  # Altura constante para WebGL
-                                "z": z
-                            },
-                            "orientation": {
-                                "x": agent.direction[0],
-                                "y": 0,
-                                "z": agent.direction[1]
-                            }
-                        })
+        with session.lock:
+            car_states = session.model.get_car_states()
+        for car_id, (x, z), direction in car_states:
+            car_positions.append({
+                "id": car_id,
+                "position": {
+                    "x": x,
+                    "y": 1,  # Altura constante para WebGL
+                    "z": z
+                },
+                "orientation": {
+                    "x": direction[0],
+                    "y": 0,
+                    "z": direction[1]
+                }
+            })
                         
         # print("Car positions:", car_positions)
         return jsonify({'positions': car_positions})
 
+def staticLayerResponse(name: str):
+    '''Responde con una capa estática ya serializada, o con un 304 si el cliente ya tiene la misma versión (If-None-Match).'''
+    session = getSession()
+    if session is None:
+        return sessionNotFound()
+
+    body, etag = session.static_layers[name]
+    response = Response(body, mimetype='application/json')
+    response.set_etag(etag)
+    response.cache_control.no_cache = True # El navegador guarda la respuesta, pero la revalida porque /init puede cargar otro mapa
+    return response.make_conditional(request)
+
 # This route will be used to get the positions of the agents
 @app.route('/getRoad', methods=['GET'])
 @cross_origin(origins="*")  # Permitir solicitudes desde cualquier origen
 def getAgents():
-    global randomModel
-          # Orientations:
-        # (1, 0, 0) -> Right
-        # (-1, 0, 0) -> Left
-        # (0, 0, 1) -> Up
-        # (0, 0, -1) -> Down
-
-    if request.method == 'GET':
-        # Lista para almacenar las posiciones de los agentes de tipo Road
-        road_positions = []
-        seen_ids = set()  # Conjunto para rastrear IDs únicos
-
-        # Iterar sobre la grilla del modelo
-        for cell_contents, (x, z) in randomModel.grid.coord_iter():
-            for agent in cell_contents:  # Itera sobre todos los agentes en la celda
-                if isinstance(agent, Road):  # Filtra por agentes de tipo Road
-                    if agent.unique_id not in seen_ids:  # Verifica si ya fue agregado
-                        seen_ids.add(agent.unique_id)  # Marca este ID como visto
-                        road_positions.append({
-                            "id": str(agent.unique_id),
-                            "position": {
-                                "x": x,
-                                "y": 1,  # Altura constante para WebGL
-                                "z": z
-                            },
-                            "orientation": {
-                                "x": agent.orientation[0],
-                                "y": 0,
-                                "z": agent.orientation[1]
-                            }
-                        })
-
-        # Log para depuración
-        # print("Road positions:", road_positions)
-
-        # Devolver la lista de posiciones en formato JSON
-        return jsonify({'positions': road_positions})
+    return staticLayerResponse('road')
 
 
 @app.route('/getBuildings', methods=['GET'])
 @cross_origin(origins="*")  # Permitir solicitudes desde cualquier origen
 def getBuildings():
-    global randomModel
-
-    if request.method == 'GET':
-        building_positions = []
-        
-        for cell_contents, (x, y) in randomModel.grid.coord_iter():
-            for agent in cell_contents:
-                if isinstance(agent, Obstacle):
-                    building_positions.append({
-                        "id": str(agent.unique_id),
-                        "x": x,
-                        "y": 1,
-                        "z": y
-                    })
-        
-        return jsonify({'positions': building_positions})
+    return staticLayerResponse('buildings')
 
 @app.route('/getDestinations', methods=['GET'])
 @cross_origin(origins="*")  # Permitir solicitudes desde
 def getDestinations():
-    global randomModel
+    return staticLayerResponse('destinations')
 
-    if request.method == 'GET':
-        destination_positions = []
-        
-        for cell_contents, (x, y) in randomModel.grid.coord_iter():
-            for agent in cell_contents:
-                if isinstance(agent, Destination):
-                    destination_positions.append({
-                        "id": str(agent.unique_id),
-                        "x": x,
-                        "y": 1,
-                        "z": y
-                    })
-        
-        return jsonify({'positions': destination_positions})
-    
+# Los semáforos se mandan en dos partes: su geometría, que no cambia, y su estado, que se pide en /getTrafficLightStates
 @app.route('/getTrafficLights', methods=['GET'])
 @cross_origin(origins="*")  # Permitir solicitudes desde cualquier origen
 def getTrafficLights():
-    global randomModel
+    return staticLayerResponse('trafficLights')
+
+# This route will be used to get the color of every traffic light, in the same order as /getTrafficLights
+# 0 -> green, 1 -> yellow, 2 -> red
+@app.route('/getTrafficLightStates', methods=['GET'])
+@cross_origin(origins="*")  # Permitir solicitudes desde cualquier origen
+def getTrafficLightStates():
+    session = getSession()
+    if session is None:
+        return sessionNotFound()
 
     if request.method == 'GET':
-        trafficLightPositions = []
-        for cell_contents, (x, z) in randomModel.grid.coord_iter():
-            for agent in cell_contents:
-                if isinstance(agent, Traffic_Light):
-                    trafficLightPositions.append({
-                        "id": str(agent.unique_id),
-                        "x": x,
-                        "y": 1,
-                        "z": z,
-                        "is_red": agent.is_red,
-                        "is_yellow": agent.is_yellow,
-                    })
-
-        return jsonify({'positions':trafficLightPositions})
+        with session.lock:
+            states = session.model.signals.color_codes().tolist()
+            step = session.model.schedule.steps
+        return jsonify({'step': step, 'states': states})
+
 # This route will be used to get the positions of the obstacles
 @app.route('/getObstacles', methods=['GET'])
 @cross_origin(origins="*")  # Permitir solicitudes desde cualquier origen
 def getObstacles():
-    global randomModel
-
-    if request.method == 'GET':
-        # Get the positions of the obstacles and return them to Unity in JSON format.
-        # Same as before, the positions are sent as a list of dictionaries, where each dictionary has the id and position of an obstacle.
-        obstaclePositions = [{"id": str(a.unique_id), "x": x, "y":1, "z":z} for a, (x, z) in randomModel.grid.coord_iter() if isinstance(a, Obstacle)]
-
-        return jsonify({'positions':obstaclePositions})
+    return staticLayerResponse('obstacles')
 
 # This route will be used to update the model
 @app.route('/update', methods=['GET'])
 @cross_origin(origins="*")  # Permitir solicitudes desde cualquier origen
 def updateModel():
-    global currentStep, randomModel
+    session = getSession()
+    if session is None:
+        return sessionNotFound()
+
     if request.method == 'GET':
         # Update the model and return a message to Unity saying that the model was updated successfully
-        randomModel.step()
-        currentStep += 1
-        print("Model updated to step", currentStep)
+        with session.lock:
+            registry.step(session)
+            session.current_step += 1
+            currentStep = session.current_step
+        if verbose:
+            print("Model updated to step", currentStep)
         return jsonify({'message':f'Model updated to step {currentStep}.', 'currentStep':currentStep})
 
+# This route exports the metrics of the model in the Prometheus text format
+@app.route('/metrics', methods=['GET'])
+@cross_origin(origins="*")  # Permitir solicitudes desde cualquier origen
+def getMetrics():
+    session = getSession()
+    if session is None:
+        return sessionNotFound()
+
+    with session.lock:
+        text = session.model.metrics.prometheus() + session.model.route_cache.prometheus()
+    return Response(text, mimetype='text/plain; version=0.0.4')
+
+# This route dumps the metrics of every step as NumPy arrays (.npz), or as an Arrow IPC stream with format=arrow
+@app.route('/metrics/dump', methods=['GET'])
+@cross_origin(origins="*")  # Permitir solicitudes desde cualquier origen
+def dumpMetrics():
+    session = getSession()
+    if session is None:
+        return sessionNotFound()
+
+    if request.args.get('format', 'npz') == 'arrow':
+        try:
+            import pyarrow as pa
+        except ImportError:
+            return {"error": "pyarrow is not installed, use format=npz"}, 501
+        with session.lock:
+            table = session.model.metrics.to_arrow()
+        sink = pa.BufferOutputStream()
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+        return Response(sink.getvalue().to_pybytes(), mimetype='application/vnd.apache.arrow.stream')
+
+    with session.lock:
+        payload = session.model.metrics.npz()
+    return Response(payload, mimetype='application/octet-stream', headers={'Content-Disposition': 'attachment; filename=metrics.npz'})
+
+# This route turns the step profiler on or off (POST {"enabled": true}) and returns its results (GET)
+# With format=folded the results are sent as folded stacks, which can be turned into a flamegraph with flamegraph.pl or speedscope
+@app.route('/profile', methods=['GET', 'POST'])
+@cross_origin(origins="*")  # Permitir solicitudes desde cualquier origen
+def profileModel():
+    session = getSession()
+    if session is None:
+        return sessionNotFound()
+
+    if request.method == 'POST':
+        enabled = (request.json or {}).get('enabled', True)
+        with session.lock:
+            if enabled:
+                session.model.disable_profiling() # Empieza desde cero
+                session.model.enable_profiling()
+            else:
+                session.model.disable_profiling()
+        return jsonify({'enabled': bool(enabled)})
+
+    with session.lock:
+        profiler = session.model.profiler
+        if profiler is None:
+            return {"error": "profiling is disabled, enable it with a POST to /profile"}, 409
+        if request.args.get('format') == 'folded':
+            return Response(profiler.folded_stacks(), mimetype='text/plain')
+        return jsonify(profiler.report())
+
+# This route saves the state of the model of a session to a checkpoint file, written in the background so the simulation doesn't stop
+# POST {"every": 50} also saves it every 50 steps (0 stops it), and {"wait": true} answers once the file is written
+@app.route('/checkpoint', methods=['POST'])
+@cross_origin(origins="*")  # Permitir solicitudes desde cualquier origen
+def checkpointModel():
+    session = getSession()
+    if session is None:
+        return sessionNotFound()
+
+    data = request.get_json(silent=True) or {}
+    every = data.get('every')
+    if every is not None and (isinstance(every, bool) or not isinstance(every, int) or every < 0):
+        return {"error": "every must be a non negative integer"}, 400
+
+    try:
+        with session.lock:
+            written = registry.checkpoint(session)
+            if every is not None:
+                session.checkpoint_interval = every
+            step = session.model.schedule.steps
+    except ValueError as error: # Models on the partitioned engine can't be checkpointed
+        return {"error": str(error)}, 409
+    if data.get('wait', False):
+        written.result()
+    return jsonify({'message': 'Checkpoint started.', 'checkpoint': session.session_id, 'step': step, 'every': session.checkpoint_interval})
+
+# This route creates a session from a checkpoint (POST {"checkpoint": "<session id>"}), which keeps the id of the saved session if it isn't in use
+@app.route('/restore', methods=['POST'])
+@cross_origin(origins="*")  # Permitir solicitudes desde cualquier origen
+def restoreModel():
+    data = request.get_json(silent=True) or {}
+    checkpoint = data.get('checkpoint')
+    if not isinstance(checkpoint, str):
+        return {"error": "checkpoint is required"}, 400
+    try:
+        tick_rate = float(data.get('tick_rate', 2))
+    except (TypeError, ValueError):
+        return {"error": "tick_rate must be a number"}, 400
+    if tick_rate <= 0:
+        return {"error": "tick_rate must be positive"}, 400
+
+    try:
+        session = startSession(registry.restore(checkpoint), tick_rate)
+    except FileNotFoundError:
+        return {"error": "checkpoint not found"}, 404
+    except ValueError as error: # Invalid id, unsupported version or a map that changed
+        return {"error": str(error)}, 400
+    return jsonify({'message': 'Model restored.', 'session': session.session_id, 'width': session.model.width, 'height': session.model.height, 'currentStep': session.current_step})
+
+# This route will be used to close a session and free its model
+@app.route('/session', methods=['DELETE'])
+@cross_origin(origins="*")  # Permitir solicitudes desde cualquier origen
+def closeSession():
+    session_id = request.args.get('session') or request.headers.get('X-Session-Id')
+    if not session_id or not registry.remove(session_id):
+        return sessionNotFound()
+    return jsonify({'message': 'Session closed.'})
+
+# This route streams the simulation as Server-Sent Events, the model is advanced on the server at the tick rate given on /init
+# The first event ("snapshot") has every car and traffic light, and each of the next ones ("delta") has what changed on a step
+@app.route('/stream', methods=['GET'])
+@cross_origin(origins="*")  # Permitir solicitudes desde cualquier origen
+def streamModel():
+    session = getSession()
+    if session is None:
+        return sessionNotFound()
+
+    stream = session.stream
+    messages = stream.subscribe()
+
+    def events():
+        try:
+            while True:
+                try:
+                    message = messages.get(timeout=15)
+                except queue.Empty:
+                    yield b": keep-alive\n\n" # Comentario SSE para que la conexion no se cierre por inactividad
+                    continue
+                if message is None: # El stream se cerro, el cliente se reconecta solo
+                    return
+                yield message
+        finally:
+            stream.unsubscribe(messages)
+
+    return Response(events(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 if __name__=='__main__':
     # Run the flask server in port 8585
-    app.run(host="localhost", port=8585, debug=True)
\ No newline at end of file
+    app.run(host="localhost", port=8585, debug=True, threaded=True)
\ No newline at end of file
@@ -0,0 +1,390 @@
+# Marcos Dayan Mann A01782876
+# José Manuel García Zumaya A01784238
+# 20 noviembre 2024
+# Servidor asíncrono (ASGI) de la simulación. Cada sesión tiene una tarea que avanza el modelo en segundo plano, a un tick rate fijo o lo más rápido posible,
+# y las lecturas como /getCars se responden con el snapshot del último paso completo, sin esperar al paso que se está calculando.
+# Usa el mismo registro de sesiones y las mismas rutas que agents_server.py. Correr desde la carpeta backend: python asgi_server.py
+
+import asyncio
+import json
+from contextlib import asynccontextmanager
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+from traffic_base.model import CityModel
+from traffic_base.stream import SteppingLoop
+from traffic_base.sessions import SessionRegistry
+from traffic_base.static_layers import build_static_layers
+import uvicorn
+
+verbose = False # Imprime cada petición a /init y /update
+
+registry = SessionRegistry()
+
+def getSession(request):
+    '''Regresa la sesión del cliente, o la última creada si no manda ninguna.'''
+    return registry.get(request.query_params.get('session') or request.headers.get('X-Session-Id'))
+
+def sessionNotFound():
+    return JSONResponse({"error": "unknown session, it may have been evicted, call /init again"}, status_code=404)
+
+def error(message: str, status_code: int = 400):
+    return JSONResponse({"error": message}, status_code=status_code)
+
+def parseTickRate(data: dict, default: float = 2):
+    '''Regresa el tick rate del cuerpo de la petición, 2 pasos por segundo por defecto como /stream de agents_server.py y 0 avanza lo más rápido posible, o None si no es válido.'''
+    try:
+        tick_rate = float(data.get('tick_rate', default))
+    except (TypeError, ValueError):
+        return None
+    return tick_rate if tick_rate >= 0 else None
+
+def isInteger(value) -> bool:
+    return isinstance(value, int) and not isinstance(value, bool)
+
+async def readJson(request) -> dict:
+    try:
+        data = await request.json()
+    except ValueError:
+        return {}
+    return data if isinstance(data, dict) else {}
+
+async def createSession(model):
+    '''Registra una sesión nueva en un hilo, las sesiones que se desalojan esperan su lock para cerrar el modelo y eso no debe detener el event loop.'''
+    return await asyncio.to_thread(registry.create, model)
+
+async def removeSession(session_id: str) -> bool:
+    '''Quita una sesión en un hilo, cerrar el modelo espera a que termine el paso que tiene el lock.'''
+    return await asyncio.to_thread(registry.remove, session_id)
+
+def startSession(session, tick_rate: float, running: bool = True):
+    '''Crea el loop de la sesión y sus capas estáticas, debe llamarse en el event loop.'''
+    def step():
+        registry.step(session)
+        session.current_step += 1
+
+    session.static_layers = build_static_layers(session.model)
+    session.stream = SteppingLoop(session.model, session.lock, tick_rate, step=step)
+    if running:
+        session.stream.start()
+    return session
+
+# Crea una sesión nueva, con los mismos parámetros que /init de agents_server.py
+# tick_rate son los pasos por segundo del loop (2 por defecto, 0 avanza lo más rápido posible) y con "running": false empieza pausado
+async def initModel(request):
+    data = await readJson(request)
+    number_agents = data.get('NAgents')
+    if number_agents is None:
+        return error("number_agents is required")
+    try:
+        number_agents = int(number_agents)
+    except (TypeError, ValueError):
+        return error("number_agents must be a valid integer")
+
+    router = data.get('router', 'bfs')
+    if router not in ('bfs', 'astar'):
+        return error("router must be 'bfs' or 'astar'")
+    engine = data.get('engine', 'agents')
+    if engine not in ('agents', 'events', 'vectorized', 'partitioned') or (engine in ('vectorized', 'partitioned') and router != 'bfs'):
+        return error("engine must be 'agents', 'events', 'vectorized' or 'partitioned', and the vectorized and partitioned engines only support the 'bfs' router")
+    tick_rate = parseTickRate(data)
+    if tick_rate is None:
+        return error("tick_rate must be a non negative number")
+    seed = data.get('seed')
+    if seed is not None and not isInteger(seed):
+        return error("seed must be an integer")
+    if not isinstance(data.get('running', True), bool):
+        return error("running must be a boolean")
+    demand = data.get('demand')
+    if demand is not None and not isinstance(demand, dict):
+        return error("demand must be an object")
+
+    if verbose:
+        print("Number of agents:", number_agents)
+
+    # El modelo se crea en un hilo para no detener a las demás sesiones mientras se carga el mapa
+    try:
+        model = await asyncio.to_thread(CityModel, 2, router, engine, seed=seed, demand=demand)
+    except ValueError as exception:
+        return error(str(exception))
+    session = startSession(await createSession(model), tick_rate, data.get('running', True))
+    return JSONResponse({"message": "Parameters received, model initiated.", "width": model.width, "height": model.height, "session": session.session_id, "seed": model._seed})
+
+# Copia el modelo de una sesión en una sesión nueva, como /fork de agents_server.py, el loop de la copia empieza igual que el de la original
+async def forkModel(request):
+    session = getSession(request)
+    if session is None:
+        return sessionNotFound()
+    seed = (await readJson(request)).get('seed')
+    if seed is not None and not isInteger(seed):
+        return error("seed must be an integer")
+
+    def fork():
+        with session.lock:
+            return session.model.fork(seed), session.current_step
+
+    try:
+        model, current_step = await asyncio.to_thread(fork)
+    except ValueError as exception: # Models on the partitioned engine can't be forked
+        return error(str(exception), 409)
+    loop = session.stream
+    forked = startSession(await createSession(model), loop.tick_rate, loop.running)
+    forked.current_step = current_step
+    return JSONResponse({"message": "Model forked.", "session": forked.session_id, "parent": session.session_id, "seed": model._seed, "currentStep": current_step})
+
+# Cambia el tick rate del loop (POST {"tick_rate": 10}) o lo pausa y lo reanuda (POST {"running": false})
+async def runModel(request):
+    session = getSession(request)
+    if session is None:
+        return sessionNotFound()
+    data = await readJson(request)
+    loop = session.stream
+    if 'tick_rate' in data:
+        tick_rate = parseTickRate(data)
+        if tick_rate is None:
+            return error("tick_rate must be a non negative number")
+        loop.tick_rate = tick_rate
+    running = data.get('running', loop.running)
+    if not isinstance(running, bool):
+        return error("running must be a boolean")
+    if running:
+        loop.start()
+    else:
+        loop.pause()
+    return JSONResponse({'running': loop.running, 'tick_rate': loop.tick_rate, 'step': loop.snapshot.step})
+
+# Las posiciones de los coches se leen del snapshot del último paso, en JSON o en el buffer binario de CarStateBuffer
+async def getCars(request):
+    session = getSession(request)
+    if session is None:
+        return sessionNotFound()
+    snapshot = session.stream.snapshot
+    if 'application/octet-stream' in request.headers.get('accept', '') and 'application/json' not in request.headers.get('accept', ''):
+        return Response(snapshot.payload, media_type='application/octet-stream')
+
+    body = snapshot.cache.get('cars')
+    if body is None: # Se serializa una sola vez por paso, aunque lo pidan muchos clientes
+        car_positions = [
+            {"id": car_id, "position": {"x": x, "y": 1, "z": z}, "orientation": {"x": direction[0], "y": 0, "z": direction[1]}}
+            for car_id, (x, z), direction in snapshot.car_states()
+        ]
+        body = snapshot.cache['cars'] = json.dumps({'positions': car_positions}, separators=(',', ':')).encode()
+    return Response(body, media_type='application/json')
+
+# 0 -> green, 1 -> yellow, 2 -> red, en el mismo orden que /getTrafficLights
+async def getTrafficLightStates(request):
+    session = getSession(request)
+    if session is None:
+        return sessionNotFound()
+    snapshot = session.stream.snapshot
+    return JSONResponse({'step': snapshot.step, 'states': list(snapshot.light_states)})
+
+def staticLayer(name: str):
+    '''Crea la ruta de una capa estática, que responde con 304 si el cliente ya tiene la misma versión (If-None-Match).'''
+    async def endpoint(request):
+        session = getSession(request)
+        if session is None:
+            return sessionNotFound()
+        body, etag = session.static_layers[name]
+        headers = {'ETag': f'"{etag}"', 'Cache-Control': 'no-cache'}
+        if f'"{etag}"' in request.headers.get('if-none-match', ''):
+            return Response(status_code=304, headers=headers)
+        return Response(body, media_type='application/json', headers=headers)
+    return endpoint
+
+# Avanza el modelo un paso, también si el loop está pausado. Con el loop corriendo el paso se agrega a los del loop, en orden
+async def updateModel(request):
+    session = getSession(request)
+    if session is None:
+        return sessionNotFound()
+    await session.stream.advance()
+    currentStep = session.current_step
+    if verbose:
+        print("Model updated to step", currentStep)
+    return JSONResponse({'message': f'Model updated to step {currentStep}.', 'currentStep': currentStep})
+
+# Las métricas sí se leen del modelo, en un hilo que espera el lock sin detener el event loop
+async def getMetrics(request):
+    session = getSession(request)
+    if session is None:
+        return sessionNotFound()
+
+    def read():
+        with session.lock:
+            return session.model.metrics.prometheus() + session.model.route_cache.prometheus()
+
+    return Response(await asyncio.to_thread(read), media_type='text/plain; version=0.0.4')
+
+# Descarga las métricas por paso como .npz, o como un stream de Arrow IPC con format=arrow si pyarrow está instalado, como /metrics/dump de agents_server.py
+async def dumpMetrics(request):
+    session = getSession(request)
+    if session is None:
+        return sessionNotFound()
+
+    if request.query_params.get('format', 'npz') == 'arrow':
+        try:
+            import pyarrow as pa
+        except ImportError:
+            return error("pyarrow is not installed, use format=npz", 501)
+
+        def readArrow():
+            with session.lock:
+                table = session.model.metrics.to_arrow()
+            sink = pa.BufferOutputStream()
+            with pa.ipc.new_stream(sink, table.schema) as writer:
+                writer.write_table(table)
+            return sink.getvalue().to_pybytes()
+
+        return Response(await asyncio.to_thread(readArrow), media_type='application/vnd.apache.arrow.stream')
+
+    def read():
+        with session.lock:
+            return session.model.metrics.npz()
+
+    return Response(await asyncio.to_thread(read), media_type='application/octet-stream', headers={'Content-Disposition': 'attachment; filename=metrics.npz'})
+
+# Prende o apaga el profiler de pasos (POST {"enabled": true}) y regresa sus resultados (GET), como /profile de agents_server.py
+# Con format=folded se mandan como folded stacks, para hacer una flamegraph con flamegraph.pl o speedscope
+async def profileModel(request):
+    session = getSession(request)
+    if session is None:
+        return sessionNotFound()
+
+    if request.method == 'POST':
+        enabled = (await readJson(request)).get('enabled', True)
+
+        def toggle():
+            with session.lock:
+                session.model.disable_profiling() # Empieza desde cero
+                if enabled:
+                    session.model.enable_profiling()
+
+        await asyncio.to_thread(toggle)
+        return JSONResponse({'enabled': bool(enabled)})
+
+    folded = request.query_params.get('format') == 'folded'
+
+    def read():
+        with session.lock:
+            profiler = session.model.profiler
+            if profiler is None:
+                return None
+            return profiler.folded_stacks() if folded else profiler.report()
+
+    result = await asyncio.to_thread(read)
+    if result is None:
+        return error("profiling is disabled, enable it with a POST to /profile", 409)
+    if folded:
+        return Response(result, media_type='text/plain')
+    return JSONResponse(result)
+
+# Guarda el estado del modelo, como /checkpoint de agents_server.py
+async def checkpointModel(request):
+    session = getSession(request)
+    if session is None:
+        return sessionNotFound()
+    data = await readJson(request)
+    every = data.get('every')
+    if every is not None and (not isInteger(every) or every < 0):
+        return error("every must be a non negative integer")
+
+    def checkpoint():
+        with session.lock:
+            written = registry.checkpoint(session)
+            if every is not None:
+                session.checkpoint_interval = every
+            return written, session.model.schedule.steps
+
+    try:
+        written, step = await asyncio.to_thread(checkpoint)
+    except ValueError as exception: # Models on the partitioned engine can't be checkpointed
+        return error(str(exception), 409)
+    if data.get('wait', False):
+        await asyncio.wrap_future(written)
+    return JSONResponse({'message': 'Checkpoint started.', 'checkpoint': session.session_id, 'step': step, 'every': session.checkpoint_interval})
+
+# Crea una sesión desde un checkpoint (POST {"checkpoint": "<session id>"})
+async def restoreModel(request):
+    data = await readJson(request)
+    checkpoint = data.get('checkpoint')
+    if not isinstance(checkpoint, str):
+        return error("checkpoint is required")
+    tick_rate = parseTickRate(data)
+    if tick_rate is None:
+        return error("tick_rate must be a non negative number")
+    if not isinstance(data.get('running', True), bool):
+        return error("running must be a boolean")
+    try:
+        session = startSession(await asyncio.to_thread(registry.restore, checkpoint), tick_rate, data.get('running', True))
+    except FileNotFoundError:
+        return error("checkpoint not found", 404)
+    except ValueError as exception: # Invalid id, unsupported version or a map that changed
+        return error(str(exception))
+    return JSONResponse({'message': 'Model restored.', 'session': session.session_id, 'width': session.model.width, 'height': session.model.height, 'currentStep': session.current_step})
+
+async def closeSession(request):
+    session_id = request.query_params.get('session') or request.headers.get('X-Session-Id')
+    if not session_id or not await removeSession(session_id):
+        return sessionNotFound()
+    return JSONResponse({'message': 'Session closed.'})
+
+# Stream de Server-Sent Events con el mismo formato que /stream de agents_server.py: un "snapshot" y después un "delta" por cada paso del loop
+async def streamModel(request):
+    session = getSession(request)
+    if session is None:
+        return sessionNotFound()
+    loop = session.stream
+    messages = await loop.subscribe()
+
+    async def events():
+        try:
+            while True:
+                try:
+                    message = await asyncio.wait_for(messages.get(), timeout=15)
+                except asyncio.TimeoutError:
+                    yield b": keep-alive\n\n" # Comentario SSE para que la conexion no se cierre por inactividad
+                    continue
+                if message is None: # El stream se cerro, el cliente se reconecta solo
+                    return
+                yield message
+        finally:
+            loop.unsubscribe(messages)
+
+    return StreamingResponse(events(), media_type='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@asynccontextmanager
+async def lifespan(app):
+    yield
+    for session_id in list(registry.sessions): # Detiene los loops antes de cerrar el event loop
+        await removeSession(session_id)
+
+app = Starlette(
+    routes=[
+        Route('/init', initModel, methods=['POST']),
+        Route('/fork', forkModel, methods=['POST']),
+        Route('/run', runModel, methods=['POST']),
+        Route('/getCars', getCars, methods=['GET']),
+        Route('/getRoad', staticLayer('road'), methods=['GET']),
+        Route('/getBuildings', staticLayer('buildings'), methods=['GET']),
+        Route('/getDestinations', staticLayer('destinations'), methods=['GET']),
+        Route('/getTrafficLights', staticLayer('trafficLights'), methods=['GET']),
+        Route('/getTrafficLightStates', getTrafficLightStates, methods=['GET']),
+        Route('/getObstacles', staticLayer('obstacles'), methods=['GET']),
+        Route('/update', updateModel, methods=['GET']),
+        Route('/metrics', getMetrics, methods=['GET']),
+        Route('/metrics/dump', dumpMetrics, methods=['GET']),
+        Route('/profile', profileModel, methods=['GET', 'POST']),
+        Route('/checkpoint', checkpointModel, methods=['POST']),
+        Route('/restore', restoreModel, methods=['POST']),
+        Route('/session', closeSession, methods=['DELETE']),
+        Route('/stream', streamModel, methods=['GET']),
+    ],
+    middleware=[Middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"])], # Permitir solicitudes desde cualquier origen
+    lifespan=lifespan,
+)
+
+if __name__=='__main__':
+    # Run the ASGI server in port 8585, the same one as the Flask server
+    uvicorn.run(app, host="localhost", port=8585)
@@ -0,0 +1,139 @@
+# Marcos Dayan Mann A01782876
+# José Manuel García Zumaya A01784238
+# 20 noviembre 2024
+# Runs CityModel without the server over a grid of parameters, spreading the runs over several processes, and saves the metrics of every step in one CSV or Parquet table.
+# Run from the backend folder, for example:
+# python batch_runner.py --steps 500 --light-interval 5 10 15 --seeds 0 1 2 --output results.csv
+# python batch_runner.py --steps 1440 --demand map_files/demand/2024_rush_hour.json --output rush_hour.csv
+
+import argparse
+import importlib.util
+import itertools
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
+
+from traffic_base.model import CityModel
+
+# Parameters of CityModel that can be swept, with the value used when they are not given
+DEFAULT_PARAMETERS = {
+    "place_cars_interval": [2],
+    "light_interval": [10],
+    "signal_mode": ["fixed"],
+    "router": ["bfs"],
+    "engine": ["agents"],
+    "map_file": ["map_files/2024_base.txt"],
+    "demand": [None], # JSON demand files, None uses the demand file of the map or the corners
+    "seed": [0],
+}
+
+def parameter_grid(parameters: dict[str, list]) -> list[dict]:
+    '''Returns every combination of the given parameter values, the parameters that are not given keep their default value.'''
+    values = {**DEFAULT_PARAMETERS, **{name: options for name, options in parameters.items() if options}}
+    unknown = set(values) - set(DEFAULT_PARAMETERS)
+    if unknown:
+        raise ValueError(f"Unknown parameters: {', '.join(sorted(unknown))}")
+    names = list(values)
+    runs = [dict(zip(names, combination)) for combination in itertools.product(*(values[name] for name in names))]
+    return [run for run in runs if run["engine"] != "vectorized" or run["router"] == "bfs"] # The vectorized engine only supports the bfs router
+
+def run_simulation(run_id: int, parameters: dict, steps: int, record_every: int = 1) -> list[dict]:
+    '''Runs one simulation and returns a row with its parameters and metrics every record_every steps, the last step is always recorded.'''
+    rows = []
+    start = time.perf_counter()
+    model = CityModel(**parameters)
+    init_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for step in range(1, steps + 1):
+        model.step()
+        if step % record_every == 0 or step == steps:
+            rows.append({
+                "run_id": run_id,
+                **parameters,
+                "step": step,
+                "total_car_number": model.total_car_number,
+                "total_cars_at_destination": model.total_cars_at_destination,
+                "current_car_number": model.current_car_number,
+                "average_steps_to_destination": model.average_steps_to_destination,
+                "total_reroutes": model.metrics.totals["reroutes"],
+                "total_light_wait_steps": model.metrics.totals["waiting_at_lights"],
+                "total_dropped": model.metrics.totals["dropped"],
+                "total_undeliverable": model.metrics.totals["undeliverable"],
+                "queued_at_spawns": model.demand.queued,
+                "init_seconds": init_seconds,
+                "elapsed_seconds": time.perf_counter() - start,
+            })
+    return rows
+
+def run_sweep(parameters: dict[str, list], steps: int, workers: int | None = None, record_every: int = 1) -> pd.DataFrame:
+    '''Runs a simulation for every combination of parameters on a process pool, and returns the rows of every run in one table ordered by run and step.'''
+    runs = parameter_grid(parameters)
+    for run in runs: # Workers could be started from another folder, so the map files are given as absolute paths
+        run["map_file"] = os.path.abspath(run["map_file"])
+        if run["demand"] is not None:
+            run["demand"] = os.path.abspath(run["demand"])
+
+    rows = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(run_simulation, run_id, run, steps, record_every): run_id for run_id, run in enumerate(runs)}
+        for finished, future in enumerate(as_completed(futures), start=1):
+            rows.extend(future.result())
+            print(f"Run {futures[future]} finished ({finished}/{len(runs)})")
+    return pd.DataFrame(rows).sort_values(["run_id", "step"], ignore_index=True)
+
+def check_output(path: str):
+    '''Raises a ValueError if the table can't be saved on the given path, so a sweep doesn't run just to fail at the end.'''
+    if path.endswith(".parquet") and not any(importlib.util.find_spec(engine) for engine in ("pyarrow", "fastparquet")):
+        raise ValueError("Saving Parquet needs pyarrow or fastparquet, install one of them or use a .csv output")
+    folder = os.path.dirname(os.path.abspath(path))
+    if not os.path.isdir(folder):
+        raise ValueError(f"The output folder {folder} doesn't exist")
+
+def save_table(table: pd.DataFrame, path: str):
+    '''Saves the table as Parquet if the path ends with .parquet, and as CSV otherwise.'''
+    if path.endswith(".parquet"):
+        table.to_parquet(path, index=False) # Needs pyarrow or fastparquet
+    else:
+        table.to_csv(path, index=False)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Headless parameter sweeps of CityModel")
+    parser.add_argument("--steps", type=int, default=500)
+    parser.add_argument("--place-cars-interval", type=int, nargs="+")
+    parser.add_argument("--light-interval", type=int, nargs="+")
+    parser.add_argument("--signal-mode", nargs="+", choices=["fixed", "adaptive"])
+    parser.add_argument("--router", nargs="+", choices=["bfs", "astar"])
+    parser.add_argument("--engine", nargs="+", choices=["agents", "events", "vectorized"])
+    parser.add_argument("--map-file", nargs="+")
+    parser.add_argument("--demand", nargs="+", help="Demand files with spawn cells, origin-destination matrix and rates, e.g. map_files/demand/2024_rush_hour.json. Without it a map only uses its own <map>.demand.json")
+    parser.add_argument("--seeds", type=int, nargs="+")
+    parser.add_argument("--workers", type=int, help="Number of processes, by default one per CPU")
+    parser.add_argument("--record-every", type=int, default=1, help="Record the metrics every this many steps")
+    parser.add_argument("--output", default="results.csv", help="Output table, .csv or .parquet")
+    args = parser.parse_args()
+
+    if args.steps < 1 or args.record_every < 1:
+        parser.error("--steps and --record-every must be positive")
+    try:
+        check_output(args.output)
+    except ValueError as error:
+        parser.error(str(error))
+
+    table = run_sweep({
+        "place_cars_interval": args.place_cars_interval,
+        "light_interval": args.light_interval,
+        "signal_mode": args.signal_mode,
+        "router": args.router,
+        "engine": args.engine,
+        "map_file": args.map_file,
+        "demand": args.demand,
+        "seed": args.seeds,
+    }, args.steps, args.workers, args.record_every)
+    save_table(table, args.output)
+
+    final = table[table["step"] == args.steps]
+    print(final.drop(columns=["run_id", "step", "map_file", "demand"]).to_string(index=False))
+    print(f"Saved {len(table)} rows to {args.output}")
@@ -0,0 +1,41 @@
+# Marcos Dayan Mann A01782876
+# José Manuel García Zumaya A01784238
+# 20 noviembre 2024
+# Runs the agents engine for a long time and shows, every interval, the agents registered on mesa, the cars on the pool, the memory traced by Python and the collections of the garbage collector.
+# With the cars recycled by the model, the registered agents and the memory stay flat while cars keep arriving.
+# Run from the backend folder: python benchmarks/bench_car_pool.py --steps 5000 --interval 1000
+
+import argparse
+import gc
+import os
+import sys
+import time
+import tracemalloc
+import warnings
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from traffic_base.model import CityModel
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Memory and garbage collection of long runs")
+    parser.add_argument("--map", default="map_files/2024_base.txt")
+    parser.add_argument("--router", choices=["bfs", "astar"], default="bfs")
+    parser.add_argument("--steps", type=int, default=5000)
+    parser.add_argument("--interval", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    warnings.simplefilter("ignore", FutureWarning) # CityModel doesn't call Model.__init__
+    model = CityModel(1, args.router, map_file=args.map, seed=args.seed)
+    tracemalloc.start()
+    collections = sum(stats["collections"] for stats in gc.get_stats())
+    start = time.perf_counter()
+    print(f"{'step':>6} {'arrived':>8} {'registered':>11} {'pool':>5} {'traced KiB':>11} {'gc runs':>8} {'steps/s':>8}")
+    for step in range(1, args.steps + 1):
+        model.step()
+        if step % args.interval == 0:
+            seconds = time.perf_counter() - start
+            traced = tracemalloc.get_traced_memory()[0] / 1024
+            gc_runs = sum(stats["collections"] for stats in gc.get_stats()) - collections
+            print(f"{step:>6} {model.total_cars_at_destination:>8} {len(model._agents):>11} {len(model.car_pool):>5} {traced:>11.0f} {gc_runs:>8} {args.interval / seconds:>8.1f}")
+            start = time.perf_counter()
@@ -0,0 +1,52 @@
+# Marcos Dayan Mann A01782876
+# José Manuel García Zumaya A01784238
+# 20 noviembre 2024
+# Loads the network with Poisson demand of increasing rates and measures its throughput: the cars that enter and arrive per step, the cars waiting on the spawn queues and the ones dropped.
+# Past the saturation point the arrivals per step stop growing while the queues and the dropped cars do.
+# Run from the backend folder: python benchmarks/bench_demand.py --rates 0.1 0.25 0.5 1 2 --engine vectorized
+
+import argparse
+import os
+import sys
+import time
+import warnings
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from traffic_base.model import CityModel
+
+def measure(map_file: str, engine: str, demand: dict, warmup: int, steps: int, seed: int) -> dict:
+    '''Returns the throughput of a model with the given demand, measured over steps after warmup steps.'''
+    model = CityModel(1, "bfs", engine, map_file=map_file, seed=seed, demand=demand)
+    for _ in range(warmup):
+        model.step()
+    totals = dict(model.metrics.totals)
+    queued = 0
+    start = time.perf_counter()
+    for _ in range(steps):
+        model.step()
+        queued += model.demand.queued
+    seconds = time.perf_counter() - start
+    result = {name: (model.metrics.totals[name] - totals[name]) / steps for name in ("spawned", "arrived", "dropped")}
+    result["queued"] = queued / steps
+    result["cars"] = model.current_car_number
+    result["steps_per_second"] = steps / seconds
+    model.close()
+    return result
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Throughput of the network under increasing demand")
+    parser.add_argument("--map", default="map_files/2024_base.txt")
+    parser.add_argument("--engine", choices=["agents", "vectorized"], default="vectorized")
+    parser.add_argument("--rates", type=float, nargs="+", default=[0.1, 0.25, 0.5, 1.0, 2.0], help="Cars per step arriving on every corner")
+    parser.add_argument("--max-queue", type=int, default=100)
+    parser.add_argument("--warmup", type=int, default=300, help="Steps before measuring, so the network reaches its steady state")
+    parser.add_argument("--steps", type=int, default=300)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    warnings.simplefilter("ignore", FutureWarning) # CityModel doesn't call Model.__init__
+    print(f"{'rate':>6} {'offered/step':>13} {'entered/step':>13} {'arrived/step':>13} {'queued':>8} {'dropped/step':>13} {'cars':>6} {'steps/s':>8}")
+    for rate in args.rates:
+        demand = {"mode": "poisson", "rate": rate, "max_queue": args.max_queue} # The corners, every one with the same rate
+        result = measure(args.map, args.engine, demand, args.warmup, args.steps, args.seed)
+        print(f"{rate:>6} {4 * rate:>13.2f} {result['spawned']:>13.2f} {result['arrived']:>13.2f} {result['queued']:>8.1f} {result['dropped']:>13.2f} {result['cars']:>6} {result['steps_per_second']:>8.1f}")
@@ -0,0 +1,48 @@
+# Marcos Dayan Mann A01782876
+# José Manuel García Zumaya A01784238
+# 20 noviembre 2024
+# Runs the same model on several engines with fixed seeds and compares their metrics, so a faster engine can be checked against the agents.
+# The arrivals are printed every quarter of the run: an engine that locks up stops adding arrivals while its cars pile up.
+# Run from the backend folder: python benchmarks/bench_engines.py --engines agents vectorized partitioned --seeds 1 2 3 4 --steps 1000
+
+import argparse
+import os
+import sys
+import time
+import warnings
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from traffic_base.model import CityModel
+
+def measure(map_file: str, engine: str, seed: int, steps: int, tiles: int | None) -> dict:
+    '''Runs a model for the given steps, returns its arrivals on every quarter of the run, its cars at the end, its totals and its steps per second.'''
+    model = CityModel(2, "bfs", engine, map_file=map_file, seed=seed, tiles=tiles)
+    arrivals = []
+    start = time.perf_counter()
+    for step in range(1, steps + 1):
+        model.step()
+        if step % max(steps // 4, 1) == 0:
+            arrivals.append(model.total_cars_at_destination)
+    seconds = time.perf_counter() - start
+    result = {"arrivals": arrivals, "cars": model.current_car_number, "totals": dict(model.metrics.totals), "steps_per_second": steps / seconds}
+    model.close()
+    return result
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Metrics of the engines with the same seeds")
+    parser.add_argument("--maps", nargs="+", default=["map_files/2024_base.txt"])
+    parser.add_argument("--engines", nargs="+", default=["agents", "vectorized", "partitioned"])
+    parser.add_argument("--seeds", type=int, nargs="+", default=[1, 2, 3, 4])
+    parser.add_argument("--steps", type=int, default=1000)
+    parser.add_argument("--tiles", type=int, default=2, help="Tiles of the partitioned engine")
+    args = parser.parse_args()
+
+    warnings.simplefilter("ignore", FutureWarning) # CityModel doesn't call Model.__init__
+    print(f"{'map':>16} {'engine':>12} {'seed':>5} {'arrivals by quarter':>26} {'cars':>5} {'reroutes':>9} {'waiting':>8} {'steps/s':>8}")
+    for map_file in args.maps:
+        for engine in args.engines:
+            for seed in args.seeds:
+                result = measure(map_file, engine, seed, args.steps, args.tiles if engine == "partitioned" else None)
+                arrivals = " ".join(f"{count:>6}" for count in result["arrivals"])
+                totals = result["totals"]
+                print(f"{os.path.basename(map_file):>16} {engine:>12} {seed:>5} {arrivals:>26} {result['cars']:>5} {totals['reroutes']:>9} {totals['waiting_at_lights']:>8} {result['steps_per_second']:>8.1f}", flush=True)
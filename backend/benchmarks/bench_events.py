@@ -0,0 +1,76 @@
+# Marcos Dayan Mann A01782876
+# José Manuel García Zumaya A01784238
+# 20 noviembre 2024
+# Compares the agents engine, which runs every car on every step, with the events engine, which only runs the cars whose situation changed.
+# Long lights and heavy demand leave more cars waiting, so the events engine runs fewer cars per step and gets faster.
+# "ran" is the cars the events engine ran on an average step: its time per step divided by them ("us/ran") stays about the same on every workload, while the agents engine pays for every car ("us/car").
+# --edge spawns the cars on every street cell of the border of the map instead of the corners, so large maps fill with queues.
+# Run from the backend folder: python benchmarks/bench_events.py --light-intervals 10 40 --rates 0.5 2
+# or, with most cars queued at long lights: python benchmarks/bench_events.py --size 120 --edge --light-intervals 10 60 --rates 0.05 0.2
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+import warnings
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from traffic_base.map_generator import write_map
+from traffic_base.model import CityModel
+from traffic_base.read_map import load_map
+
+def edge_spawns(map_file: str) -> list[list[int]]:
+    '''Returns the street cells on the border of the map.'''
+    compiled_map = load_map(map_file)
+    grid = compiled_map.grid()
+    width, height = len(grid[0]), len(grid)
+    return [[x, y] for x, y in compiled_map.graph if x in (0, width - 1) or y in (0, height - 1)]
+
+def measure(map_file: str, engine: str, light_interval: int, rate: float, spawns: list | None, warmup: int, steps: int, seed: int) -> dict:
+    '''Returns the steps per second of a model after warmup steps, and for the events engine the cars asleep and the cars run on an average step.'''
+    demand = {"mode": "poisson", "rate": rate, "max_queue": 100}
+    if spawns:
+        demand["spawns"] = spawns
+    model = CityModel(1, "bfs", engine, map_file=map_file, light_interval=light_interval, seed=seed, demand=demand)
+    for _ in range(warmup):
+        model.step()
+    cars = asleep = ran = 0
+    start = time.perf_counter()
+    for _ in range(steps):
+        model.step()
+        cars += model.current_car_number
+        if model.events is not None:
+            asleep += len(model.events.sleeping)
+            ran += model.events.ran
+    seconds = time.perf_counter() - start
+    model.close()
+    return {"steps_per_second": steps / seconds, "cars": cars / steps, "asleep": asleep / steps, "ran": ran / steps}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Agents engine against the event-driven engine")
+    parser.add_argument("--map", default="map_files/2024_base.txt")
+    parser.add_argument("--light-intervals", type=int, nargs="+", default=[10, 40])
+    parser.add_argument("--size", type=int, help="Runs on a generated map of this size instead of --map")
+    parser.add_argument("--edge", action="store_true", help="Spawns on every border street cell instead of the corners")
+    parser.add_argument("--rates", type=float, nargs="+", default=[0.5, 2.0], help="Cars per step arriving on every spawn cell")
+    parser.add_argument("--warmup", type=int, default=300, help="Steps before measuring, so the network fills with cars")
+    parser.add_argument("--steps", type=int, default=300)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    warnings.simplefilter("ignore", FutureWarning) # CityModel doesn't call Model.__init__
+    map_file = args.map
+    if args.size:
+        map_file = os.path.join(tempfile.mkdtemp(), f"synthetic_{args.size}.txt")
+        write_map(map_file, args.size, args.size, seed=args.seed)
+    spawns = edge_spawns(map_file) if args.edge else None
+    print(f"{'lights':>6} {'rate':>6} {'cars':>6} {'asleep':>7} {'ran':>6} {'agents steps/s':>15} {'events steps/s':>15} {'speedup':>8} {'us/car':>7} {'us/ran':>7}")
+    for light_interval in args.light_intervals:
+        for rate in args.rates:
+            agents = measure(map_file, "agents", light_interval, rate, spawns, args.warmup, args.steps, args.seed)
+            events = measure(map_file, "events", light_interval, rate, spawns, args.warmup, args.steps, args.seed)
+            speedup = events["steps_per_second"] / agents["steps_per_second"]
+            per_car = 1e6 / (agents["steps_per_second"] * max(agents["cars"], 1))
+            per_ran = 1e6 / (events["steps_per_second"] * max(events["ran"], 1))
+            print(f"{light_interval:>6} {rate:>6} {events['cars']:>6.0f} {events['asleep']:>7.1f} {events['ran']:>6.1f} {agents['steps_per_second']:>15.1f} {events['steps_per_second']:>15.1f} {speedup:>7.2f}x {per_car:>7.1f} {per_ran:>7.1f}", flush=True)
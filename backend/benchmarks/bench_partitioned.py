@@ -0,0 +1,72 @@
+# Marcos Dayan Mann A01782876
+# José Manuel García Zumaya A01784238
+# 20 noviembre 2024
+# Measures how the partitioned engine scales with the number of tiles, against the vectorized engine on one process, on generated maps of several sizes.
+# Every tile is a worker process, so the speedup is bounded by the cores of the machine (shown on the first line).
+# "projected" is the step time if every tile had its own core: the measured step minus the time the tiles took, plus the time of the slowest tile.
+# The partitioned engine only pays off once "projected" beats the vectorized engine, which hasn't happened yet on the maps measured (see PartitionedEngine).
+# --edge-rate adds cars on every street cell of the border of the map, so large maps have enough cars to keep the tiles busy.
+# Run from the backend folder: python benchmarks/bench_partitioned.py --sizes 250 500 --tiles 1 2 4 --edge-rate 0.05
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+import warnings
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from traffic_base.map_generator import write_map
+from traffic_base.model import CityModel
+from traffic_base.read_map import load_map
+
+def edge_demand(map_file: str, rate: float) -> dict | None:
+    '''Returns a demand with Poisson arrivals on every street cell of the border of the map, None for the default demand.'''
+    if not rate:
+        return None
+    compiled_map = load_map(map_file)
+    grid = compiled_map.grid()
+    width, height = len(grid[0]), len(grid)
+    spawns = [[x, y] for x, y in compiled_map.graph if x in (0, width - 1) or y in (0, height - 1)]
+    return {"mode": "poisson", "rate": rate, "spawns": spawns, "max_queue": 20}
+
+def measure(map_file: str, engine: str, tiles: int | None, warmup: int, steps: int, seed: int, demand: dict | None) -> tuple[float, float, int, int]:
+    '''Returns the steps per second of a model after warmup steps, the steps per second it would reach with a core per tile, the cars that arrived and the cars on the map at the end.'''
+    model = CityModel(1, "bfs", engine, map_file=map_file, seed=seed, tiles=tiles, demand=demand)
+    for _ in range(warmup):
+        model.step()
+    saved = 0.0 # Time the tiles waited for each other on one core
+    start = time.perf_counter()
+    for _ in range(steps):
+        model.step()
+        if engine == "partitioned":
+            tile_seconds = model.vector_engine.tile_seconds
+            saved += sum(tile_seconds) - max(tile_seconds)
+    seconds = time.perf_counter() - start
+    arrived, cars = model.total_cars_at_destination, model.current_car_number
+    model.close()
+    return steps / seconds, steps / (seconds - saved), arrived, cars
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Scaling of the partitioned engine with the number of tiles")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[250, 500])
+    parser.add_argument("--tiles", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--warmup", type=int, default=200, help="Steps before measuring, so the map has cars")
+    parser.add_argument("--steps", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--edge-rate", type=float, default=0.0, help="Cars per step arriving on every border cell, 0 for the default demand")
+    args = parser.parse_args()
+
+    warnings.simplefilter("ignore", FutureWarning) # CityModel doesn't call Model.__init__
+    print(f"{os.cpu_count()} cores")
+    print(f"{'size':>6} {'engine':>12} {'tiles':>6} {'steps/s':>9} {'speedup':>8} {'projected':>10} {'speedup':>8} {'arrived':>8} {'cars':>7}")
+    with tempfile.TemporaryDirectory() as folder:
+        for size in args.sizes:
+            map_file = os.path.join(folder, f"synthetic_{size}.txt")
+            write_map(map_file, size, size, seed=args.seed)
+            demand = edge_demand(map_file, args.edge_rate)
+            baseline, _, arrived, cars = measure(map_file, "vectorized", None, args.warmup, args.steps, args.seed, demand)
+            print(f"{size:>6} {'vectorized':>12} {'-':>6} {baseline:>9.1f} {1:>8.2f} {'-':>10} {'-':>8} {arrived:>8} {cars:>7}", flush=True)
+            for tiles in args.tiles:
+                steps_per_second, projected, arrived, cars = measure(map_file, "partitioned", tiles, args.warmup, args.steps, args.seed, demand)
+                print(f"{size:>6} {'partitioned':>12} {tiles:>6} {steps_per_second:>9.1f} {steps_per_second / baseline:>8.2f} {projected:>10.1f} {projected / baseline:>8.2f} {arrived:>8} {cars:>7}", flush=True)
@@ -0,0 +1,61 @@
+# Marcos Dayan Mann A01782876
+# José Manuel García Zumaya A01784238
+# 20 noviembre 2024
+# Measures the cost of advancing one cell on a route as the route gets longer: the list of tuples consumed with pop(0) the cars used before, against the Route and index they use now.
+# Also shows the bytes each route takes per cell.
+# Run from the backend folder: python benchmarks/bench_route_moves.py
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from traffic_base.routing import Route
+
+def straight_steps(length: int) -> list[tuple[tuple[int, int], tuple[int, int]]]:
+    '''Returns a route going right for length cells, as a list of coordinates and directions.'''
+    return [((x, 0), (1, 0)) for x in range(1, length + 1)]
+
+def consume_list(steps: list) -> float:
+    '''Follows a copy of the route like Car.following_route did, reading the first cell and removing it with pop(0). Returns the seconds taken.'''
+    route = list(steps)
+    start = time.perf_counter()
+    while route:
+        next_cell, direction = route[0]
+        route.pop(0)
+    return time.perf_counter() - start
+
+def consume_route(route: Route) -> float:
+    '''Follows the route like Car.following_route does now, reading the cell on the index and increasing it. Returns the seconds taken.'''
+    route_index = 0
+    start = time.perf_counter()
+    while len(route.cells) - route_index:
+        next_cell, direction = route.cells[route_index], route.directions[route_index]
+        route_index += 1
+    return time.perf_counter() - start
+
+def list_bytes(steps: list) -> int:
+    '''Bytes of the list, its tuples and their coordinate tuples (the small ints are cached by Python and not counted).'''
+    return sys.getsizeof(steps) + sum(sys.getsizeof(step) + sys.getsizeof(step[0]) + sys.getsizeof(step[1]) for step in steps)
+
+def route_bytes(route: Route) -> int:
+    '''Bytes of the route and its two tuples, the coordinate tuples are shared (on a model, with the street graph) and so are the direction tuples.'''
+    return sys.getsizeof(route) + sys.getsizeof(route.cells) + sys.getsizeof(route.directions)
+
+def best_per_move(consume, route, length: int, repeats: int) -> float:
+    return min(consume(route) for _ in range(repeats)) / length
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Cost per move versus route length")
+    parser.add_argument("--lengths", type=int, nargs="+", default=[10, 100, 1000, 10000, 100000])
+    parser.add_argument("--repeats", type=int, default=5, help="Times every route is followed, the fastest time is kept")
+    args = parser.parse_args()
+
+    print(f"{'length':>8} {'pop(0) ns/move':>15} {'index ns/move':>14} {'list B/cell':>12} {'Route B/cell':>13}")
+    for length in args.lengths:
+        steps = straight_steps(length)
+        route = Route.from_steps(steps)
+        list_time = best_per_move(consume_list, steps, length, args.repeats)
+        route_time = best_per_move(consume_route, route, length, args.repeats)
+        print(f"{length:>8} {list_time * 1e9:>15.1f} {route_time * 1e9:>14.1f} {list_bytes(steps) / length:>12.1f} {route_bytes(route) / length:>13.1f}")
@@ -0,0 +1,55 @@
+# Marcos Dayan Mann A01782876
+# José Manuel García Zumaya A01784238
+# 20 noviembre 2024
+# Compares the fixed and adaptive signal modes on the same seeds: arrivals, average trip and steps cars waited at lights.
+# The default demand can't fill the map (a corner only takes a car every other step), so --edge-rates also runs a demand with a spawn on every street cell of the border of the map.
+# Run from the backend folder: python benchmarks/bench_signals.py --engine vectorized --light-intervals 10 30 --edge-rates 0.05 0.1
+
+import argparse
+import os
+import sys
+import warnings
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from traffic_base.model import CityModel
+
+def edge_spawns(map_file: str) -> list[list[int]]:
+    '''Returns the road cells on the border of the map.'''
+    occupancy = CityModel(map_file=map_file, seed=0).occupancy
+    width, height = occupancy.width, occupancy.height
+    return [[x, y] for x in range(width) for y in range(height) if (x in (0, width - 1) or y in (0, height - 1)) and occupancy.road_direction[x, y] != 0]
+
+def measure(map_file: str, engine: str, signal_mode: str, light_interval: int, demand: dict | None, seeds: list[int], steps: int) -> np.ndarray:
+    '''Returns the arrivals, the average trip steps and the steps waited at lights of the runs, averaged over the seeds.'''
+    results = []
+    for seed in seeds:
+        model = CityModel(2, "bfs", engine, map_file=map_file, light_interval=light_interval, signal_mode=signal_mode, seed=seed, demand=demand)
+        for _ in range(steps):
+            model.step()
+        results.append((model.total_cars_at_destination, model.metrics.average_trip_steps(), model.metrics.totals["waiting_at_lights"]))
+        model.close()
+    return np.mean(results, axis=0)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Fixed against adaptive traffic lights")
+    parser.add_argument("--map", default="map_files/2024_base.txt")
+    parser.add_argument("--engine", default="agents", choices=["agents", "events", "vectorized", "partitioned"])
+    parser.add_argument("--light-intervals", type=int, nargs="+", default=[10, 30])
+    parser.add_argument("--edge-rates", type=float, nargs="*", default=[0.05, 0.1], help="Cars per step arriving on every border cell, on top of the default demand runs")
+    parser.add_argument("--seeds", type=int, nargs="+", default=[0, 1, 2, 3])
+    parser.add_argument("--steps", type=int, default=600)
+    args = parser.parse_args()
+
+    warnings.simplefilter("ignore", FutureWarning) # CityModel doesn't call Model.__init__
+    demands = [("default", None)]
+    if args.edge_rates:
+        spawns = edge_spawns(args.map)
+        demands += [(f"edge {rate:g}", {"mode": "poisson", "rate": rate, "spawns": spawns, "max_queue": 20}) for rate in args.edge_rates]
+    print(f"{'demand':>10} {'lights':>6} {'fixed arrived':>14} {'adaptive arrived':>17} {'change':>7} {'fixed trip':>11} {'adaptive trip':>14} {'fixed waits':>12} {'adaptive waits':>15}")
+    for name, demand in demands:
+        for light_interval in args.light_intervals:
+            fixed = measure(args.map, args.engine, "fixed", light_interval, demand, args.seeds, args.steps)
+            adaptive = measure(args.map, args.engine, "adaptive", light_interval, demand, args.seeds, args.steps)
+            change = adaptive[0] / fixed[0] - 1
+            print(f"{name:>10} {light_interval:>6} {fixed[0]:>14.1f} {adaptive[0]:>17.1f} {change:>+7.1%} {fixed[1]:>11.1f} {adaptive[1]:>14.1f} {fixed[2]:>12.0f} {adaptive[2]:>15.0f}", flush=True)
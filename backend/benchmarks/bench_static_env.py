@@ -0,0 +1,85 @@
+# Marcos Dayan Mann A01782876
+# José Manuel García Zumaya A01784238
+# 20 noviembre 2024
+# Measures the init and step time of CityModel on maps of increasing size, built by tiling the bundled 2024 map.
+# --backend measures another checkout of the backend, e.g. one from before the static agents left the scheduler, and --compare prints the times next to a saved run:
+# git worktree add /tmp/scheduled <commit before the change>
+# python benchmarks/bench_static_env.py --backend /tmp/scheduled/backend --output scheduled.json
+# python benchmarks/bench_static_env.py --compare scheduled.json
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+import warnings
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def write_tiled_map(base_map: str, tiles: int, path: str):
+    '''Writes a map made of tiles x tiles copies of the base map.'''
+    with open(base_map, 'r', encoding='utf-8') as file:
+        rows = [line.rstrip('\n') for line in file]
+    with open(path, 'w', encoding='utf-8') as file:
+        for _ in range(tiles):
+            for row in rows:
+                file.write(row * tiles + '\n')
+
+def measure(map_file: str, steps: int) -> tuple[float, float, int]:
+    '''Returns the init time, the average step time and the number of scheduled agents of a model on the given map.'''
+    from traffic_base.model import CityModel # Imported from the backend chosen with --backend
+    with contextlib.redirect_stdout(io.StringIO()): # The model prints on every step
+        start = time.perf_counter()
+        model = CityModel(2, map_file=map_file)
+        init_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for _ in range(steps):
+            model.step()
+        step_time = (time.perf_counter() - start) / steps
+    return init_time, step_time, len(model.schedule.agents)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Step time versus map size")
+    parser.add_argument("--base-map", default="map_files/2024_base.txt")
+    parser.add_argument("--tiles", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--steps", type=int, default=50)
+    parser.add_argument("--backend", default=BACKEND, help="Backend folder of the code to measure, this one by default")
+    parser.add_argument("--output", help="JSON file for the results")
+    parser.add_argument("--compare", help="JSON results of a previous run, e.g. of an older backend, printed next to these ones")
+    args = parser.parse_args()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as file:
+            baseline = json.load(file)
+        if baseline["settings"]["steps"] != args.steps:
+            print("Warning: the baseline was run with a different number of steps")
+    sys.path.insert(0, os.path.abspath(args.backend))
+    warnings.simplefilter("ignore", FutureWarning) # CityModel doesn't call Model.__init__
+
+    results = {}
+    header = f"{'map size':>10} {'init (s)':>10} {'step (ms)':>10} {'scheduled':>10}"
+    print(header + (f" {'base init':>10} {'base step':>10} {'base sched':>10} {'speedup':>8}" if baseline else ""))
+    with tempfile.TemporaryDirectory() as folder:
+        for tiles in args.tiles:
+            map_file = os.path.join(folder, f"tiled_{tiles}.txt")
+            write_tiled_map(args.base_map, tiles, map_file)
+            init_time, step_time, scheduled = measure(map_file, args.steps)
+            with open(map_file, 'r', encoding='utf-8') as file:
+                rows = file.read().splitlines()
+            size = f"{len(rows[0])}x{len(rows)}"
+            results[size] = {"init_seconds": init_time, "step_seconds": step_time, "scheduled": scheduled}
+            line = f"{len(rows[0]):>4}x{len(rows):<5} {init_time:>10.3f} {step_time * 1000:>10.2f} {scheduled:>10}"
+            previous = baseline["results"].get(size) if baseline else None
+            if previous:
+                line += f" {previous['init_seconds']:>10.3f} {previous['step_seconds'] * 1000:>10.2f} {previous['scheduled']:>10} {previous['step_seconds'] / step_time:>7.2f}x"
+            print(line)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            json.dump({"settings": {"backend": os.path.abspath(args.backend), "base_map": args.base_map, "steps": args.steps}, "results": results}, file, indent=2)
+        print(f"Saved the results to {args.output}")
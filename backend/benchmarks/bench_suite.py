@@ -0,0 +1,247 @@
+# Marcos Dayan Mann A01782876
+# José Manuel García Zumaya A01784238
+# 20 noviembre 2024
+# Benchmark suite of CityModel. Runs the bundled maps and synthetic maps up to 1000x1000 at fixed seeds, measuring init time, steps per second, peak memory, route lookups per step and arrived cars.
+# Results are saved as JSON so runs of different commits can be compared, --compare fails if a metric got worse than the threshold.
+# Run from the backend folder, for example:
+# python benchmarks/bench_suite.py --output bench.json
+# python benchmarks/bench_suite.py --output new.json --compare bench.json --threshold 0.1
+
+import argparse
+import gc
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BACKEND_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_FOLDER)
+from traffic_base.map_generator import write_map
+
+try:
+    import resource # Not available on Windows, peak memory is not measured there
+except ImportError:
+    resource = None
+
+BUNDLED_MAPS = ["2021_base.txt", "2022_base.txt", "2024_base.txt"]
+SYNTHETIC_MAP_SEED = 0 # Seed of the generated maps, fixed so every run measures the same maps
+DEFAULT_SYNTHETIC_SIZES = [100, 250, 500, 1000]
+ARRAY_ENGINES = ["vectorized", "partitioned"] # Engines that read the routing table arrays directly, without the route cache or the router, so their route metrics are None
+
+# Metrics compared by --compare, with True when a higher value is better
+COMPARED_METRICS = {
+    "cold_init_seconds": False,
+    "init_seconds": False,
+    "steps_per_second": True,
+    "peak_memory_mb": False,
+    "search_nodes_per_step": False,
+    "route_calls_per_step": False,
+    "arrived_per_step": True,
+}
+
+def max_rss_mb() -> float | None:
+    '''Returns the peak resident memory of this process in MB.'''
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024 # Bytes on macOS, KB on Linux
+
+def run_case(map_file: str, parameters: dict, steps: int, counted_steps: int, repeats: int) -> dict:
+    '''
+    Builds a model on the map and measures it, meant to run on a fresh process so the peak memory belongs to this case only.
+    The init and the steps are timed without instrumentation on repeats new models, the first init compiles the map and the next ones load it from the cache. The fastest times are kept, then the profiler counts the route lookups and the routes made by the router over counted_steps more steps of the last model.
+    The route metrics are None on the engines of ARRAY_ENGINES, so --compare doesn't take their counters for a baseline of 0.
+    '''
+    from traffic_base.model import CityModel
+
+    memory_before = max_rss_mb()
+    init_times, step_seconds = [], float("inf")
+    model = None
+    for _ in range(repeats):
+        model = None # The previous model is freed first, so the peak memory is the one of a single model
+        gc.collect()
+        start = time.perf_counter()
+        model = CityModel(map_file=map_file, **parameters)
+        init_times.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        for _ in range(steps):
+            model.step()
+        step_seconds = min(step_seconds, time.perf_counter() - start)
+    memory_after = max_rss_mb()
+    arrived = model.total_cars_at_destination # The same on every repeat, the seed is fixed
+    spawned = model.total_car_number
+    average_trip = model.average_steps_to_destination
+
+    counters = {}
+    uses_routes = parameters["engine"] not in ARRAY_ENGINES
+    if not uses_routes:
+        counters = {"route_lookups_per_step": None, "route_calls_per_step": None, "search_nodes_per_step": None}
+    elif counted_steps > 0:
+        profiler = model.enable_profiling()
+        for _ in range(counted_steps):
+            model.step()
+        model.disable_profiling()
+        counters = {
+            "route_lookups_per_step": profiler.counters["route_cache_calls"] / counted_steps, # Routes asked by the cars to the route cache
+            "route_calls_per_step": profiler.counters["route_calls"] / counted_steps, # Routes missing from the cache, asked to the router
+            "search_nodes_per_step": profiler.counters["astar_nodes" if parameters["router"] == "astar" else "route_nodes"] / counted_steps, # Nodes expanded by A*, or cells walked on the routing table
+        }
+
+    return {
+        "width": model.width,
+        "height": model.height,
+        "cold_init_seconds": init_times[0], # Compiling the map and its routing table
+        "init_seconds": min(init_times[1:]) if repeats > 1 else None, # Loading them from the cache
+        "steps_per_second": steps / step_seconds,
+        "peak_memory_mb": memory_after - memory_before if memory_before is not None else None,
+        **counters,
+        "arrived": arrived,
+        "arrived_per_step": arrived / steps,
+        "arrived_per_second": arrived / step_seconds,
+        "spawned": spawned,
+        "average_steps_to_destination": average_trip,
+        "route_cache_hit_rate": model.route_cache.stats()["hit_rate"] if uses_routes else None, # Routes of the cars found in the route cache, over every step
+    }
+
+def case_process(connection, map_file: str, parameters: dict, steps: int, counted_steps: int, repeats: int):
+    try:
+        with tempfile.TemporaryDirectory(ignore_cleanup_errors=True) as folder: # The map is copied to an empty folder, so the first model compiles it and its cache is removed afterwards
+            connection.send(("ok", run_case(shutil.copy(map_file, folder), parameters, steps, counted_steps, repeats)))
+    except Exception as error:
+        connection.send(("error", f"{type(error).__name__}: {error}"))
+    finally:
+        connection.close()
+
+def run_isolated(map_file: str, parameters: dict, steps: int, counted_steps: int, repeats: int, timeout: float) -> dict:
+    '''Runs a case on its own process, returns its metrics or its status if it failed or took longer than timeout seconds.'''
+    context = multiprocessing.get_context("spawn") # Fresh interpreter, nothing shared with the previous cases
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=case_process, args=(sender, map_file, parameters, steps, counted_steps, repeats))
+    process.start()
+    sender.close()
+    if receiver.poll(timeout):
+        try:
+            status, result = receiver.recv()
+        except EOFError:
+            status, result = "error", "the process ended without a result"
+    else:
+        status, result = "timeout", f"took longer than {timeout:g} s"
+        process.terminate()
+    process.join()
+    if status == "ok":
+        return {"status": "ok", **result}
+    return {"status": status, "detail": result}
+
+def benchmark_cases(synthetic_sizes: list[int], folder: str) -> list[tuple[str, str]]:
+    '''Returns the name and map file of every case, generating the synthetic maps on the folder.'''
+    maps_folder = os.path.join(BACKEND_FOLDER, "map_files")
+    cases = [(name.removesuffix(".txt"), os.path.join(maps_folder, name)) for name in BUNDLED_MAPS]
+    for size in synthetic_sizes:
+        map_file = os.path.join(folder, f"synthetic_{size}.txt")
+        write_map(map_file, size, size, seed=SYNTHETIC_MAP_SEED)
+        cases.append((f"synthetic_{size}", map_file))
+    return cases
+
+def environment() -> dict:
+    '''Returns what is needed to know where the results come from.'''
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND_FOLDER, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    import mesa
+    import numpy
+    return {
+        "commit": commit,
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "numpy": numpy.__version__,
+        "mesa": mesa.__version__,
+        "machine": platform.machine(),
+        "system": platform.system(),
+        "cpus": os.cpu_count(),
+    }
+
+def run_suite(args) -> dict:
+    parameters = {"place_cars_interval": args.place_cars_interval, "router": args.router, "engine": args.engine}
+    results = {}
+    with tempfile.TemporaryDirectory() as folder:
+        for name, map_file in benchmark_cases(args.synthetic_sizes, folder):
+            if args.cases and name not in args.cases:
+                continue
+            for seed in args.seeds:
+                key = f"{name}/seed{seed}"
+                print(f"{key} ...", end=" ", flush=True)
+                result = run_isolated(map_file, {**parameters, "seed": seed}, args.steps, args.counted_steps, args.repeats, args.timeout)
+                results[key] = result
+                if result["status"] == "ok":
+                    print(f"init {result['cold_init_seconds']:.2f} s, {result['steps_per_second']:.1f} steps/s, {result['arrived']} arrived")
+                else:
+                    print(f"{result['status']} ({result['detail']})")
+    return {
+        "environment": environment(),
+        "settings": {**parameters, "steps": args.steps, "counted_steps": args.counted_steps, "repeats": args.repeats, "seeds": args.seeds},
+        "results": results,
+    }
+
+def compare(current: dict, baseline: dict, threshold: float) -> list[str]:
+    '''Returns a line for every metric of a case that got worse than the baseline by more than the threshold (a fraction).'''
+    regressions = []
+    for key, result in current["results"].items():
+        previous = baseline["results"].get(key)
+        if previous is None or previous["status"] != "ok":
+            continue
+        if result["status"] != "ok":
+            regressions.append(f"{key}: {result['status']}, it was ok on the baseline")
+            continue
+        for metric, higher_is_better in COMPARED_METRICS.items():
+            old, new = previous.get(metric), result.get(metric)
+            if old is None or new is None or old == 0:
+                continue
+            change = (new - old) / abs(old)
+            if (change < -threshold) if higher_is_better else (change > threshold):
+                regressions.append(f"{key}: {metric} {old:.4g} -> {new:.4g} ({change:+.1%})")
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark suite of CityModel")
+    parser.add_argument("--steps", type=int, default=200, help="Timed steps of every case")
+    parser.add_argument("--repeats", type=int, default=3, help="Times every timing is repeated on a new model, the fastest one is kept")
+    parser.add_argument("--counted-steps", type=int, default=50, help="Profiled steps after the timed ones, used to count the route lookups")
+    parser.add_argument("--seeds", type=int, nargs="+", default=[0])
+    parser.add_argument("--synthetic-sizes", type=int, nargs="*", default=DEFAULT_SYNTHETIC_SIZES, help="Width and height of the synthetic maps, made by the map generator")
+    parser.add_argument("--cases", nargs="+", help="Only run the cases with these names, e.g. 2024_base synthetic_250")
+    parser.add_argument("--place-cars-interval", type=int, default=2)
+    parser.add_argument("--router", default="bfs", choices=["bfs", "astar"])
+    parser.add_argument("--engine", default="agents", choices=["agents", "events", "vectorized", "partitioned"])
+    parser.add_argument("--timeout", type=float, default=600, help="Seconds a case can take before it is stopped")
+    parser.add_argument("--output", help="JSON file for the results")
+    parser.add_argument("--compare", help="JSON results of a previous run to compare with")
+    parser.add_argument("--threshold", type=float, default=0.1, help="Fraction a metric can get worse before it is a regression")
+    args = parser.parse_args()
+
+    if args.steps < 1 or args.repeats < 1 or args.counted_steps < 0:
+        parser.error("--steps and --repeats must be positive and --counted-steps can't be negative")
+
+    report = run_suite(args)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            json.dump(report, file, indent=2)
+        print(f"Saved the results to {args.output}")
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as file:
+            baseline = json.load(file)
+        if baseline["settings"] != report["settings"]:
+            print("Warning: the baseline was run with different settings, the results may not be comparable")
+        regressions = compare(report, baseline, args.threshold)
+        for line in regressions:
+            print(f"REGRESSION {line}")
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions over {args.threshold:.0%} against {args.compare}")
@@ -0,0 +1,66 @@
+# Marcos Dayan Mann A01782876
+# José Manuel García Zumaya A01784238
+# 20 noviembre 2024
+
+import threading
+import pytest
+from traffic_base import checkpoint
+from traffic_base.model import CityModel
+from traffic_base.checkpoint import CheckpointWriter, save_checkpoint, load_checkpoint
+
+MODELS = [
+    ("map_files/2024_base.txt", "bfs", "agents", "fixed"),
+    ("map_files/2024_base.txt", "astar", "agents", "adaptive"),
+    ("map_files/2021_base.txt", "bfs", "events", "fixed"),
+    ("map_files/2021_base.txt", "bfs", "vectorized", "adaptive"),
+]
+
+def state(model: CityModel) -> tuple:
+    '''Returns the cars, the traffic lights, the counters and the metrics of a model.'''
+    return sorted(model.get_car_states()), model.signals.color_codes().tolist(), model.total_cars_at_destination, model.total_car_number, model.current_car_number, model.metrics.prometheus(), model.metrics.npz()
+
+def run(model: CityModel, steps: int):
+    for _ in range(steps):
+        model.step()
+
+@pytest.mark.parametrize("map_file, router, engine, signal_mode", MODELS)
+def test_restored_model_takes_the_same_steps(tmp_path, map_file, router, engine, signal_mode):
+    model = CityModel(router=router, engine=engine, map_file=map_file, signal_mode=signal_mode, seed=3)
+    run(model, 60)
+    path = str(tmp_path / "model.npz")
+    save_checkpoint(model, path, {"current_step": 60})
+    restored, metadata = load_checkpoint(path)
+    assert metadata == {"current_step": 60}
+    assert state(restored) == state(model)
+
+    run(model, 100)
+    run(restored, 100)
+    assert state(restored) == state(model)
+    model.close()
+    restored.close()
+
+def test_writer_keeps_the_newest_state(tmp_path, monkeypatch):
+    release = threading.Event()
+    write_checkpoint = checkpoint.write_checkpoint
+    def blocked_write(path, arrays):
+        release.wait() # Every write waits, so the next checkpoints are submitted while the first one is written
+        write_checkpoint(path, arrays)
+    monkeypatch.setattr(checkpoint, "write_checkpoint", blocked_write)
+
+    model = CityModel(seed=3)
+    writer = CheckpointWriter()
+    path = str(tmp_path / "model.npz")
+    futures = []
+    for step in range(3):
+        model.step()
+        futures.append(writer.submit(model, path, {"current_step": step + 1}))
+    assert futures[1] is futures[2] # The second state was replaced by the third before being written
+    release.set()
+    for future in futures:
+        future.result(timeout=10)
+
+    restored, metadata = load_checkpoint(path)
+    assert metadata == {"current_step": 3}
+    assert state(restored) == state(model)
+    model.close()
+    restored.close()
@@ -0,0 +1,46 @@
+# Marcos Dayan Mann A01782876
+# José Manuel García Zumaya A01784238
+# 20 noviembre 2024
+
+import pytest
+from traffic_base.model import CityModel
+
+MODELS = [
+    ("map_files/2024_base.txt", "bfs", "agents", "fixed"),
+    ("map_files/2024_base.txt", "astar", "agents", "adaptive"),
+    ("map_files/2021_base.txt", "bfs", "events", "fixed"),
+    ("map_files/2021_base.txt", "bfs", "vectorized", "adaptive"),
+]
+
+def state(model: CityModel) -> tuple:
+    '''Returns the cars, the traffic lights, the counters and the metrics of a model.'''
+    return sorted(model.get_car_states()), model.signals.color_codes().tolist(), model.total_cars_at_destination, model.total_car_number, model.current_car_number, model.metrics.prometheus(), model.metrics.npz()
+
+def run(model: CityModel, steps: int):
+    for _ in range(steps):
+        model.step()
+
+@pytest.mark.parametrize("map_file, router, engine, signal_mode", MODELS)
+def test_fork_takes_the_same_steps(map_file, router, engine, signal_mode):
+    model = CityModel(router=router, engine=engine, map_file=map_file, signal_mode=signal_mode, seed=3)
+    run(model, 60)
+    fork = model.fork()
+    assert state(fork) == state(model)
+
+    run(model, 100)
+    run(fork, 100)
+    assert state(fork) == state(model)
+
+    seeded = fork.fork(seed=11) # Another seed draws other random numbers, but starts from the same cars
+    assert sorted(seeded.get_car_states()) == sorted(fork.get_car_states())
+    model.close()
+    fork.close()
+    seeded.close()
+
+def test_models_without_seed_differ():
+    first, second = CityModel(), CityModel()
+    run(first, 30)
+    run(second, 30)
+    assert sorted(first.get_car_states()) != sorted(second.get_car_states())
+    first.close()
+    second.close()
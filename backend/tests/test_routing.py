@@ -0,0 +1,21 @@
+# Marcos Dayan Mann A01782876
+# José Manuel García Zumaya A01784238
+# 20 noviembre 2024
+
+import pytest
+from traffic_base.model import CityModel
+from traffic_base.agent import Car
+
+@pytest.mark.parametrize("map_file", ["map_files/2021_base.txt", "map_files/2022_base.txt", "map_files/2024_base.txt"])
+def test_routing_table_matches_bfs(map_file):
+    model = CityModel(map_file=map_file, seed=0)
+    car = Car(0, model, "calculating_route", model.grid_info["destinations"][0])
+    graph, table = model.street_graph, model.routing_table
+    for goal in set(model.grid_info["destinations"]):
+        for start in set(graph) | model.corners:
+            expected = car.bfs(graph, start, goal)
+            route = table.route(start, goal)
+            assert (None if route is None else list(route)) == expected, (start, goal)
+            if route is not None:
+                assert table.route_length(start, goal) == len(route)
+    model.close()
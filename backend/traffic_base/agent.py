@@ -4,32 +4,49 @@
 
 from mesa import Agent
 from collections import deque
+from traffic_base.routing import Route, EMPTY_ROUTE
+
+VISITED_CELLS = 64 # Cells a car remembers having been to after changing its route, the oldest ones are forgotten first
 
 class Car(Agent):
     '''
-    Car agent. Represents a car in the grid.
+    Car agent. Represents a car in the grid. The model recycles the cars that arrived for the next ones it places (see CityModel.new_car).
     Attributes:
-    - status: string representing the status of the car. Can be "calculating_route", "following_route", "avoiding_bottleneck" or "arrived".
-    - route: List of tuples that contain coordinates that the car will follow to reach its destination, and the direction it will take to reach that coordinate.
-    - destination_coords: list of possible destination coordinates.
-    - destination: tuple representing the destination of the car, it is randomly selected from all destination_coords.
-    - color: string representing the color of the car on mesa's server.
-    - street_graph: dictionary representing the streets and connections between them.
+    - unique_id: int identifying the car, sent to the clients as "c_<id>".
+    - status: string representing the status of the car. Can be "calculating_route", "following_route", "avoiding_bottleneck", "arrived" or "undeliverable" (there is no route to its destination).
+    - route: Route with the coordinates the car will follow to reach its destination and the direction it will take to reach each of them, shared with the model's route cache so it is never changed.
+    - route_index: index of the next cell of the route, increased every time the car advances instead of removing the cell.
+    - destination: tuple representing the destination of the car, drawn by the demand model of the model.
+    - color: string representing the color of the car on mesa's server, the same for every car.
     - direction: tuple representing the direction the car is facing.
-    - previous_cells_after_change: set of cells the car has been to after recalculating the route.
+    - previous_cells_after_change: deque with the last VISITED_CELLS cells the car has been to after recalculating the route.
     - did_avoid_bottleneck_on_past: boolean flag to monitor if used the avoid bottleneck function on traffic lights.
+    - spawn_step: step when the car was placed on the grid.
+    - light_wait_steps: number of steps the car has waited for red or yellow traffic lights.
+    - reroutes: number of times the car has changed its route to avoid traffic.
     '''
-    def __init__(self, unique_id, model, status: str, street_graph: dict, destination_coords: list[tuple[int, int]]):
+    color = "blue"
+
+    def __init__(self, unique_id: int, model, status: str, destination: tuple[int, int]):
         super().__init__(unique_id, model)
-        self.status = status 
-        self.route = [] 
-        self.destination_coords = destination_coords 
-        self.destination = self.random.choice(destination_coords)
-        self.color = "blue"
-        self.street_graph = street_graph 
-        self.direction = (0, 0) 
-        self.previous_cells_after_change = set() 
+        self.previous_cells_after_change = deque(maxlen=VISITED_CELLS)
+        self.reset(unique_id, status, destination)
+
+
+    def reset(self, unique_id: int, status: str, destination: tuple[int, int]):
+        '''Leaves the car as if it was just created with the given id, status and destination, so an arrived car can be placed again.'''
+        self.unique_id = unique_id
+        self.pos = None
+        self.status = status
+        self.route = EMPTY_ROUTE
+        self.route_index = 0
+        self.destination = destination
+        self.direction = (0, 0)
+        self.previous_cells_after_change.clear()
         self.did_avoid_bottleneck_on_past = False
+        self.spawn_step = 0
+        self.light_wait_steps = 0
+        self.reroutes = 0
 
 
     def bfs(self, graph: dict[tuple[int, int], list[tuple[int, int]]], start: tuple[int, int], goal: tuple[int, int]) -> list[tuple[tuple[int, int], tuple[int, int]]]:
@@ -43,14 +60,7 @@ class Car(Agent):
         visited = set()
         visited.add(start)
         parent = {}
-            
-            
-        corners = [ # Define the map corners
-            (0, 0), 
-            (0, self.model.height - 1), 
-            (self.model.width - 1, 0), 
-            (self.model.width - 1, self.model.height - 1)
-        ]
+        corners = self.model.corners # Map corners, which can't be part of a route
         
         while queue: # While there are nodes to visit
             current = queue.popleft() # Get the first node in the queue
@@ -94,12 +104,42 @@ class Car(Agent):
 
    
 
+    def set_route(self, route):
+        '''Starts following a route from its first cell, an empty route if it is None.'''
+        self.route = route if route is not None else EMPTY_ROUTE
+        self.route_index = 0
+
+
+    def remaining_route(self) -> int:
+        '''Returns the number of cells of the route the car hasn't reached yet.'''
+        return len(self.route.cells) - self.route_index
+
+
     def calculating_route(self):
-        '''Calculates the route the car will follow to reach its destination using the BFS algorithm and changes the status of the car to "following_route"'''
-        self.route = self.bfs(self.street_graph, self.pos, self.destination)
-        if self.route:
+        '''Calculates the route the car will follow to reach its destination using the model's route cache, which asks the router for the routes it doesn't have (by default the same route as the BFS algorithm), and changes the status of the car to "following_route"'''
+        route = self.model.route_cache.route(self.pos, self.destination)
+        if route is None and not self.model.occupancy.has_destination(self.pos): # There is no route to the destination (e.g. a destination on a map corner), the car leaves the grid without counting as an arrival
+            self.leave_undelivered()
+            return
+        self.set_route(route)
+        if route is None or route: # A car placed on a destination cell arrives on its next step
             self.status = "following_route"
-            self.model.average_steps_to_destination = self.model.average_steps_to_destination + ((len(self.route) - self.model.average_steps_to_destination) / (self.model.total_car_number + 1)) # Updating the average steps to destination metric with a moving average formula
+
+
+    def leave_undelivered(self):
+        '''Removes the car from the grid and the scheduler when it can't reach its destination, counting it as undeliverable on the model's metrics.'''
+        self.status = "undeliverable"
+        self.model.schedule.remove(self)
+        self.model.remove_car(self)
+        self.model.current_car_number -= 1
+        self.model.metrics.step_undeliverable += 1
+        self.model.release_car(self) # Back to the model's pool, the car isn't used after this
+
+
+    def count_reroute(self):
+        '''Counts a change of route to avoid traffic on the car and on the model's metrics.'''
+        self.reroutes += 1
+        self.model.metrics.step_reroutes += 1
 
 
     def is_opposite_direction(self, new_direction: tuple[int, int]) -> bool:
@@ -111,117 +151,137 @@ class Car(Agent):
     def handle_traffic_ahead(self, next_cell: tuple[int, int]):
         '''Handles the traffic ahead of the car by checking the possible moves and avoiding bottlenecks on traffic lights.'''
 
-        possible_moves = self.street_graph.get(self.pos, []) # possible moves in graph from current position in street
+        possible_moves = self.model.street_graph.get(self.pos, []) # possible moves in graph from current position in street
 
         possible_moves = [pos for pos in possible_moves if pos != next_cell and pos not in self.previous_cells_after_change] # taking out current next_cell and cells where we have been to prevent zig-zagging
 
+        occupancy = self.model.occupancy
+        pos_direction = occupancy.get_road_direction(self.pos) # main direction of the road the car is on, it doesn't change while evaluating the moves
+        if pos_direction is None: # cars that are not on a road (e.g. on a traffic light) don't take alternative moves
+            possible_moves = []
+
         for move in possible_moves:
-            move_contents = self.model.grid.get_cell_list_contents(move)
-            is_move_free = not any( # statement to check that the cell we are evaluating to move is available
-                (isinstance(agent, Car) or 
-                (isinstance(agent, Destination) and move != self.destination))
-                for agent in move_contents)
-            
-            is_move_red_light = any(isinstance(agent, Traffic_Light) and agent.is_red for agent in move_contents) # checking the free cell is not a red traffic light
+            is_move_free = not (occupancy.has_car(move) or (occupancy.has_destination(move) and move != self.destination)) # statement to check that the cell we are evaluating to move is available
 
-            pos_roads = [agent for agent in self.model.grid.get_cell_list_contents(self.pos) if isinstance(agent, Road)]
-            if not pos_roads:
-                continue
-            pos_road = pos_roads[0]
+            move_traffic_light = occupancy.get_traffic_light(move)
+            is_move_red_light = move_traffic_light is not None and move_traffic_light.is_red # checking the free cell is not a red traffic light
             
             new_direction = self.get_direction(self.pos, move) # recalculating the direction of the move so in mesa we can represent the car in the correct rotation
-            illegal_move_to_traffic_light = pos_road.main_direction != new_direction and any(isinstance(agent, Traffic_Light) for agent in move_contents)
+            illegal_move_to_traffic_light = pos_direction != new_direction and move_traffic_light is not None
             if illegal_move_to_traffic_light:
                 continue
 
             if is_move_free and not is_move_red_light: # if the move is free and there is no red light, we move to that cell
                 if not self.is_opposite_direction(new_direction):
-                    provisional_route = self.bfs(self.street_graph, move, self.destination) # recalculating the route to the destination
-                    if provisional_route and (len(provisional_route) <= len(self.route)):  # if the new route is shorter or equal to the current route, we move to the new cell
-                        self.route = provisional_route
+                    provisional_cost = self.model.router.route_cost(move, self.destination) # cost of the route to the destination from the move cell, its length when routing with BFS
+                    if provisional_cost and (provisional_cost <= self.model.router.path_cost(self.route, self.route_index)):  # if the new route is cheaper or equal to the current route, we move to the new cell
+                        self.set_route(self.model.route_cache.route(move, self.destination))
+                        self.count_reroute()
                     
-                    if self.route and self.route[0][0] == move: # if the route contains the move cell, we delete it so in the next step we don't move to the same cell
-                        self.route.pop(0)
+                    if self.remaining_route() and self.route.cells[self.route_index] == move: # if the route contains the move cell, we skip it so in the next step we don't move to the same cell
+                        self.route_index += 1
                     
-                    self.model.grid.move_agent(self, move) # moving the car to the new cell
-                    self.direction = new_direction # updating the direction of the car
-                    self.previous_cells_after_change.add(move) # adding the cell to the previous cells set to prevent zig-zagging
+                    self.model.move_car(self, move, new_direction) # moving the car to the new cell and updating its direction
+                    self.previous_cells_after_change.append(move) # adding the cell to the previous cells to prevent zig-zagging
                     return
                 
 
         # If there is no possible move, we check if the car is on a traffic light and if it is red, we avoid the bottleneck
-        traffic_light = [agent for agent in self.model.grid.get_cell_list_contents(self.pos) if isinstance(agent, Traffic_Light)]
-        if traffic_light and not traffic_light[0].is_red:
+        traffic_light = occupancy.get_traffic_light(self.pos)
+        if traffic_light is not None and not traffic_light.is_red:
             self.avoid_bottleneck_on_traffic_light()
 
 
 
 
+    def blocking_cells(self, next_cell: tuple[int, int]) -> list[tuple[int, int]]:
+        '''
+        Returns the cells that keep a car blocked by traffic where it is: its next cell and the moves handle_traffic_ahead would take if they were free.
+        The moves it never takes whatever the traffic (backwards, into destinations that aren't the car's or into a traffic light from the side) are left out. Used by the event engine to wake the car when one of them is freed.
+        '''
+        cells = [next_cell]
+        occupancy = self.model.occupancy
+        pos_direction = occupancy.get_road_direction(self.pos)
+        if pos_direction is None: # Same as handle_traffic_ahead, cars that are not on a road don't take alternative moves
+            return cells
+        for move in self.model.street_graph.get(self.pos, []):
+            if move == next_cell or move in self.previous_cells_after_change or (occupancy.has_destination(move) and move != self.destination):
+                continue
+            new_direction = self.get_direction(self.pos, move)
+            if (pos_direction != new_direction and occupancy.get_traffic_light(move) is not None) or self.is_opposite_direction(new_direction):
+                continue
+            cells.append(move)
+        return cells
+
+
     def avoid_bottleneck_on_traffic_light(self):
         '''Avoids the bottleneck on a traffic light by moving the car to the next cells in the road and preventing it to close to other cars'''
-        self.route.clear() # Clearing the route to avoid the bottleneck
+        detour = [] # Replaces the route to avoid the bottleneck, it belongs to this car so it isn't cached
         self.status = "avoiding_bottleneck"
         self.did_avoid_bottleneck_on_past = True
+        self.count_reroute()
 
         overload_x, overload_y = 0, 0
 
         for _ in range(5): # Moving the car to the next 5 cells in the road if possible and calculating the new route rom there
             next_x, next_y = self.pos[0] + self.direction[0] + overload_x , self.pos[1] + self.direction[1] + overload_y
-            road = [agent for agent in self.model.grid.get_cell_list_contents((next_x, next_y)) if isinstance(agent, Road)]
-            if not road:
+            road_direction = self.model.occupancy.get_road_direction((next_x, next_y))
+            if road_direction is None:
+                self.set_route(Route.from_steps(detour))
                 return
-            road = road[0]
-            self.route.append(((next_x, next_y), road.main_direction))
-            overload_x += road.main_direction[0]
-            overload_y += road.main_direction[1]
+            detour.append(((next_x, next_y), road_direction))
+            overload_x += road_direction[0]
+            overload_y += road_direction[1]
         
+        self.set_route(Route.from_steps(detour))
         if self.route: # Making the first move
-            self.model.grid.move_agent(self, self.route[0][0])
-            self.direction = self.route[0][1]
-            self.route.pop(0)
+            self.model.move_car(self, *self.route[0])
+            self.route_index += 1
 
 
     def following_route(self):
-        if not self.route or self.destination == self.pos or any(isinstance(agent, Destination) for agent in self.model.grid.get_cell_list_contents(self.pos)):
+        occupancy = self.model.occupancy
+        if not self.remaining_route() or self.destination == self.pos or occupancy.has_destination(self.pos):
             self.status = "arrived"
             self.model.schedule.remove(self)
-            self.model.grid.remove_agent(self)
+            self.model.remove_car(self)
             self.model.total_cars_at_destination += 1
             self.model.current_car_number -= 1
+            self.model.metrics.record_arrival(self.spawn_step, self.light_wait_steps, self.reroutes)
+            self.model.release_car(self) # Back to the model's pool, the car isn't used after this
             return
 
-        next_cell, direction = self.route[0]
-        next_cell_contents = self.model.grid.get_cell_list_contents(next_cell)
-        is_car_agent = any(isinstance(agent, Car) for agent in next_cell_contents)
+        next_cell, direction = self.route.cells[self.route_index], self.route.directions[self.route_index]
+        is_car_agent = occupancy.has_car(next_cell)
 
-        is_current_traffic_light = [agent for agent in self.model.grid.get_cell_list_contents(self.pos) if isinstance(agent, Traffic_Light)] 
-        is_next_traffic_light = [agent for agent in next_cell_contents if isinstance(agent, Traffic_Light)]
+        current_traffic_light = occupancy.get_traffic_light(self.pos)
+        next_traffic_light = occupancy.get_traffic_light(next_cell)
         
         
-        if is_current_traffic_light and is_next_traffic_light and not is_next_traffic_light[0].is_red:
+        if current_traffic_light is not None and next_traffic_light is not None and not next_traffic_light.is_red:
             self.avoid_bottleneck_on_traffic_light()
         
-        elif is_next_traffic_light and (is_next_traffic_light[0].is_yellow or is_next_traffic_light[0].is_red): # No other choice than waiting for the traffic light to turn green
+        elif next_traffic_light is not None and (next_traffic_light.is_yellow or next_traffic_light.is_red): # No other choice than waiting for the traffic light to turn green
+            self.light_wait_steps += 1
+            self.model.metrics.step_waiting_at_lights += 1
             return
 
-        elif self.status == "avoiding_bottleneck" and len(self.route) > 0 and not is_car_agent:
-            self.model.grid.move_agent(self, next_cell)
-            self.direction = direction
-            self.route.pop(0)
+        elif self.status == "avoiding_bottleneck" and self.remaining_route() > 0 and not is_car_agent:
+            self.model.move_car(self, next_cell, direction)
+            self.route_index += 1
             return
  
         elif is_car_agent:
             self.handle_traffic_ahead(next_cell)
-            if not self.route:
+            if not self.remaining_route() and self.model.verbose:
                 print("Car without route")
         else:
-            self.route.pop(0)
-            self.model.grid.move_agent(self, next_cell)
-            self.direction = direction
+            self.route_index += 1
+            self.model.move_car(self, next_cell, direction)
 
 
     def subsumption(self):
-        if self.status == "calculating_route" and len(self.route) == 0 and self.pos != self.destination: # Calculating route
+        if self.status == "calculating_route" and self.remaining_route() == 0 and self.pos != self.destination: # Calculating route
             self.calculating_route()
         # elif self.status == "following_route": # While following route
         else:
@@ -251,42 +311,45 @@ class Road(Agent):
 
 class Traffic_Light(Agent):
     '''
-    Traffic light agent. Represents a traffic light in the grid.
+    Traffic light agent. Represents a traffic light in the grid, its state is kept by the model's SignalController, which advances every light at once.
     Attributes:
     - directions: list of strings representing the directions the traffic light is facing.
+    - controller: SignalController that keeps the state of the traffic light.
+    - light_id: int representing the index of the traffic light in the controller.
     - is_red: boolean flag to determine if the traffic light is red.
     - is_yellow: boolean flag to determine if the traffic light is yellow.
     - time_interval: int representing the time interval the traffic light takes to change.
     - time_to_change: int representing the time left to change the traffic light.
     - color: string representing the color of the traffic light on mesa's server.
     '''
-    def __init__(self, unique_id, model, directions: list[str], is_red: bool, time_to_change: int, color: str):
+    def __init__(self, unique_id, model, directions: list[str], controller, light_id: int):
         super().__init__(unique_id, model)
         self.directions = directions
-        self.is_red = is_red
-        self.is_yellow = False
-        self.time_interval = time_to_change
-        self.time_to_change = time_to_change
-        self.color = color
+        self.controller = controller
+        self.light_id = light_id
+
+    @property
+    def is_red(self) -> bool:
+        return bool(self.controller.is_red[self.light_id])
+
+    @property
+    def is_yellow(self) -> bool:
+        return bool(self.controller.is_yellow[self.light_id])
+
+    @property
+    def time_interval(self) -> int:
+        return int(self.controller.time_interval[self.light_id])
+
+    @property
+    def time_to_change(self) -> int:
+        return int(self.controller.time_to_change[self.light_id])
+
+    @property
+    def color(self) -> str:
+        return self.controller.get_color(self.light_id)
 
     def step(self):
-        '''Changes the color of the traffic light based on the time interval and the current timer'''
-        if self.is_red == False and self.time_to_change < 1: # yellow to red
-            self.color = "red"
-            self.is_red = True
-            self.is_yellow = False
-            self.time_to_change = self.time_interval
-
-        elif self.is_red == True and self.time_to_change < 1: # red to green
-            self.color = "green"
-            self.is_red = False
-            self.time_to_change = self.time_interval
-
-        elif self.is_red == False and self.time_to_change < 2: # green to yellow
-            self.color = "yellow"
-            self.is_yellow = True
-        
-        self.time_to_change -= 1
+        pass # The controller changes every light at once
 
 class Obstacle(Agent):
     """
@@ -0,0 +1,290 @@
+# Marcos Dayan Mann A01782876
+# José Manuel García Zumaya A01784238
+# 20 noviembre 2024
+
+from concurrent.futures import Future, ThreadPoolExecutor
+from itertools import chain
+import json
+import os
+import threading
+import numpy as np
+
+CHECKPOINT_VERSION = 5 # Changes every time the layout of the checkpoints changes, older checkpoints can't be restored
+CAR_STATUSES = ("calculating_route", "following_route", "avoiding_bottleneck", "arrived") # Status of the cars by the code saved on the checkpoint
+HISTOGRAMS = ("trip_steps", "light_wait_steps", "reroutes", "queue_length", "entry_wait_steps") # Histograms of the metrics collector
+
+def capture(model, metadata: dict | None = None) -> dict[str, np.ndarray]:
+    '''
+    Copies the dynamic state of the model to NumPy arrays: cars with their routes, traffic light timers, spawn queues, metrics, random generators and step counters.
+    The arrays don't share memory with the model, so the model can keep stepping while they are written. The static map is not saved, only its file and hash.
+    metadata is a dictionary saved as it is, e.g. the step counter of a session.
+    '''
+    from traffic_base.partitioned import PartitionedEngine
+    from traffic_base.routing import CongestionRouter
+
+    if isinstance(model.vector_engine, PartitionedEngine):
+        raise ValueError("Models on the partitioned engine can't be checkpointed, their cars are on the worker processes")
+    version, random_state, gauss_next = model.random.getstate()
+    header = {
+        "version": CHECKPOINT_VERSION,
+        "map_file": model.map_file,
+        "map_hash": model.map_hash,
+        "parameters": {
+            "place_cars_interval": model.place_cars_interval,
+            "router": "astar" if isinstance(model.router, CongestionRouter) else "bfs",
+            "engine": "vectorized" if model.vector_engine is not None else "events" if model.events is not None else "agents",
+            "light_interval": model.light_interval,
+            "signal_mode": model.signals.mode,
+            "seed": model._seed,
+            "demand": model.demand.config,
+        },
+        "counters": {
+            "total_cars_at_destination": model.total_cars_at_destination,
+            "total_car_number": model.total_car_number,
+            "current_car_number": model.current_car_number,
+            "id_counter": model.id_counter,
+            "running": model.running,
+            "schedule_steps": model.schedule.steps,
+            "schedule_time": model.schedule.time,
+            "model_steps": model._steps,
+            "model_time": model._time,
+        },
+        "random_version": version,
+        "random_gauss_next": gauss_next,
+        "vector_rng": model.vector_engine.rng.bit_generator.state if model.vector_engine is not None else None,
+        "demand_rng": model.demand.rng.bit_generator.state if model.demand.rng is not None else None,
+        "events": model.events.state() if model.events is not None else None,
+        "metrics": {
+            "recorded": model.metrics.recorded,
+            "current_step": model.metrics.current_step,
+            "step_counters": [model.metrics.step_spawned, model.metrics.step_arrived, model.metrics.step_reroutes, model.metrics.step_waiting_at_lights, model.metrics.step_dropped, model.metrics.step_undeliverable],
+            "last_spawn_queue": model.metrics.last_spawn_queue,
+            "totals": model.metrics.totals,
+            "histogram_totals": [getattr(model.metrics, name).total for name in HISTOGRAMS],
+        },
+        "metadata": metadata or {},
+    }
+
+    signals = model.signals
+    metrics = model.metrics
+    queue_lengths, queue_steps = model.demand.queue_steps()
+    arrays = {
+        "header": np.frombuffer(json.dumps(header).encode(), dtype=np.uint8),
+        "random_state": np.array(random_state, dtype=np.uint32),
+        "light_is_red": signals.is_red.copy(),
+        "light_is_yellow": signals.is_yellow.copy(),
+        "light_time_to_change": signals.time_to_change.copy(),
+        "light_queue_length": signals.queue_length.copy(),
+        "light_extension": signals.extension.copy(),
+        "demand_queue_lengths": queue_lengths,
+        "demand_queue_steps": queue_steps,
+        "metrics_steps": metrics.steps.copy(),
+        "metrics_light_queue_sum": metrics.light_queue_sum.copy(),
+        "metrics_last_queue_length": metrics.last_queue_length.copy(),
+    }
+    for name in HISTOGRAMS:
+        arrays[f"metrics_{name}_counts"] = getattr(metrics, name).counts.copy()
+
+    if model.vector_engine is not None:
+        engine = model.vector_engine
+        for name in engine.ARRAYS:
+            arrays[f"vector_{name}"] = getattr(engine, name)[:engine.count].copy()
+    else:
+        arrays.update(capture_cars(model))
+    return arrays
+
+def capture_cars(model) -> dict[str, np.ndarray]:
+    '''Packs the Car agents in the order of the scheduler, their routes and visited cells are saved as flat arrays with the offsets of every car.'''
+    cars = model.schedule.agents
+    slots = model.car_states.slots
+    status_codes = {status: code for code, status in enumerate(CAR_STATUSES)}
+    # One row per car, read in a single pass and converted to arrays once
+    rows = np.fromiter(chain.from_iterable(
+        (car.unique_id, *car.pos, *car.direction, *car.destination, status_codes[car.status], car.spawn_step, car.light_wait_steps, car.reroutes, car.did_avoid_bottleneck_on_past, slots[car.unique_id])
+        for car in cars
+    ), dtype=np.int64).reshape(-1, 13)
+    route_cells = [car.route.cells[car.route_index:] for car in cars]
+    route_directions = [car.route.directions[car.route_index:] for car in cars]
+    visited_cells = [car.previous_cells_after_change for car in cars]
+    route_steps = np.hstack([pair_rows(route_cells), pair_rows(route_directions)])
+    return {
+        "car_number": rows[:, 0].astype(np.int32),
+        "car_position": rows[:, 1:3].astype(np.int32),
+        "car_direction": rows[:, 3:5].astype(np.int8),
+        "car_destination": rows[:, 5:7].astype(np.int32),
+        "car_status": rows[:, 7].astype(np.int8),
+        "car_counters": rows[:, 8:11].astype(np.int32), # spawn_step, light_wait_steps and reroutes
+        "car_avoided_bottleneck": rows[:, 11].astype(bool),
+        "car_slot": rows[:, 12].astype(np.int32),
+        "route_offsets": offsets(route_cells),
+        "route_steps": route_steps, # x, y, direction x, direction y
+        "visited_offsets": offsets(visited_cells),
+        "visited_cells": pair_rows(visited_cells),
+    }
+
+def pair_rows(lists: list) -> np.ndarray:
+    '''Concatenates lists of (x, y) pairs as an int32 array with a row per pair.'''
+    return np.fromiter(chain.from_iterable(chain.from_iterable(lists)), dtype=np.int32).reshape(-1, 2)
+
+def offsets(lists: list) -> np.ndarray:
+    '''Returns where the items of every list start on the concatenation of all of them, followed by the total length.'''
+    lengths = np.fromiter(map(len, lists), dtype=np.int64, count=len(lists))
+    return np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+
+def write_checkpoint(path: str, arrays: dict[str, np.ndarray]):
+    '''Writes the arrays of a checkpoint as a compressed .npz file, replacing the previous checkpoint only once the new one is complete.'''
+    temporary_path = f"{path}.{threading.get_ident()}.tmp"
+    try:
+        with open(temporary_path, 'wb') as file:
+            np.savez_compressed(file, **arrays)
+        os.replace(temporary_path, path)
+    except BaseException:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+        raise
+
+def save_checkpoint(model, path: str, metadata: dict | None = None):
+    write_checkpoint(path, capture(model, metadata))
+
+def load_checkpoint(path: str, map_file: str | None = None):
+    '''
+    Creates a model from a checkpoint, returns it with the metadata saved with it.
+    The model is created again on the map file of the checkpoint (or the given one, e.g. if it was moved), which must have the same contents, and then its dynamic state is replaced by the saved one.
+    '''
+    from traffic_base.model import CityModel
+
+    with np.load(path) as file:
+        arrays = {name: file[name] for name in file.files}
+    header = json.loads(arrays["header"].tobytes())
+    if header["version"] != CHECKPOINT_VERSION:
+        raise ValueError(f"Checkpoint version {header['version']} is not supported, expected version {CHECKPOINT_VERSION}")
+
+    model = CityModel(map_file=map_file or header["map_file"], **header["parameters"])
+    if model.map_hash != header["map_hash"]:
+        raise ValueError("The map file changed since the checkpoint was saved")
+    restore(model, header, arrays)
+    return model, header["metadata"]
+
+def restore(model, header: dict, arrays: dict[str, np.ndarray]):
+    '''Replaces the dynamic state of a model that was just created with the state saved on a checkpoint.'''
+    from traffic_base.agent import Car
+    from traffic_base.routing import Route
+
+    signals = model.signals
+    signals.is_red[:] = arrays["light_is_red"]
+    signals.is_yellow[:] = arrays["light_is_yellow"]
+    signals.time_to_change = arrays["light_time_to_change"].copy()
+    signals.queue_length = arrays["light_queue_length"].copy()
+    signals.extension[:] = arrays["light_extension"]
+
+    if model.vector_engine is not None:
+        engine = model.vector_engine
+        count = len(arrays["vector_car_id"])
+        engine.ensure_capacity(count)
+        for name in engine.ARRAYS:
+            getattr(engine, name)[:count] = arrays[f"vector_{name}"]
+        engine.count = count
+        np.add.at(engine.cell_cars, engine.node_cell[engine.node[:count]], 1)
+        engine.rng.bit_generator.state = header["vector_rng"]
+        engine.write_states(model.car_states)
+    else:
+        # Cars are placed in the order of their slot on the car state buffer, so /getCars sends them in the same order, and scheduled in the saved order
+        cars = []
+        for index, number in enumerate(arrays["car_number"].tolist()):
+            car = Car(number, model, CAR_STATUSES[arrays["car_status"][index]], tuple(arrays["car_destination"][index].tolist()))
+            car.direction = tuple(arrays["car_direction"][index].tolist())
+            car.spawn_step, car.light_wait_steps, car.reroutes = arrays["car_counters"][index].tolist()
+            car.did_avoid_bottleneck_on_past = bool(arrays["car_avoided_bottleneck"][index])
+            start, end = arrays["route_offsets"][index:index + 2]
+            car.set_route(Route.from_array(arrays["route_steps"][start:end])) # Not shared with the route cache, which starts empty
+            start, end = arrays["visited_offsets"][index:index + 2]
+            car.previous_cells_after_change.extend((x, y) for x, y in arrays["visited_cells"][start:end].tolist())
+            cars.append(car)
+        for index in np.argsort(arrays["car_slot"], kind="stable").tolist():
+            spawn_step = cars[index].spawn_step
+            model.place_car(cars[index], tuple(arrays["car_position"][index].tolist()))
+            cars[index].spawn_step = spawn_step # place_car sets it to the current step
+        for car in cars:
+            model.schedule.add(car)
+        if model.events is not None: # Replacing the wake-ups of the cars placed above
+            model.events.set_state(header["events"])
+
+    model.demand.set_queue_steps(arrays["demand_queue_lengths"], arrays["demand_queue_steps"])
+    if model.demand.rng is not None:
+        model.demand.rng.bit_generator.state = header["demand_rng"]
+
+    metrics = model.metrics
+    saved = header["metrics"]
+    metrics.steps[:] = arrays["metrics_steps"]
+    metrics.recorded = saved["recorded"]
+    metrics.current_step = saved["current_step"]
+    metrics.step_spawned, metrics.step_arrived, metrics.step_reroutes, metrics.step_waiting_at_lights, metrics.step_dropped, metrics.step_undeliverable = saved["step_counters"]
+    metrics.last_spawn_queue = saved["last_spawn_queue"]
+    metrics.totals = dict(saved["totals"])
+    for name, total in zip(HISTOGRAMS, saved["histogram_totals"]):
+        histogram = getattr(metrics, name)
+        histogram.counts[:] = arrays[f"metrics_{name}_counts"]
+        histogram.total = total
+    metrics.light_queue_sum[:] = arrays["metrics_light_queue_sum"]
+    metrics.last_queue_length = arrays["metrics_last_queue_length"].copy()
+
+    counters = header["counters"]
+    model.total_cars_at_destination = counters["total_cars_at_destination"]
+    model.total_car_number = counters["total_car_number"]
+    model.current_car_number = counters["current_car_number"]
+    model.id_counter = counters["id_counter"]
+    model.running = counters["running"]
+    model.schedule.steps, model.schedule.time = counters["schedule_steps"], counters["schedule_time"]
+    model._steps, model._time = counters["model_steps"], counters["model_time"]
+    model.car_states.set_step(model.schedule.steps)
+    # The random generator is restored last, the model drew from it while it was created
+    model.random.setstate((header["random_version"], tuple(arrays["random_state"].tolist()), header["random_gauss_next"]))
+
+class CheckpointWriter:
+    '''
+    Checkpoint writer. Copies the state of a model on the calling thread and writes it on a background thread, so a checkpoint only stops the model while its arrays are copied.
+    Attributes:
+    - executor: single thread where the checkpoints are written, one at a time.
+    - pending: dictionary with the future of the checkpoint being written for every path.
+    - queued: dictionary with the newest state captured for every path while its previous checkpoint was written, and its future. It is written right after it.
+    '''
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="checkpoint")
+        self.pending = {}
+        self.queued = {}
+        self.lock = threading.Lock()
+
+
+    def submit(self, model, path: str, metadata: dict | None = None) -> Future:
+        '''
+        Starts writing a checkpoint of the model, must be called with the model's lock held. The state is always copied on the call, so the returned future is done once the file has the model's current state.
+        If a checkpoint of the path is still being written, the new state waits for it and replaces any older state that was waiting, whose callers get the future of the new one.
+        '''
+        arrays = capture(model, metadata)
+        with self.lock:
+            if path in self.pending:
+                queued = self.queued.get(path)
+                future = queued[1] if queued is not None else Future()
+                self.queued[path] = (arrays, future)
+                return future
+            future = Future()
+            self.pending[path] = future
+        self.executor.submit(self.write, path, arrays, future)
+        return future
+
+
+    def write(self, path: str, arrays: dict[str, np.ndarray], future: Future):
+        '''Writes a checkpoint on the writer thread, then starts writing the state queued for the same path while it was written, if any.'''
+        try:
+            write_checkpoint(path, arrays)
+        except Exception as exception:
+            future.set_exception(exception)
+        else:
+            future.set_result(None)
+        with self.lock:
+            queued = self.queued.pop(path, None)
+            if queued is None:
+                del self.pending[path]
+                return
+            self.pending[path] = queued[1]
+        self.executor.submit(self.write, path, *queued)
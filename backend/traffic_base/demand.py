@@ -0,0 +1,227 @@
+# Marcos Dayan Mann A01782876
+# José Manuel García Zumaya A01784238
+# 20 noviembre 2024
+
+from collections import deque
+import copy
+import json
+import math
+import os
+import numpy as np
+
+DEMAND_MODES = ("interval", "poisson")
+PROFILE_KINDS = ("constant", "rush_hour", "table")
+
+class DemandProfile:
+    '''
+    Multiplier of the spawn rates on every step, so the demand can change during the simulation.
+    Attributes:
+    - kind: string with the shape of the profile, "constant", "rush_hour" (a base level plus gaussian peaks) or "table" (linear interpolation between points).
+    - base: multiplier outside the peaks of a rush hour profile.
+    - peaks: list of (step, width, height) of every peak of a rush hour profile, each peak adds height on its step and fades with a standard deviation of width steps.
+    - points: float64 array (points x 2) with the steps and multipliers of a table profile, the first and last multipliers are kept before and after the points.
+    - period: steps after which the profile repeats (e.g. the steps of a day), 0 to never repeat.
+    '''
+    def __init__(self, kind: str = "constant", base: float = 1.0, peaks: list | None = None, points: list | None = None, period: int = 0):
+        if kind not in PROFILE_KINDS:
+            raise ValueError(f"Unknown demand profile '{kind}', expected one of {', '.join(PROFILE_KINDS)}")
+        if period < 0:
+            raise ValueError("The period of a demand profile can't be negative")
+        self.kind = kind
+        self.base = float(base)
+        self.peaks = [(float(step), float(width), float(height)) for step, width, height in peaks or []]
+        if any(width <= 0 for _, width, _ in self.peaks):
+            raise ValueError("The width of every rush hour peak must be positive")
+        self.points = np.array(points or [[0, 1.0]], dtype=np.float64).reshape(-1, 2)
+        if kind == "table" and np.any(np.diff(self.points[:, 0]) <= 0):
+            raise ValueError("The steps of a table profile must be increasing")
+        self.period = int(period)
+
+
+    @classmethod
+    def from_config(cls, config: dict | None) -> "DemandProfile":
+        '''Creates the profile from its dictionary on a demand config, peaks can be given as lists or as {"step", "width", "height"} dictionaries.'''
+        config = dict(config or {})
+        peaks = [[peak["step"], peak["width"], peak["height"]] if isinstance(peak, dict) else peak for peak in config.pop("peaks", [])]
+        return cls(peaks=peaks, **config)
+
+
+    def multiplier(self, step: int) -> float:
+        if self.period:
+            step %= self.period
+        if self.kind == "constant":
+            return self.base
+        if self.kind == "table":
+            return float(np.interp(step, self.points[:, 0], self.points[:, 1]))
+        value = self.base
+        for center, width, height in self.peaks:
+            distance = abs(step - center)
+            if self.period:
+                distance = min(distance, self.period - distance) # Peaks near the end of the period also rise at its beginning
+            value += height * math.exp(-0.5 * (distance / width) ** 2)
+        return value
+
+
+class DemandModel:
+    '''
+    Demand model. Decides how many cars enter the map on every step, on which spawn cells and where they go.
+    Cars arrive on the queue of their spawn cell, and the first car of every queue enters the map when the cell is free, so a blocked entry delays its cars instead of losing them.
+    The destination of every car is drawn when it enters, from the row of its spawn on the origin-destination matrix.
+    Attributes:
+    - model: model the cars are placed on.
+    - config: dictionary the demand was created from, None for the default demand (one car on every corner every place_cars_interval steps).
+    - mode: string with how cars arrive, "interval" brings one car to every spawn every interval steps and "poisson" draws the arrivals of every spawn from a Poisson distribution on every step.
+    - interval: steps between the arrivals of the interval mode.
+    - spawns: list with the coordinates of every spawn cell, street cells where cars enter the map.
+    - rates: float64 array with the cars per step arriving on every spawn on the poisson mode, before the profile multiplier.
+    - profile: DemandProfile with the multiplier of the rates on every step.
+    - destinations: list with the destinations of the origin-destination matrix.
+    - od_weights: list with the cumulative weights of the destinations for every spawn, None to draw every destination with the same probability.
+    - max_queue: most cars waiting on the queue of a spawn, cars arriving on a full queue are dropped.
+    - queues: list with a deque per spawn with the step every waiting car arrived.
+    - queued: number of cars waiting on every queue.
+    - rng: NumPy generator of the poisson arrivals, None on the interval mode so the demand only draws from the model's generator as it always did.
+    '''
+    def __init__(self, model, config: dict | None = None):
+        settings = config or {}
+        unknown = set(settings) - {"mode", "interval", "spawns", "rate", "profile", "destinations", "od", "max_queue"}
+        if unknown:
+            raise ValueError(f"Unknown demand settings: {', '.join(sorted(unknown))}")
+        self.model = model
+        self.config = config
+        self.mode = settings.get("mode", "interval")
+        if self.mode not in DEMAND_MODES:
+            raise ValueError(f"Unknown demand mode '{self.mode}', expected 'interval' or 'poisson'")
+        self.interval = int(settings.get("interval", model.place_cars_interval))
+        if self.interval < 1:
+            raise ValueError("The demand interval must be at least 1")
+
+        # Spawn cells, as [x, y] or {"cell": [x, y], "rate": cars per step}, the corners by default
+        spawns = settings["spawns"] if "spawns" in settings else [(0, 0), (0, model.height - 1), (model.width - 1, 0), (model.width - 1, model.height - 1)]
+        default_rate = float(settings.get("rate", 1.0))
+        self.spawns, rates = [], []
+        destination_cells = set(model.grid_info["destinations"])
+        for spawn in spawns:
+            cell, rate = (spawn["cell"], spawn.get("rate", default_rate)) if isinstance(spawn, dict) else (spawn, default_rate)
+            cell = tuple(int(value) for value in cell)
+            if "spawns" in settings and (cell not in model.street_graph or cell in destination_cells): # The corners were always used, whatever is on them
+                raise ValueError(f"Spawn cell {cell} is not a street cell of the map")
+            if cell in self.spawns:
+                raise ValueError(f"Spawn cell {cell} is repeated")
+            self.spawns.append(cell)
+            rates.append(float(rate))
+        if not self.spawns:
+            raise ValueError("The demand needs at least one spawn cell")
+        self.rates = np.array(rates, dtype=np.float64)
+        if np.any(self.rates < 0):
+            raise ValueError("Spawn rates can't be negative")
+        self.profile = DemandProfile.from_config(settings.get("profile"))
+
+        # Origin-destination matrix, a row per spawn with a weight per destination
+        self.destinations = [tuple(int(value) for value in cell) for cell in settings.get("destinations", [])]
+        if any(cell not in destination_cells for cell in self.destinations):
+            raise ValueError("Every destination of the origin-destination matrix must be a destination of the map")
+        if not self.destinations:
+            # grid_info has every destination twice, the uniform draw keeps using it so the runs don't change, and the matrix has a column per destination
+            self.destinations = list(dict.fromkeys(model.grid_info["destinations"])) if "od" in settings else model.grid_info["destinations"]
+        self.od_weights = None
+        if "od" in settings:
+            od = np.array(settings["od"], dtype=np.float64)
+            if od.shape != (len(self.spawns), len(self.destinations)):
+                raise ValueError(f"The origin-destination matrix must have a row per spawn and a column per destination ({len(self.spawns)}x{len(self.destinations)})")
+            if np.any(od < 0) or np.any(od.sum(axis=1) <= 0):
+                raise ValueError("The origin-destination weights can't be negative and every spawn needs a destination")
+            self.od_weights = np.cumsum(od, axis=1).tolist()
+
+        self.max_queue = int(settings.get("max_queue", 0 if self.mode == "interval" else 1000)) # Without a queue, the interval mode skips the blocked corners like the model always did
+        if self.max_queue < 0:
+            raise ValueError("max_queue can't be negative")
+        self.queues = [deque() for _ in self.spawns]
+        self.queued = 0
+        self.rng = np.random.default_rng(model.random.getrandbits(64)) if self.mode == "poisson" else None
+
+
+    def fork(self, model) -> "DemandModel":
+        '''Returns a demand for a forked model with a copy of the queues and of the random generator.'''
+        demand = copy.copy(self)
+        demand.model = model
+        demand.queues = [deque(queue) for queue in self.queues]
+        demand.rng = copy.deepcopy(self.rng)
+        return demand
+
+
+    def arrivals(self, step: int) -> np.ndarray:
+        '''Returns the number of cars arriving on every spawn on the step.'''
+        if self.mode == "interval":
+            return np.full(len(self.spawns), 1 if step % self.interval == 0 else 0)
+        return self.rng.poisson(self.rates * max(self.profile.multiplier(step), 0.0))
+
+
+    def step(self, step: int) -> tuple[list[tuple[int, int]], list[tuple[int, int]]]:
+        '''
+        Adds the cars arriving on the step to their queues and returns the positions and destinations of the cars entering the map, the first car of every queue whose spawn cell is free.
+        The waits of the cars that enter and the cars dropped from full queues are recorded on the metrics of the model.
+        '''
+        arrivals = self.arrivals(step)
+        for index in np.flatnonzero(arrivals).tolist():
+            self.queues[index].extend([step] * int(arrivals[index]))
+        self.queued += int(arrivals.sum())
+
+        positions, destinations, waits = [], [], []
+        random, has_car = self.model.random, self.model.occupancy.has_car
+        dropped = 0
+        for index, queue in enumerate(self.queues):
+            if not queue:
+                continue
+            pos = self.spawns[index]
+            if not has_car(pos):
+                waits.append(step - queue.popleft())
+                positions.append(pos)
+                if self.od_weights is None:
+                    destinations.append(random.choice(self.destinations))
+                else:
+                    destinations.append(random.choices(self.destinations, cum_weights=self.od_weights[index])[0])
+            while len(queue) > self.max_queue: # The newest cars are dropped
+                queue.pop()
+                dropped += 1
+        self.queued -= len(positions) + dropped
+
+        metrics = self.model.metrics
+        metrics.step_dropped += dropped
+        metrics.record_entries(np.array(waits, dtype=np.int64))
+        return positions, destinations
+
+
+    def queue_steps(self) -> tuple[np.ndarray, np.ndarray]:
+        '''Returns the length of every queue and the arrival steps of every waiting car, queue after queue, to save them on a checkpoint.'''
+        lengths = np.array([len(queue) for queue in self.queues], dtype=np.int64)
+        steps = np.array([step for queue in self.queues for step in queue], dtype=np.int64)
+        return lengths, steps
+
+
+    def set_queue_steps(self, lengths: np.ndarray, steps: np.ndarray):
+        offsets = np.concatenate([[0], np.cumsum(lengths)]).tolist()
+        self.queues = [deque(steps[start:end].tolist()) for start, end in zip(offsets, offsets[1:])]
+        self.queued = int(lengths.sum())
+
+
+def demand_file(map_file: str) -> str:
+    '''Returns the demand file declared for a map, the map file with the .demand.json extension (e.g. map_files/2024_base.demand.json).'''
+    return os.path.splitext(map_file)[0] + ".demand.json"
+
+def load_demand(demand: dict | str | None, map_file: str) -> dict | None:
+    '''
+    Returns the demand config to create a DemandModel with: the given dictionary, the contents of the given JSON file, or without either the demand file of the map if it has one.
+    None means the default demand of the model. Only the demand file next to the map is loaded on its own, the sample configs of map_files/demand (like 2024_rush_hour.json) must be passed explicitly.
+    '''
+    if demand is None:
+        path = demand_file(map_file)
+        if not os.path.exists(path):
+            return None
+        demand = path
+    if isinstance(demand, str):
+        with open(demand) as file:
+            demand = json.load(file)
+    if not isinstance(demand, dict):
+        raise ValueError("The demand must be a dictionary")
+    return demand
@@ -0,0 +1,175 @@
+# Marcos Dayan Mann A01782876
+# José Manuel García Zumaya A01784238
+# 20 noviembre 2024
+
+import heapq
+
+class EventKernel:
+    '''
+    Event-driven scheduler of the Car agents, used instead of the model's RandomActivation by the "events" engine.
+    The awake cars of a step are kept in a list that is shuffled at the start of the step, like RandomActivation shuffles every agent, so a step costs as much as the cars that are awake on it.
+    A car whose step changed nothing sleeps until what stopped it changes: cars waiting for a red or yellow light sleep until that light changes color, and cars blocked by other cars sleep until one of the cells they could move to is freed or one of the lights around them changes.
+    The signal controller reports the lights that change color on every step, and the model reports the cells it frees, so the cost of a step grows with the cars that move instead of with every car on the grid.
+    A car woken during a step draws a random place among the cars of the step: if its turn hasn't passed yet it runs on the same step, as it would have with RandomActivation, from a heap of wake-ups ordered by that place, and on the next step otherwise.
+    Attributes:
+    - model: model the cars belong to.
+    - awake: list with the ids of the cars that run on the next step (or on the step being prepared, e.g. the cars placed on it).
+    - order: shuffled list with the ids of the cars that run on the current step, None between the steps.
+    - wakeups: heap of (place, car id) with the cars woken during the current step that run on it, a place between i and i + 1 runs them after the i-th car of the order.
+    - place: place of the car being run on the current step.
+    - sleeping: dictionary with the step every sleeping car last ran, the cells and lights it waits for and whether it waits for a light, by car id.
+    - cell_waiters: dictionary with the ids of the cars waiting for every cell to be freed, kept as dictionaries so they wake in the order they fell asleep.
+    - light_waiters: dictionary with the ids of the cars waiting for every light to change, by light id.
+    - light_sleepers: number of sleeping cars waiting for a light, each of them counts as waiting on every step.
+    - ran: number of cars run on the last step.
+    '''
+    def __init__(self, model):
+        self.model = model
+        self.awake = []
+        self.order = None
+        self.wakeups = []
+        self.place = 0.0
+        self.sleeping = {}
+        self.cell_waiters = {}
+        self.light_waiters = {}
+        self.light_sleepers = 0
+        self.ran = 0
+
+
+    def fork(self, model) -> "EventKernel":
+        '''Returns a kernel for a forked model with a copy of the awake and of the sleeping cars.'''
+        kernel = EventKernel(model)
+        kernel.awake = list(self.awake)
+        kernel.sleeping = dict(self.sleeping)
+        kernel.cell_waiters = {cell: dict(waiters) for cell, waiters in self.cell_waiters.items()}
+        kernel.light_waiters = {light_id: dict(waiters) for light_id, waiters in self.light_waiters.items()}
+        kernel.light_sleepers = self.light_sleepers
+        kernel.ran = self.ran
+        return kernel
+
+
+    def state(self) -> dict:
+        '''Returns the awake and the sleeping cars as lists, to save them on a checkpoint.'''
+        return {
+            "awake": list(self.awake),
+            "sleeping": [[car_id, last_step, [list(cell) for cell in cells], lights, waiting_for_light] for car_id, (last_step, cells, lights, waiting_for_light) in self.sleeping.items()],
+            "cell_waiters": [[list(cell), list(waiters)] for cell, waiters in self.cell_waiters.items()],
+            "light_waiters": [[light_id, list(waiters)] for light_id, waiters in self.light_waiters.items()],
+            "light_sleepers": self.light_sleepers,
+        }
+
+
+    def set_state(self, state: dict):
+        self.awake = list(state["awake"])
+        self.sleeping = {car_id: (last_step, tuple(tuple(cell) for cell in cells), lights, waiting_for_light) for car_id, last_step, cells, lights, waiting_for_light in state["sleeping"]}
+        self.cell_waiters = {tuple(cell): dict.fromkeys(waiters) for cell, waiters in state["cell_waiters"]}
+        self.light_waiters = {light_id: dict.fromkeys(waiters) for light_id, waiters in state["light_waiters"]}
+        self.light_sleepers = state["light_sleepers"]
+
+
+    def add(self, car):
+        '''Schedules a car placed on the grid, it runs on the step being prepared.'''
+        self.awake.append(car.unique_id)
+
+
+    def step(self):
+        '''Runs the cars that are awake on the step in a random order, after waking the ones waiting for the lights that changed color.'''
+        model = self.model
+        now = model.schedule.steps
+        light_waiters = self.light_waiters
+        for light_id in model.signals.changed.tolist():
+            waiters = light_waiters.get(light_id)
+            if waiters:
+                for car_id in list(waiters):
+                    self.wake(car_id, now)
+        model.metrics.step_waiting_at_lights += self.light_sleepers
+
+        order, self.awake = self.awake, []
+        model.random.shuffle(order)
+        self.order, self.wakeups = order, []
+        wakeups, awake, cars = self.wakeups, self.awake, model.cars
+        index = woken = 0
+        while index < len(order) or wakeups:
+            if wakeups and (index == len(order) or wakeups[0][0] < index): # Cars woken during the step whose place comes before the next car of the order
+                self.place, car_id = heapq.heappop(wakeups)
+                woken += 1
+            else:
+                self.place, car_id = index, order[index]
+                index += 1
+            car = cars[car_id]
+            pos, status, route, light_wait_steps = car.pos, car.status, car.route, car.light_wait_steps
+            car.step()
+            if car.status in ("arrived", "undeliverable"): # Out of the grid
+                continue
+            if pos == car.pos and status == car.status and route is car.route: # Every move changes the position, and every change of plan the status or the route
+                self.sleep(car, now, car.light_wait_steps != light_wait_steps)
+            else:
+                awake.append(car_id)
+        self.ran = len(order) + woken
+        self.order = None
+
+        model.schedule.steps += 1
+        model.schedule.time += 1
+
+
+    def sleep(self, car, now: int, waiting_for_light: bool):
+        '''
+        Puts to sleep a car whose step changed nothing. A car waiting for a light only looks at the light of its next cell,
+        and a blocked car looks at the cells it could move to and at the lights on them and on its own cell, since nothing else can change what it does.
+        '''
+        occupancy = self.model.occupancy
+        next_cell = car.route.cells[car.route_index]
+        if waiting_for_light:
+            cells, lights = (), [occupancy.get_traffic_light(next_cell).light_id]
+        else:
+            cells = tuple(car.blocking_cells(next_cell))
+            lights = []
+            for cell in (car.pos, *cells):
+                light = occupancy.get_traffic_light(cell)
+                if light is not None and light.light_id not in lights:
+                    lights.append(light.light_id)
+
+        car_id = car.unique_id
+        self.sleeping[car_id] = (now, cells, lights, waiting_for_light)
+        for cell in cells:
+            self.cell_waiters.setdefault(cell, {})[car_id] = None
+        for light_id in lights:
+            self.light_waiters.setdefault(light_id, {})[car_id] = None
+        if waiting_for_light:
+            self.light_sleepers += 1
+
+
+    def wake(self, car_id: int, now: int):
+        '''Schedules a sleeping car, on this step if it didn't run on it and its place comes after the car being run, and on the next step otherwise.'''
+        last_step, cells, lights, waiting_for_light = self.sleeping.pop(car_id)
+        for cell in cells:
+            waiters = self.cell_waiters[cell]
+            del waiters[car_id]
+            if not waiters:
+                del self.cell_waiters[cell]
+        for light_id in lights:
+            waiters = self.light_waiters[light_id]
+            del waiters[car_id]
+            if not waiters:
+                del self.light_waiters[light_id]
+
+        step = now
+        if self.order is None: # Before the cars of the step run, it is shuffled with them
+            self.awake.append(car_id)
+        elif last_step != now and (place := self.model.random.random() * len(self.order)) > self.place:
+            heapq.heappush(self.wakeups, (place, car_id))
+        else:
+            step = now + 1
+            self.awake.append(car_id)
+        if waiting_for_light: # Counting the steps it slept as steps waited, the model counted them on every step
+            self.light_sleepers -= 1
+            self.model.cars[car_id].light_wait_steps += step - last_step - 1
+
+
+    def freed(self, pos: tuple[int, int]):
+        '''Wakes the cars waiting for a cell the model just left without cars.'''
+        waiters = self.cell_waiters.get(pos)
+        if waiters and not self.model.occupancy.cars[pos]:
+            now = self.model.schedule.steps
+            for car_id in list(waiters):
+                self.wake(car_id, now)
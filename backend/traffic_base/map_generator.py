@@ -0,0 +1,128 @@
+# Marcos Dayan Mann A01782876
+# José Manuel García Zumaya A01784238
+# 20 noviembre 2024
+# Procedural map generator. Writes city maps of any size with the same symbols as the hand drawn maps, so routing, the grid and the server can be tested at scale.
+# Run from the backend folder, for example:
+# python -m traffic_base.map_generator --width 1000 --height 1000 --seed 7 --output map_files/generated_1000.txt
+
+import argparse
+import numpy as np
+
+# Seed streams, so the rows and the lights of a map use independent random numbers
+ROW_STREAM = 0
+LIGHT_STREAM = 1
+
+def street_bands(length: int, block_size: int, lanes: int) -> tuple[np.ndarray, np.ndarray]:
+    '''
+    Splits an axis of the map in streets of lanes cells and blocks of block_size cells, starting and ending with a street.
+    Returns the first cell of every street and the street of every cell (-1 on blocks), the last block takes the cells that are left over.
+    '''
+    period = lanes + block_size
+    blocks = (length - lanes) // period
+    starts = np.arange(blocks + 1, dtype=np.int64) * period
+    starts[-1] = length - lanes # The last street is always on the edge of the map
+    band = np.full(length, -1, dtype=np.int32)
+    for index, start in enumerate(starts.tolist()):
+        band[start:start + lanes] = index
+    return starts, band
+
+def band_symbols(count: int, first: str, interior: tuple[str, str], last: str) -> list[str]:
+    '''Returns the direction of every street of an axis: the streets on the edges go around the map and the ones inside alternate.'''
+    return [first if index == 0 else last if index == count - 1 else interior[index % 2] for index in range(count)]
+
+def light_plan(seed: int, horizontal_band: int, vertical_bands: int, light_density: float) -> np.ndarray:
+    '''Returns which intersections of a horizontal street have traffic lights, the same every time it is asked for.'''
+    rng = np.random.default_rng([seed, LIGHT_STREAM, horizontal_band])
+    return rng.random(vertical_bands) < light_density
+
+def generate_rows(width: int, height: int, block_size: int = 4, lanes: int = 2, light_density: float = 0.5, destination_density: float = 0.1, seed: int = 0):
+    '''
+    Yields the rows of a map from top to bottom, without keeping the whole grid in memory.
+    The map is a grid of one way streets of lanes cells around blocks of block_size cells: the streets on the edges go around the map and the ones inside alternate their direction.
+    On each intersection there are traffic lights with probability light_density, "S" on the vertical street and "s" on the horizontal one so they alternate.
+    Every block cell next to a street is a destination with probability destination_density, the first cell of the first block always is so every map has one. The rest of the cells are obstacles.
+    Every row and every intersection takes its random numbers from the seed and its own index, so the same parameters always give the same map.
+    '''
+    if lanes < 2:
+        raise ValueError("Streets need at least 2 lanes, since routes can't go through the corners of the map")
+    if block_size < 1:
+        raise ValueError("The block size must be positive")
+    if width < 2 * lanes + block_size or height < 2 * lanes + block_size:
+        raise ValueError(f"The map must be at least {2 * lanes + block_size} cells wide and high to fit a block")
+    if not 0 <= light_density <= 1 or not 0 <= destination_density <= 1:
+        raise ValueError("The light and destination densities must be between 0 and 1")
+
+    column_starts, column_band = street_bands(width, block_size, lanes)
+    row_starts, row_band = street_bands(height, block_size, lanes)
+    vertical = band_symbols(len(column_starts), "v", ("v", "^"), "^") # Going down on the left edge and up on the right one
+    horizontal = band_symbols(len(row_starts), "<", ("<", ">"), ">") # Going left on the top edge and right on the bottom one
+
+    # Block rows: the vertical streets with their direction and obstacles on the blocks
+    is_street_column = column_band >= 0
+    block_row = np.full(width, ord("#"), dtype=np.uint8)
+    block_row[is_street_column] = np.array([ord(vertical[band]) for band in column_band[is_street_column].tolist()], dtype=np.uint8)
+    next_to_street_column = ~is_street_column & (np.roll(is_street_column, 1) | np.roll(is_street_column, -1))
+    vertical_columns = [np.arange(start, start + lanes) for start in column_starts.tolist()]
+
+    def approach_column(band: int, symbol: str) -> int:
+        '''Column before the intersection of a horizontal street with the given vertical street, following the direction of the horizontal street.'''
+        return int(column_starts[band]) + lanes if symbol == "<" else int(column_starts[band]) - 1
+
+    light_plans = {} # Lights of the horizontal streets next to the current row, at most two are kept
+    def lights_of(band: int) -> np.ndarray:
+        if band not in light_plans:
+            if len(light_plans) > 1:
+                light_plans.pop(min(light_plans))
+            light_plans[band] = light_plan(seed, band, len(column_starts), light_density)
+        return light_plans[band]
+
+    for y in range(height):
+        band = int(row_band[y])
+        if band >= 0: # Horizontal street, the intersections keep its direction
+            symbol = horizontal[band]
+            row = np.full(width, ord(symbol), dtype=np.uint8)
+            for vertical_band, has_lights in enumerate(lights_of(band).tolist()):
+                x = approach_column(vertical_band, symbol)
+                if has_lights and 0 <= x < width and not is_street_column[x]:
+                    row[x] = ord("s")
+        else: # Block row, crossed by the vertical streets
+            row = block_row.copy()
+            rng = np.random.default_rng([seed, ROW_STREAM, y])
+            next_to_street = next_to_street_column | (row_band[y - 1] >= 0) | (row_band[y + 1] >= 0) # Block rows are never on the edges
+            destinations = next_to_street & ~is_street_column & (rng.random(width) < destination_density)
+            row[destinations] = ord("D")
+
+            # The vertical streets going down have their lights on the row before the next horizontal street, and the ones going up on the row after the previous one
+            for horizontal_band, direction in ((int(row_band[y + 1]), "v"), (int(row_band[y - 1]), "^")):
+                if horizontal_band < 0:
+                    continue
+                for vertical_band, has_lights in enumerate(lights_of(horizontal_band).tolist()):
+                    if has_lights and vertical[vertical_band] == direction:
+                        row[vertical_columns[vertical_band]] = ord("S")
+        if y == lanes: # First cell of the first block
+            row[lanes] = ord("D")
+        yield row.tobytes().decode("ascii")
+
+def write_map(path: str, width: int, height: int, **parameters):
+    '''Writes a generated map to the file one row at a time, the parameters are the ones of generate_rows.'''
+    with open(path, 'w', encoding='utf-8') as file:
+        for row in generate_rows(width, height, **parameters):
+            file.write(row + '\n')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Generates a city map with the symbols of the map files")
+    parser.add_argument("--width", type=int, required=True)
+    parser.add_argument("--height", type=int, required=True)
+    parser.add_argument("--block-size", type=int, default=4, help="Cells of every block between streets")
+    parser.add_argument("--lanes", type=int, default=2, help="Lanes of every street")
+    parser.add_argument("--light-density", type=float, default=0.5, help="Fraction of intersections with traffic lights")
+    parser.add_argument("--destination-density", type=float, default=0.1, help="Fraction of the block cells next to a street that are destinations")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", required=True)
+    args = parser.parse_args()
+
+    try:
+        write_map(args.output, args.width, args.height, block_size=args.block_size, lanes=args.lanes, light_density=args.light_density, destination_density=args.destination_density, seed=args.seed)
+    except ValueError as error:
+        parser.error(str(error))
+    print(f"Saved a {args.width}x{args.height} map to {args.output}")
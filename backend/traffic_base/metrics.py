@@ -0,0 +1,257 @@
+# Marcos Dayan Mann A01782876
+# José Manuel García Zumaya A01784238
+# 20 noviembre 2024
+
+from bisect import bisect_left
+import io
+import numpy as np
+
+# Fields recorded on every step, kept on a ring buffer
+STEP_FIELDS = [
+    ("step", np.int64),
+    ("spawned", np.int32), # cars placed on the step
+    ("arrived", np.int32), # cars that reached their destination on the step
+    ("cars", np.int32), # cars on the grid at the end of the step
+    ("reroutes", np.int32), # routes changed to avoid traffic on the step
+    ("waiting_at_lights", np.int32), # cars that waited for a red or yellow light on the step
+    ("queued_at_lights", np.int32), # cars on the queues of every light at the beginning of the step
+    ("queued_at_spawns", np.int32), # cars waiting to enter the map at the end of the step
+    ("dropped", np.int32), # cars that couldn't enter the map on the step because the queue of their spawn was full
+    ("undeliverable", np.int32), # cars removed from the map on the step because there is no route to their destination
+]
+
+# Upper bounds of the histogram buckets, every histogram also has a last bucket for bigger values
+TRIP_STEPS_BUCKETS = [10, 20, 30, 40, 50, 60, 80, 100, 150, 200, 300, 500]
+LIGHT_WAIT_BUCKETS = [0, 1, 2, 5, 10, 20, 30, 50, 100]
+REROUTE_BUCKETS = [0, 1, 2, 3, 5, 10, 20]
+QUEUE_BUCKETS = [0, 1, 2, 3, 5, 8, 13]
+ENTRY_WAIT_BUCKETS = [0, 1, 2, 5, 10, 20, 50, 100, 200]
+
+class Histogram:
+    '''
+    Histogram with fixed buckets, values are counted on the first bucket whose upper bound is greater or equal to them.
+    Attributes:
+    - bounds: list with the upper bound of each bucket, the last bucket has no bound.
+    - counts: int64 array with the number of values on each bucket.
+    - total: sum of every value counted.
+    '''
+    def __init__(self, bounds: list[float]):
+        self.bounds = bounds
+        self.bounds_array = np.array(bounds, dtype=np.float64)
+        self.counts = np.zeros(len(bounds) + 1, dtype=np.int64)
+        self.total = 0.0
+
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.total += value
+
+
+    def observe_many(self, values: np.ndarray):
+        if len(values) == 0:
+            return
+        self.counts += np.bincount(np.searchsorted(self.bounds_array, values, side="left"), minlength=len(self.counts))
+        self.total += float(values.sum())
+
+
+    def count(self) -> int:
+        return int(self.counts.sum())
+
+
+class MetricsCollector:
+    '''
+    Metrics collector. Records counters for every step on a preallocated ring buffer and keeps histograms of the trips, so the model doesn't need to print its metrics to follow them.
+    The metrics are exported on demand, as Prometheus text or as NumPy arrays.
+    Attributes:
+    - capacity: number of steps kept on the ring buffer, older steps are overwritten.
+    - steps: structured array used as ring buffer, with a row per step and the fields of STEP_FIELDS.
+    - recorded: number of steps recorded since the model was created.
+    - current_step: number of the step being recorded, used to measure the trips.
+    - trip_steps: histogram of the steps every car took from being placed to reaching its destination.
+    - light_wait_steps: histogram of the steps every car waited for traffic lights during its trip.
+    - reroutes: histogram of the number of times every car changed its route during its trip.
+    - queue_length: histogram of the queue length of every light on every step.
+    - entry_wait_steps: histogram of the steps every car waited on the queue of its spawn before entering the map.
+    - light_ids: list of the unique id of every traffic light.
+    - light_queue_sum: int64 array with the sum of the queue length of every light over every step.
+    - last_spawn_queue: cars waiting on the spawn queues at the end of the last step.
+    - totals: dictionary with the counters since the model was created (spawned, arrived, reroutes, waiting_at_lights, dropped, undeliverable).
+    '''
+    def __init__(self, light_ids: list[str], capacity: int = 4096):
+        self.capacity = capacity
+        self.steps = np.zeros(capacity, dtype=STEP_FIELDS)
+        self.recorded = 0
+        self.current_step = 0
+        self.trip_steps = Histogram(TRIP_STEPS_BUCKETS)
+        self.light_wait_steps = Histogram(LIGHT_WAIT_BUCKETS)
+        self.reroutes = Histogram(REROUTE_BUCKETS)
+        self.queue_length = Histogram(QUEUE_BUCKETS)
+        self.entry_wait_steps = Histogram(ENTRY_WAIT_BUCKETS)
+        self.light_ids = light_ids
+        self.light_queue_sum = np.zeros(len(light_ids), dtype=np.int64)
+        self.last_queue_length = np.zeros(len(light_ids), dtype=np.int32)
+        self.last_spawn_queue = 0
+        self.totals = {"spawned": 0, "arrived": 0, "reroutes": 0, "waiting_at_lights": 0, "dropped": 0, "undeliverable": 0}
+        self.reset_step()
+
+
+    def reset_step(self):
+        # Counters of the step being recorded, they are plain attributes so the agents can increase them cheaply
+        self.step_spawned = 0
+        self.step_arrived = 0
+        self.step_reroutes = 0
+        self.step_waiting_at_lights = 0
+        self.step_dropped = 0
+        self.step_undeliverable = 0
+
+
+    # Recording, called by the model, the engines and the agents
+
+    def begin_step(self, step: int):
+        self.current_step = step
+        self.reset_step()
+
+
+    def record_queues(self, queue_length: np.ndarray):
+        '''Records the queue length of every light, calculated by the signal controller at the beginning of the step.'''
+        self.last_queue_length = queue_length
+        self.light_queue_sum += queue_length
+        self.queue_length.observe_many(queue_length)
+
+
+    def record_entries(self, wait_steps: np.ndarray):
+        '''Records the steps waited on the spawn queues by the cars that entered the map on the step.'''
+        self.entry_wait_steps.observe_many(wait_steps)
+
+
+    def record_arrival(self, spawn_step: int, light_wait_steps: int, reroutes: int):
+        '''Records a car that reached its destination.'''
+        self.step_arrived += 1
+        self.trip_steps.observe(self.current_step - spawn_step)
+        self.light_wait_steps.observe(light_wait_steps)
+        self.reroutes.observe(reroutes)
+
+
+    def record_arrivals(self, spawn_steps: np.ndarray, light_wait_steps: np.ndarray, reroutes: np.ndarray):
+        '''Records several cars that reached their destination, used by the vectorized engine.'''
+        self.step_arrived += len(spawn_steps)
+        self.trip_steps.observe_many(self.current_step - spawn_steps)
+        self.light_wait_steps.observe_many(light_wait_steps)
+        self.reroutes.observe_many(reroutes)
+
+
+    def end_step(self, cars: int, queued_at_spawns: int = 0):
+        '''Saves the counters of the step on the ring buffer.'''
+        self.last_spawn_queue = queued_at_spawns
+        row = self.steps[self.recorded % self.capacity]
+        row["step"] = self.current_step
+        row["spawned"] = self.step_spawned
+        row["arrived"] = self.step_arrived
+        row["cars"] = cars
+        row["reroutes"] = self.step_reroutes
+        row["waiting_at_lights"] = self.step_waiting_at_lights
+        row["queued_at_lights"] = int(self.last_queue_length.sum())
+        row["queued_at_spawns"] = queued_at_spawns
+        row["dropped"] = self.step_dropped
+        row["undeliverable"] = self.step_undeliverable
+        self.recorded += 1
+
+        self.totals["spawned"] += self.step_spawned
+        self.totals["arrived"] += self.step_arrived
+        self.totals["reroutes"] += self.step_reroutes
+        self.totals["waiting_at_lights"] += self.step_waiting_at_lights
+        self.totals["dropped"] += self.step_dropped
+        self.totals["undeliverable"] += self.step_undeliverable
+
+
+    def average_trip_steps(self) -> float:
+        '''Returns the average steps the cars that arrived took to reach their destination.'''
+        count = self.trip_steps.count()
+        return self.trip_steps.total / count if count else 0.0
+
+
+    # Exports
+
+    def step_series(self) -> np.ndarray:
+        '''Returns the rows of the ring buffer from the oldest to the newest step.'''
+        if self.recorded <= self.capacity:
+            return self.steps[:self.recorded].copy()
+        start = self.recorded % self.capacity
+        return np.concatenate([self.steps[start:], self.steps[:start]])
+
+
+    def arrays(self) -> dict[str, np.ndarray]:
+        '''Returns every metric as NumPy arrays: one column per step field, the bucket bounds and counts of every histogram and the queue sums per light.'''
+        series = self.step_series()
+        arrays = {name: series[name] for name, _ in STEP_FIELDS}
+        for name, histogram in self.histograms().items():
+            arrays[f"{name}_bounds"] = histogram.bounds_array
+            arrays[f"{name}_counts"] = histogram.counts.copy()
+        arrays["light_ids"] = np.array(self.light_ids)
+        arrays["light_queue_sum"] = self.light_queue_sum.copy()
+        return arrays
+
+
+    def npz(self) -> bytes:
+        '''Returns the arrays of the metrics saved as an .npz file.'''
+        buffer = io.BytesIO()
+        np.savez(buffer, **self.arrays())
+        return buffer.getvalue()
+
+
+    def to_arrow(self):
+        '''Returns the step series as a pyarrow Table, pyarrow must be installed.'''
+        import pyarrow as pa # Optional dependency, only needed for this export
+        series = self.step_series()
+        return pa.table({name: series[name] for name, _ in STEP_FIELDS})
+
+
+    def histograms(self) -> dict[str, Histogram]:
+        return {
+            "trip_steps": self.trip_steps,
+            "light_wait_steps": self.light_wait_steps,
+            "reroutes_per_trip": self.reroutes,
+            "light_queue_length": self.queue_length,
+            "entry_wait_steps": self.entry_wait_steps,
+        }
+
+
+    def prometheus(self, prefix: str = "traffic_") -> str:
+        '''Returns the metrics in the Prometheus text exposition format.'''
+        lines = []
+        def metric(name: str, kind: str, help_text: str, samples: list[tuple[str, float]]):
+            lines.append(f"# HELP {prefix}{name} {help_text}")
+            lines.append(f"# TYPE {prefix}{name} {kind}")
+            for labels, value in samples:
+                lines.append(f"{prefix}{name}{labels} {value}")
+
+        last = self.steps[(self.recorded - 1) % self.capacity] if self.recorded else None
+        metric("step", "gauge", "Last step of the simulation.", [("", int(last["step"]) if last is not None else 0)])
+        metric("cars", "gauge", "Cars on the grid.", [("", int(last["cars"]) if last is not None else 0)])
+        metric("cars_spawned_total", "counter", "Cars placed on the grid.", [("", self.totals["spawned"])])
+        metric("cars_arrived_total", "counter", "Cars that reached their destination.", [("", self.totals["arrived"])])
+        metric("reroutes_total", "counter", "Routes changed to avoid traffic.", [("", self.totals["reroutes"])])
+        metric("light_waits_total", "counter", "Steps cars spent waiting for red or yellow lights.", [("", self.totals["waiting_at_lights"])])
+        metric("cars_dropped_total", "counter", "Cars that couldn't enter the map because the queue of their spawn was full.", [("", self.totals["dropped"])])
+        metric("cars_undeliverable_total", "counter", "Cars removed from the map because there is no route to their destination.", [("", self.totals["undeliverable"])])
+        metric("spawn_queue", "gauge", "Cars waiting to enter the map.", [("", self.last_spawn_queue)])
+        metric("light_queue", "gauge", "Cars waiting before each traffic light.", [(f'{{light="{light_id}"}}', int(length)) for light_id, length in zip(self.light_ids, self.last_queue_length.tolist())])
+
+        help_texts = {
+            "trip_steps": "Steps from being placed to reaching the destination.",
+            "light_wait_steps": "Steps waited for traffic lights during a trip.",
+            "reroutes_per_trip": "Route changes during a trip.",
+            "light_queue_length": "Queue length of every light on every step.",
+            "entry_wait_steps": "Steps waited on the spawn queue before entering the map.",
+        }
+        for name, histogram in self.histograms().items():
+            cumulative = np.cumsum(histogram.counts).tolist()
+            samples = [(f'_bucket{{le="{bound}"}}', count) for bound, count in zip(histogram.bounds, cumulative)]
+            samples.append(('_bucket{le="+Inf"}', cumulative[-1]))
+            lines.append(f"# HELP {prefix}{name} {help_texts[name]}")
+            lines.append(f"# TYPE {prefix}{name} histogram")
+            for suffix, value in samples:
+                lines.append(f"{prefix}{name}{suffix} {value}")
+            lines.append(f"{prefix}{name}_sum {histogram.total}")
+            lines.append(f"{prefix}{name}_count {cumulative[-1]}")
+        return "\n".join(lines) + "\n"
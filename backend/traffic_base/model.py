@@ -5,53 +5,240 @@
 from mesa import Model
 from mesa.time import RandomActivation
 from mesa.space import MultiGrid
-from traffic_base.read_map import build_graph
+from traffic_base.read_map import load_map
 # from read_map import build_graph
+from traffic_base.routing import RoutingTable, CongestionRouter, RouteCache
+from traffic_base.occupancy import OccupancyIndex, ROAD_DIRECTIONS
+from traffic_base.vector_engine import VectorizedEngine
+from traffic_base.partitioned import PartitionedEngine
+from traffic_base.events import EventKernel
+from traffic_base.signals import SignalController
+from traffic_base.snapshot import CarStateBuffer
+from traffic_base.metrics import MetricsCollector
+from traffic_base.demand import DemandModel, load_demand
+from traffic_base.profiler import StepProfiler
 from traffic_base.agent import *
 # from agent import *
+import copy
 import json
+import random
 import requests
+import warnings
+import numpy as np
+
+CAR_POOL_SIZE = 1024 # Most arrived cars kept for reuse, more than the cars that arrive between two placements on the maps we use
 
 class CityModel(Model):
-    def __init__(self, place_cars_interval: int = 2):
-        street_graph, grid, grid_info = build_graph('map_files/2024_base.txt') # Function that reads the map file and returns the street graph which agents will use to navigate, the string grid and some additional information, and the grid_info dictionary which contains the destination coordinates in order to select them for the agents
+    def __init__(self, place_cars_interval: int = 2, router: str = "bfs", engine: str = "agents", map_file: str = 'map_files/2024_base.txt', light_interval: int = 10, signal_mode: str = "fixed", seed: int | None = None, verbose: bool = False, profile: bool = False, tiles: int | None = None, demand: dict | str | None = None):
+        # Runs with the same seed are reproducible. Without one mesa's Model.__new__ seeds self.random with a float, so an integer seed is drawn instead and /init can return it to repeat the run
+        if seed is None:
+            seed = random.SystemRandom().getrandbits(32)
+        self.reset_randomizer(seed) # Seeds self.random like mesa does with a seed passed by keyword, and keeps it in self._seed
+        compiled_map = load_map(map_file) # Street graph which agents will use to navigate, the symbols of the map and its destinations, compiled once per map file and loaded from its cache afterwards
+        street_graph, grid, grid_info = compiled_map.graph, compiled_map.grid(), {"destinations": compiled_map.destination_list()} # grid_info contains the destination coordinates in order to select them for the agents
 
         # street_graph, grid, grid_info = build_graph('../map_files/2024_base.txt') # Function that reads the map file and returns the street graph which agents will use to navigate, the string grid and some additional information, and the grid_info dictionary which contains the destination coordinates in order to select them for the agents
 
+        self.map_file = map_file # Map file and hash of its contents, saved on checkpoints so they are restored on the same map
+        self.map_hash = compiled_map.map_hash
+
         self.width = len(grid[0]) # map dimensions
         self.height = len(grid)
         self.grid = MultiGrid(self.width, self.height, torus=False) # inicializing the grid as a MultiGrid, allowing multiple agents to be on the same cell
         self.schedule = RandomActivation(self) # Random activation scheduler, which shuffles the order of the agents each step and executes its step in one thread
+        self.occupancy = OccupancyIndex(self.width, self.height) # Layers with what is on every cell, so agents don't need to go through the cell contents
+        self.signals = SignalController(signal_mode) # Controller that changes every traffic light at once, "fixed" or "adaptive" to the queues on each intersection
+        self.light_interval = light_interval # Interval for changing the traffic lights
+        self.verbose = verbose # Prints the metrics on every step when True, they can always be read from self.metrics
 
         self.place_cars_interval = place_cars_interval # Interval for placing cars
         self.grid_info = grid_info # contains the destination coordinates
         self.street_graph = street_graph # Graph representing the streets and connections between them
+        self.cars = {} # Cars currently on the grid by their unique ID
+        self.car_pool = [] # Cars that arrived, reused by new_car so long runs don't keep creating and collecting agents
+        self.car_states = CarStateBuffer() # Packed ids, positions and directions of the cars, sent as they are by the binary /getCars
+        self.static_agents = {} # Shared Road, Obstacle and Destination agents by map symbol, the static environment is kept in the occupancy index
+        self.corners = {(0, 0), (0, self.height - 1), (self.width - 1, 0), (self.width - 1, self.height - 1)} # Map corners, where cars are placed and routes can't go through
 
         # Variables that track metrics for the simulation for measuring its performance
         self.total_cars_at_destination = 0 
         self.total_car_number = 0
         self.current_car_number = 0
-        self.average_steps_to_destination = 0
 
         self.id_counter = 0  # Counter for unique IDs
 
-        # Iterating through the grid in order to inicialze the environment, in mesa environment is treated as an agent
-        for y in range(self.height):
-            for x in range(self.width):
-                symbol = grid[y][x]
-                mesa_y = self.height - 1 - y  # Adjust coordinate system to match mesa's, because mesa's y-axis is inverted respect Python matrix indices
-                self.place_env_agent((x, mesa_y), symbol)
+        # Iterating through the grid in order to inicialze the environment, in mesa environment is treated as an agent, but none of them is scheduled
+        with warnings.catch_warnings():
+            warnings.filterwarnings("ignore", message="Agent .* is being placed with", category=UserWarning) # The shared agents are placed on many cells on purpose
+            for y in range(self.height):
+                for x in range(self.width):
+                    symbol = grid[y][x]
+                    mesa_y = self.height - 1 - y  # Adjust coordinate system to match mesa's, because mesa's y-axis is inverted respect Python matrix indices
+                    self.place_env_agent((x, mesa_y), symbol)
+
+        self.signals.build(self.street_graph, self.occupancy) # Grouping the traffic lights by intersection once all of them are placed
+        self.metrics = MetricsCollector([str(light.unique_id) for light in self.occupancy.traffic_lights]) # Per step counters and trip histograms
+
+        # Shortest routes from every street cell to every destination, computed once per map file and cached with the compiled map
+        routing_arrays = compiled_map.load_arrays("routing")
+        self.routing_table = RoutingTable(self.street_graph, self.grid_info["destinations"], self.corners, routing_arrays)
+        if routing_arrays is None:
+            compiled_map.save_arrays("routing", self.routing_table.arrays())
+
+        # Router used by the cars, "bfs" follows the shortest routes of the routing table and "astar" looks for the cheapest routes with the current traffic
+        if router == "bfs":
+            self.router = self.routing_table
+        elif router == "astar":
+            self.router = CongestionRouter(self.occupancy, self.street_graph, self.corners, lambda: self.schedule.steps)
+        else:
+            raise ValueError(f"Unknown router '{router}', expected 'bfs' or 'astar'")
+        self.route_cache = RouteCache(self.router) # Routes shared by the cars, keyed by their start and goal
+
+        # Cars entering the map, from a demand config (a dictionary or a JSON file), the demand file of the map, or one car on every corner every place_cars_interval steps
+        self.demand = DemandModel(self, load_demand(demand, map_file))
+
+        # Engine that moves the cars, "agents" steps one Car agent at a time and "vectorized" moves every car at once with NumPy arrays following the routing table
+        # "partitioned" splits the map in tiles (one per core unless tiles is given) and moves the cars of each tile like "vectorized" on its own worker process, it's experimental and not faster than "vectorized" yet
+        # "events" steps the Car agents like "agents", but only the awake ones, the cars waiting for a light or blocked by another car sleep until they can move
+        self.events = None
+        if engine in ("agents", "events"):
+            self.vector_engine = None
+            if engine == "events":
+                self.events = EventKernel(self)
+        elif engine in ("vectorized", "partitioned"):
+            if router != "bfs":
+                raise ValueError(f"The {engine} engine only supports the 'bfs' router")
+            self.vector_engine = VectorizedEngine(self) if engine == "vectorized" else PartitionedEngine(self, tiles)
+        else:
+            raise ValueError(f"Unknown engine '{engine}', expected 'agents', 'events', 'vectorized' or 'partitioned'")
 
         self.running = True # Flag for the model's running state
+        self.profiler = None # Step profiler, only set while profiling so the model runs without instrumentation otherwise
+        if profile:
+            self.enable_profiling()
 
         # control measure to ensure no IDs are repeated
         all_ids = [agent.unique_id for agent in self.schedule.agents]
         if len(all_ids) != len(set(all_ids)):
             print("Warning: Duplicate IDs detected!")
-        else:
+        elif self.verbose:
             print("All IDs are unique.")
 
 
+    def enable_profiling(self) -> StepProfiler:
+        '''Starts measuring the phases of every step, returns the profiler with the results.'''
+        if self.profiler is None:
+            self.profiler = StepProfiler()
+            self.profiler.attach(self)
+        return self.profiler
+
+    def disable_profiling(self) -> StepProfiler | None:
+        '''Stops measuring the steps and restores the original methods, returns the profiler with the results.'''
+        profiler = self.profiler
+        if profiler is not None:
+            profiler.detach(self)
+            self.profiler = None
+        return profiler
+
+
+    def fork(self, seed: int | None = None) -> "CityModel":
+        '''
+        Returns a copy of the model on its current step, so several what-if branches can run from the same warmed-up state.
+        Only the dynamic state is copied (cars, traffic lights, the car layer, metrics and random generators), the street graph, the static layers and the routing table are shared with this model since they never change.
+        Without a seed the fork continues with the same random numbers as this model and takes the same steps, with a seed its random numbers start from that seed.
+        The grid of the fork only has the cars and the traffic lights, the shared Road, Obstacle and Destination agents are read from the occupancy index instead.
+        '''
+        if isinstance(self.vector_engine, PartitionedEngine):
+            raise ValueError("Models on the partitioned engine can't be forked, their cars are on the worker processes")
+        profiler = self.disable_profiling() # The wrapped methods belong to this model, so they are restored before copying and wrapped again afterwards
+        fork = CityModel.__new__(CityModel, seed=seed)
+        Model.__init__(fork)
+        if seed is None:
+            fork._seed = self._seed
+            fork.random.setstate(self.random.getstate())
+        fork._steps, fork._time = self._steps, self._time
+
+        # Static map, shared
+        fork.map_file, fork.map_hash = self.map_file, self.map_hash
+        fork.width, fork.height = self.width, self.height
+        fork.street_graph = self.street_graph
+        fork.grid_info = self.grid_info
+        fork.static_agents = self.static_agents
+        fork.corners = self.corners
+        fork.place_cars_interval = self.place_cars_interval
+        fork.light_interval = self.light_interval
+        fork.verbose = self.verbose
+
+        # Dynamic state, copied
+        fork.grid = MultiGrid(self.width, self.height, torus=False)
+        fork.occupancy = self.occupancy.fork()
+        fork.signals = self.signals.fork(fork.occupancy)
+        fork.metrics = copy.deepcopy(self.metrics)
+        fork.car_states = self.car_states.copy()
+        fork.total_cars_at_destination = self.total_cars_at_destination
+        fork.total_car_number = self.total_car_number
+        fork.current_car_number = self.current_car_number
+        fork.id_counter = self.id_counter
+        fork.running = self.running
+        fork.profiler = None
+
+        for light in self.occupancy.traffic_lights:
+            fork_light = copy.copy(light)
+            fork_light.model, fork_light.controller = fork, fork.signals
+            fork.register_agent(fork_light)
+            fork.occupancy.traffic_lights.append(fork_light)
+            fork.place_agent_copy(fork_light)
+
+        fork.cars = {}
+        fork.car_pool = [] # Not shared, the cars of the pool belong to this model
+        for car_id, car in self.cars.items():
+            fork_car = copy.copy(car)
+            fork_car.model = fork
+            fork_car.previous_cells_after_change = car.previous_cells_after_change.copy()
+            fork.register_agent(fork_car)
+            fork.place_agent_copy(fork_car)
+            fork.cars[car_id] = fork_car
+        fork.schedule = RandomActivation(fork, [fork.cars[car.unique_id] for car in self.schedule.agents]) # Same activation order, so the shuffles of both models match
+        fork.schedule.steps, fork.schedule.time = self.schedule.steps, self.schedule.time
+
+        fork.routing_table = RoutingTable(self.street_graph, self.grid_info["destinations"], self.corners, self.routing_table.arrays()) # Own object over the same arrays, so profiling a fork doesn't wrap the methods of this model
+        if self.router is self.routing_table:
+            fork.router = fork.routing_table
+        else:
+            fork.router = self.router.fork(fork.occupancy, lambda: fork.schedule.steps)
+        fork.route_cache = self.route_cache.fork(fork.router)
+        fork.demand = self.demand.fork(fork)
+        fork.events = self.events.fork(fork) if self.events is not None else None
+        fork.vector_engine = None
+        if self.vector_engine is not None:
+            fork.vector_engine = self.vector_engine.fork(fork)
+            if seed is not None:
+                fork.vector_engine.rng = np.random.default_rng(fork.random.getrandbits(64))
+        if seed is not None and fork.demand.rng is not None:
+            fork.demand.rng = np.random.default_rng(fork.random.getrandbits(64))
+
+        if profiler is not None:
+            self.profiler = profiler
+            profiler.attach(self)
+        return fork
+
+    def close(self):
+        '''Stops the worker processes of the partitioned engine, the model can still be read but not stepped. It does nothing on the other engines.'''
+        if isinstance(self.vector_engine, PartitionedEngine):
+            self.vector_engine.close()
+
+    def place_agent_copy(self, agent: Agent):
+        '''Places a copied agent on the grid of a fork, on the same position it had on the original model.'''
+        pos, agent.pos = agent.pos, None
+        self.grid.place_agent(agent, pos)
+
+
+    @property
+    def average_steps_to_destination(self) -> float:
+        '''Average steps the cars that arrived took from being placed to reaching their destination.'''
+        return self.metrics.average_trip_steps()
+
+
     def send_stats(self, url: str = "http://10.49.12.55:5000/api/"):
         # endpoint = "validate_attempt"
         endpoint = "attempt"
@@ -76,36 +263,104 @@ class CityModel(Model):
 
     def step(self):
         '''Advance the model by one step.'''
-        if self.schedule.steps % self.place_cars_interval == 0: # Determines the moment to place cars based on the interval defined
-            print("Placing cars")
-            self.place_cars()
+        self.metrics.begin_step(self.schedule.steps)
+        self.route_cache.begin_step()
+        self.place_cars() # The demand model decides how many cars enter on the step
         
         # if self.schedule.steps % 10 == 0:
         #     self.send_stats()
 
-        self.schedule.step()
+        self.signals.step()
+        self.metrics.record_queues(self.signals.queue_length)
+        if self.events is not None: # Only the cars that are awake
+            self.events.step()
+        else:
+            self.schedule.step()
+        if self.vector_engine is not None: # The schedule only has the environment agents when the cars are in the vectorized engine
+            self.vector_engine.step()
+            self.vector_engine.write_states(self.car_states)
+        self.car_states.set_step(self.schedule.steps)
+        self.metrics.end_step(self.current_car_number, self.demand.queued)
 
-        self.terminal_report() # Prints the metrics of the simulation on the terminal
+        if self.verbose:
+            self.terminal_report() # Prints the metrics of the simulation on the terminal
 
     def terminal_report(self):
         '''Prints the metrics of the simulation on the terminal.'''
         print(f"\n\nREPORTING: \nTOTAL_CAR_NUMBER: {self.total_car_number} \nTOTAL_CARS_AT_DESTINATION: {self.total_cars_at_destination} \nCURRENT_CAR_NUMBER: {self.current_car_number} \nAVERAGE_STEPS_TO_DESTINATION: {self.average_steps_to_destination}")
 
     def place_cars(self):
-        print("Placing cars")
-        '''Place cars in each corner of the grid if it is not already taken by another car.'''
-        for pos in [(0, 0), (0, self.height - 1), (self.width - 1, 0), (self.width - 1, self.height - 1)]:
-            cell_contents = self.grid.get_cell_list_contents(pos)
-            is_taken = any(isinstance(agent, Car) for agent in cell_contents)
-            if is_taken:
-                continue
-            car = Car(f"c_{self.id_counter}", self, "calculating_route", self.street_graph, self.grid_info["destinations"])
-            self.id_counter += 1
-            self.grid.place_agent(car, pos)
+        '''Places the cars that enter the map on the step, on the spawn cells of the demand model that are not taken by another car.'''
+        positions, destinations = self.demand.step(self.schedule.steps)
+        if not positions:
+            return
+        if self.verbose:
+            print("Placing cars")
+        car_ids = list(range(self.id_counter, self.id_counter + len(positions)))
+        self.id_counter += len(positions)
+        self.total_car_number += len(positions)
+        self.current_car_number += len(positions)
+        self.metrics.step_spawned += len(positions)
+        if self.vector_engine is not None:
+            self.vector_engine.spawn(car_ids, positions, destinations) # Every car of the step at once
+            return
+        for car_id, pos, destination in zip(car_ids, positions, destinations):
+            car = self.new_car(car_id, "calculating_route", destination)
+            self.place_car(car, pos)
             self.schedule.add(car)
 
-            self.total_car_number += 1
-            self.current_car_number += 1
+    def place_car(self, car: Car, pos: tuple[int, int]):
+        '''Places a car in the grid, keeping the occupancy index up to date.'''
+        self.grid.place_agent(car, pos)
+        self.occupancy.place_car(pos)
+        car.spawn_step = self.metrics.current_step
+        if self.profiler is not None:
+            self.profiler.attach_car(car)
+        self.cars[car.unique_id] = car
+        self.car_states.add(car.unique_id, car.unique_id, pos, car.direction)
+        if self.events is not None:
+            self.events.add(car)
+
+    def new_car(self, unique_id: int, status: str, destination: tuple[int, int]) -> Car:
+        '''Returns a car with the given id, status and destination, taken from the pool of arrived cars when there is one.'''
+        if not self.car_pool:
+            return Car(unique_id, self, status, destination)
+        car = self.car_pool.pop()
+        car.reset(unique_id, status, destination)
+        self.register_agent(car)
+        return car
+
+    def release_car(self, car: Car):
+        '''Keeps a car that arrived on the pool for new_car, once it is out of the grid and the scheduler.'''
+        car.remove() # Mesa keeps a reference to every registered agent
+        if self.profiler is not None:
+            self.profiler.detach_car(car)
+        if len(self.car_pool) < CAR_POOL_SIZE:
+            self.car_pool.append(car)
+
+    def move_car(self, car: Car, pos: tuple[int, int], direction: tuple[int, int]):
+        '''Moves a car in the grid and updates the direction it is facing, keeping the occupancy index up to date.'''
+        previous = car.pos
+        self.occupancy.move_car(previous, pos)
+        self.grid.move_agent(car, pos)
+        car.direction = direction
+        self.car_states.update(car.unique_id, pos, direction)
+        if self.events is not None:
+            self.events.freed(previous)
+
+    def remove_car(self, car: Car):
+        '''Removes a car from the grid, keeping the occupancy index up to date.'''
+        previous = car.pos
+        self.occupancy.remove_car(previous)
+        self.grid.remove_agent(car)
+        del self.cars[car.unique_id]
+        self.car_states.remove(car.unique_id)
+        if self.events is not None:
+            self.events.freed(previous)
+
+    def get_car_states(self) -> list[tuple[str, tuple[int, int], tuple[int, int]]]:
+        '''Returns the id, position and direction of every car on the grid, for both engines.'''
+        return self.car_states.states()
 
     def determine_valid_moves_on_road(self, symbol: str):
         '''Determines the valid moves for a car on a road based on the road's symbol.'''
@@ -133,28 +388,62 @@ class CityModel(Model):
         else:
             return (0,0)
 
+    def get_static_agent(self, symbol: str):
+        '''Returns the Road, Obstacle or Destination agent shared by every cell with the given symbol, creating it the first time.'''
+        if symbol not in self.static_agents:
+            unique_id = f"{symbol}_static"
+            if symbol in ["v", "^", ">", "<"]:
+                agent = Road(unique_id, self, [1,0] if symbol in [">", "<"] else [0,1], self.determine_valid_moves_on_road(symbol), self.determine_main_direction_on_road(symbol))
+            elif symbol == "#":
+                agent = Obstacle(unique_id, self)
+            else:
+                agent = Destination(unique_id, self)
+            self.static_agents[symbol] = agent
+        return self.static_agents[symbol]
+
     def place_env_agent(self, pos: tuple[int, int], symbol: str):
         '''Place an environment agent in the grid based on the symbol.'''
         unique_id = f"{symbol}_{self.id_counter}"
         self.id_counter += 1
 
-        if symbol in ["v", "^", ">", "<"]: # If the symbol is a road, create a road agent inicializing it with the corresponding parameters, and so on for the other agent types
-            agent = Road(unique_id, self, [1,0] if symbol in [">", "<"] else [0,1], self.determine_valid_moves_on_road(symbol), self.determine_main_direction_on_road(symbol))
+        if symbol in ["v", "^", ">", "<"]: # If the symbol is a road, use the road agent shared by that symbol and save its direction in the static layers, and so on for the other agent types
+            agent = self.get_static_agent(symbol)
+            self.occupancy.add_road(pos, agent.main_direction)
 
         elif symbol in ["S", "s"]: 
             is_red = False if symbol == "S" else True
-            agent = Traffic_Light(unique_id, self, [symbol], is_red, 10, "red" if is_red else "green")
+            light_id = self.signals.add_light(pos, is_red, self.light_interval)
+            agent = Traffic_Light(unique_id, self, [symbol], self.signals, light_id) # Its state is changed by the signal controller, so it isn't added to the scheduler
+            self.occupancy.add_traffic_light(pos, agent)
 
         elif symbol == "#":
-            agent = Obstacle(unique_id, self)
+            agent = self.get_static_agent(symbol)
+            self.occupancy.add_obstacle(pos)
 
         elif symbol == "D":
-            agent = Destination(unique_id, self)
+            agent = self.get_static_agent(symbol)
             self.grid_info["destinations"].append(pos)
+            self.occupancy.add_destination(pos)
 
         else:
             print(f"Warning: Unrecognized symbol '{symbol}' at position {pos}")
             return
 
-        self.grid.place_agent(agent, pos) # Place the agent in the grid
-        self.schedule.add(agent) # Add the agent to the scheduler so it can be activated and its step called every frame
\ No newline at end of file
+        self.grid.place_agent(agent, pos) # Place the agent in the grid, shared agents are placed in every cell with their symbol for mesa's visualization
+
+    def get_static_cells(self, kind: type) -> list[tuple[str, tuple[int, int], Agent]]:
+        '''Returns the id, position and shared agent of every Road, Obstacle or Destination cell, reading the static layers instead of the grid.'''
+        cells = []
+        for symbol, agent in self.static_agents.items():
+            if not isinstance(agent, kind):
+                continue
+            if isinstance(agent, Road):
+                layer = self.occupancy.road_direction == ROAD_DIRECTIONS.index(agent.main_direction)
+            elif isinstance(agent, Obstacle):
+                layer = self.occupancy.is_obstacle
+            else:
+                layer = self.occupancy.is_destination
+            for x, y in np.argwhere(layer).tolist():
+                cell_number = (self.height - 1 - y) * self.width + x # Same number the cell had on the id counter when the map was read
+                cells.append((f"{symbol}_{cell_number}", (x, y), agent))
+        return cells
\ No newline at end of file
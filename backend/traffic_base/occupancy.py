@@ -0,0 +1,91 @@
+# Marcos Dayan Mann A01782876
+# José Manuel García Zumaya A01784238
+# 20 noviembre 2024
+
+import copy
+import numpy as np
+
+# Directions a road can face, indexed by the code stored in the road layer (0 means there is no road)
+ROAD_DIRECTIONS = [None, (1, 0), (-1, 0), (0, 1), (0, -1)]
+
+class OccupancyIndex:
+    '''
+    Occupancy index. Keeps what is on every cell of the grid as NumPy layers, so agents can check a cell without going through the agents placed on it.
+    The static layers are filled once while the map is read, and the car layer is updated every time a car is placed, moved or removed.
+    Attributes:
+    - width: int representing the width of the grid.
+    - height: int representing the height of the grid.
+    - road_direction: int8 array with the code of the main direction of the road on each cell (see ROAD_DIRECTIONS), 0 where there is no road.
+    - light_id: int32 array with the index of the traffic light on each cell, -1 where there is none.
+    - is_destination: bool array flagging the destination cells.
+    - is_obstacle: bool array flagging the obstacle cells.
+    - cars: int32 array with the number of cars on each cell.
+    - traffic_lights: list of the traffic light agents, indexed by their light id.
+    '''
+    def __init__(self, width: int, height: int):
+        self.width = width
+        self.height = height
+        self.road_direction = np.zeros((width, height), dtype=np.int8)
+        self.light_id = np.full((width, height), -1, dtype=np.int32)
+        self.is_destination = np.zeros((width, height), dtype=bool)
+        self.is_obstacle = np.zeros((width, height), dtype=bool)
+        self.cars = np.zeros((width, height), dtype=np.int32)
+        self.traffic_lights = []
+
+    def fork(self) -> "OccupancyIndex":
+        '''Returns an index sharing the static layers with this one and with its own copy of the car layer, the traffic lights are added again by the forked model.'''
+        index = copy.copy(self)
+        index.cars = self.cars.copy()
+        index.traffic_lights = []
+        return index
+
+    def in_bounds(self, pos: tuple[int, int]) -> bool:
+        return 0 <= pos[0] < self.width and 0 <= pos[1] < self.height
+
+    # Static layers, filled while the environment is placed
+
+    def add_road(self, pos: tuple[int, int], main_direction: tuple[int, int]):
+        self.road_direction[pos] = ROAD_DIRECTIONS.index(main_direction)
+
+    def add_traffic_light(self, pos: tuple[int, int], traffic_light):
+        self.light_id[pos] = len(self.traffic_lights)
+        self.traffic_lights.append(traffic_light)
+
+    def add_destination(self, pos: tuple[int, int]):
+        self.is_destination[pos] = True
+
+    def add_obstacle(self, pos: tuple[int, int]):
+        self.is_obstacle[pos] = True
+
+    # Typed lookups
+
+    def get_road_direction(self, pos: tuple[int, int]) -> tuple[int, int] | None:
+        '''Returns the main direction of the road on the cell, or None if there is no road on it.'''
+        if not self.in_bounds(pos):
+            return None
+        return ROAD_DIRECTIONS[self.road_direction[pos]]
+
+    def get_traffic_light(self, pos: tuple[int, int]):
+        '''Returns the traffic light agent on the cell, or None if there is no traffic light on it.'''
+        if not self.in_bounds(pos):
+            return None
+        light_id = self.light_id[pos]
+        return self.traffic_lights[light_id] if light_id >= 0 else None
+
+    def has_destination(self, pos: tuple[int, int]) -> bool:
+        return self.in_bounds(pos) and bool(self.is_destination[pos])
+
+    def has_car(self, pos: tuple[int, int]) -> bool:
+        return self.in_bounds(pos) and self.cars[pos] > 0
+
+    # Car layer, updated on every move
+
+    def place_car(self, pos: tuple[int, int]):
+        self.cars[pos] += 1
+
+    def move_car(self, from_pos: tuple[int, int], to_pos: tuple[int, int]):
+        self.cars[from_pos] -= 1
+        self.cars[to_pos] += 1
+
+    def remove_car(self, pos: tuple[int, int]):
+        self.cars[pos] -= 1
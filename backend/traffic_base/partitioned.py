@@ -0,0 +1,461 @@
+# Marcos Dayan Mann A01782876
+# José Manuel García Zumaya A01784238
+# 20 noviembre 2024
+
+from multiprocessing import shared_memory
+import multiprocessing
+import os
+import time
+import weakref
+import numpy as np
+from traffic_base.vector_engine import VectorizedEngine, CALCULATING_ROUTE
+
+# Fields of a car handed from one process to another, the same as the car arrays of VectorizedEngine
+CAR_RECORD = np.dtype([
+    ("car_id", np.int32), ("node", np.int32), ("direction_x", np.int8), ("direction_y", np.int8), ("destination", np.int32),
+    ("cursor", np.int32), ("status", np.int8), ("spawn_step", np.int32), ("light_wait", np.int32), ("reroutes", np.int32), ("detour", np.int8),
+])
+
+# Fields of every car a tile writes to its shared state after a step: the cars on the tile, followed by the cars that arrived with their trip metrics
+TILE_STATE = np.dtype([
+    ("car_id", np.int32), ("node", np.int32), ("direction_x", np.int8), ("direction_y", np.int8),
+    ("spawn_step", np.int32), ("light_wait", np.int32), ("reroutes", np.int32),
+])
+
+def handoff_priority(car_ids: np.ndarray, step: int) -> np.ndarray:
+    '''Priority of the cars entering a tile on a step, the lowest one wins a cell. It depends only on the car and the step, so it's the same on every run and no car always loses.'''
+    mixed = (car_ids.astype(np.uint64) * np.uint64(2654435761) + np.uint64(step) * np.uint64(40503)) & np.uint64(0xFFFFFFFF)
+    return (mixed * np.uint64(2246822519) >> np.uint64(7)) & np.uint64(0xFFFFFFFF)
+
+def share_array(array: np.ndarray) -> tuple[shared_memory.SharedMemory, np.ndarray]:
+    '''Copies an array to a new block of shared memory, returns the block and the array over it.'''
+    block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    shared = np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)
+    shared[...] = array
+    return block, shared
+
+def attach_array(spec: tuple) -> tuple[shared_memory.SharedMemory, np.ndarray]:
+    '''Opens an array shared by another process, spec is its block name, shape and dtype.'''
+    name, shape, dtype = spec
+    try:
+        block = shared_memory.SharedMemory(name=name, track=False) # Python 3.13+, the block belongs to the process that created it
+    except TypeError: # Older versions register it again on the resource tracker the workers share with the model's process, which is harmless
+        block = shared_memory.SharedMemory(name=name)
+    return block, np.ndarray(shape, dtype=dtype, buffer=block.buf)
+
+class TileEngine(VectorizedEngine):
+    '''
+    Engine of one tile of a partitioned model, runs on a worker process. Moves the cars on its tile like VectorizedEngine, over the car layer shared by every tile.
+    Cars whose next cell is on another tile don't move, they are returned as handoff requests and the partitioned engine decides which of them cross. The tile only reads the cars of its own cells, so sidesteps stay on it.
+    Attributes:
+    - tile: index of the tile.
+    - cell_tile: int16 array with the tile that owns every cell, flattened like the occupancy layers.
+    - rng: random generator of the activation order of the tile, seeded from the model's seed and the tile index.
+    - crossings: handoff requests of the current step, tuples with the records of the cars, the nodes they asked for and whether they are forced.
+    - refused: ids of the cars that couldn't cross on the last step.
+    - red_lights, blocked_lights: shared boolean arrays with the red lights and the lights cars wait for, written by the partitioned engine before every step.
+    - state_block, state: block of shared memory created by the tile and the TILE_STATE array over it, which the partitioned engine reads after every step instead of receiving the cars through the pipe.
+    - (and the car arrays of VectorizedEngine, with the cars on the tile)
+    '''
+    def __init__(self, tile: int, arrays: dict[str, np.ndarray], shape: tuple[int, int], seed: int, capacity: int = 256):
+        self.model = None
+        self.tile = tile
+        self.width, self.height = shape
+        self.next_hop = arrays["next_hop"]
+        self.distance = arrays["distance"]
+        self.goal_node = arrays["goal_node"]
+        self.node_x = arrays["node_x"]
+        self.node_y = arrays["node_y"]
+        self.node_cell = arrays["node_cell"]
+        self.offsets = arrays["offsets"]
+        self.neighbors = arrays["neighbors"]
+        self.node_of_cell = arrays["node_of_cell"]
+        self.cell_cars = arrays["cell_cars"]
+        self.cell_light = arrays["cell_light"]
+        self.cell_destination = arrays["cell_destination"]
+        self.cell_road = arrays["cell_road"]
+        self.cell_tile = arrays["cell_tile"]
+        self.red_lights = arrays["red_lights"]
+        self.blocked_lights = arrays["blocked_lights"]
+        self.state_block, self.state = None, np.zeros(0, dtype=TILE_STATE)
+        self.freed_by = np.full(self.cell_cars.shape, -1, dtype=np.int64)
+        self.rng = np.random.default_rng([seed, tile])
+        self.count = 0
+        for name in self.ARRAYS:
+            setattr(self, name, np.zeros(capacity, dtype=CAR_RECORD[name]))
+
+
+    def receive(self, records: np.ndarray):
+        '''Adds cars that were placed on the tile or entered it, their cells are already counted on the car layer.'''
+        size = len(records)
+        self.ensure_capacity(self.count + size)
+        for name in self.ARRAYS:
+            getattr(self, name)[self.count:self.count + size] = records[name]
+        self.count += size
+
+
+    def release(self, car_ids: np.ndarray):
+        '''Removes the cars that left the tile.'''
+        if len(car_ids):
+            self.remove(np.flatnonzero(np.isin(self.car_id[:self.count], car_ids)))
+
+
+    def records(self, cars: np.ndarray) -> np.ndarray:
+        records = np.zeros(len(cars), dtype=CAR_RECORD)
+        for name in self.ARRAYS:
+            records[name] = getattr(self, name)[cars]
+        return records
+
+
+    def local(self, cells: np.ndarray) -> np.ndarray:
+        return self.cell_tile[cells] == self.tile
+
+
+    def split_leaving(self, movers: np.ndarray, next_node: np.ndarray, next_cell: np.ndarray) -> np.ndarray:
+        '''
+        Separates the cars leaving the tile, they are handed off after every tile moved its own cars.
+        A car that couldn't cross on the last step is held back for one step instead, so it can take the detours of a blocked car inside the tile.
+        '''
+        leaving = ~self.local(next_cell)
+        held = leaving & np.isin(self.car_id[movers], self.refused)
+        crossing = leaving & ~held
+        self.cross(movers[crossing], next_node[crossing], force=False)
+        return ~crossing
+
+
+    def cross(self, cars: np.ndarray, next_node: np.ndarray, force: bool):
+        '''Adds handoff requests for cars entering another tile, forced for the cars that enter even if there is a car on the cell (see VectorizedEngine.start_detours).'''
+        if len(cars):
+            self.crossings.append((self.records(cars), next_node, np.full(len(cars), force)))
+
+
+    def step_tile(self, refused: np.ndarray) -> dict:
+        '''
+        Advances the cars of the tile one step, with the ids of the cars that couldn't cross on the last step, and writes its cars and the ones that arrived to its shared state.
+        Returns the shared state, the number of cars waiting at lights, of reroutes and of undeliverable cars, the handoff requests and the seconds the step took.
+        '''
+        start = time.process_time() # CPU time of the worker, so tiles sharing a core don't count each other's time
+        touched_cells = []
+        self.crossings = []
+        self.refused = refused
+        arrived_cars, undeliverable_cars, waiting, reroutes = self.step_cars(self.rng.permutation(self.count), self.red_lights, self.blocked_lights, touched_cells)
+        for cells in touched_cells:
+            self.freed_by[cells] = -1
+
+        arrived = self.state_rows(arrived_cars) # Copied before the cars are removed
+        leaving = np.concatenate([arrived_cars, undeliverable_cars])
+        if len(leaving):
+            self.remove(leaving)
+        count = self.count
+        self.ensure_state_capacity(count + len(arrived))
+        for name in TILE_STATE.names:
+            self.state[name][:count] = getattr(self, name)[:count]
+        self.state[count:count + len(arrived)] = arrived
+        return {
+            "state": (self.state_block.name, len(self.state), count, len(arrived)),
+            "undeliverable": len(undeliverable_cars),
+            "waiting": waiting,
+            "reroutes": reroutes,
+            "handoffs": self.crossings,
+            "seconds": time.process_time() - start,
+        }
+
+
+    def state_rows(self, cars: np.ndarray) -> np.ndarray:
+        rows = np.zeros(len(cars), dtype=TILE_STATE)
+        for name in TILE_STATE.names:
+            rows[name] = getattr(self, name)[cars]
+        return rows
+
+
+    def ensure_state_capacity(self, size: int):
+        '''Moves the shared state to a block twice as large when it can't hold the given rows. The old block is unlinked, the partitioned engine keeps it open until it reads the new name.'''
+        if self.state_block is not None and size <= len(self.state):
+            return
+        capacity = max(size, 2 * len(self.state), 256)
+        block = shared_memory.SharedMemory(create=True, size=capacity * TILE_STATE.itemsize)
+        self.close_state()
+        self.state_block, self.state = block, np.ndarray(capacity, dtype=TILE_STATE, buffer=block.buf)
+
+
+    def close_state(self):
+        if self.state_block is not None:
+            block, self.state = self.state_block, np.zeros(0, dtype=TILE_STATE)
+            self.state_block = None
+            block.close()
+            block.unlink()
+
+def tile_worker(connection, tile: int, specs: dict, shape: tuple[int, int], seed: int):
+    '''Loop of a worker process, steps its tile every time the partitioned engine asks for it until it is closed.'''
+    blocks, arrays, engine = [], {}, None
+    for name, spec in specs.items():
+        block, arrays[name] = attach_array(spec)
+        blocks.append(block)
+    try:
+        engine = TileEngine(tile, arrays, shape, seed)
+        while True:
+            message = connection.recv()
+            if message[0] == "close":
+                break
+            _, departed, refused, incoming = message
+            engine.release(departed)
+            engine.receive(incoming)
+            connection.send(engine.step_tile(refused))
+    except EOFError: # The model was closed without closing its workers
+        pass
+    finally:
+        if engine is not None:
+            engine.close_state()
+        engine = arrays = None # The arrays must be released before their blocks are closed
+        for block in blocks:
+            block.close()
+
+def split_tiles(occupancy, node_cell: np.ndarray, tiles: int) -> np.ndarray:
+    '''Splits the map in vertical strips with about the same number of street cells, returns the tile of every cell flattened like the occupancy layers.'''
+    columns = np.bincount(node_cell // occupancy.height, minlength=occupancy.width)
+    target = np.arange(1, tiles) * (columns.sum() / tiles)
+    bounds = np.searchsorted(np.cumsum(columns), target) + 1 # First column of every tile but the first
+    column_tile = np.zeros(occupancy.width, dtype=np.int16)
+    for bound in bounds:
+        column_tile[bound:] += 1
+    return np.repeat(column_tile, occupancy.height)
+
+def close_workers(processes: list, connections: list, blocks: list, tile_states: list):
+    for connection in connections:
+        try:
+            connection.send(("close",))
+            connection.close()
+        except (OSError, ValueError):
+            pass
+    for process in processes:
+        process.join(timeout=5)
+        if process.is_alive():
+            process.terminate()
+    for block in blocks:
+        block.close()
+        block.unlink()
+    for index, state in enumerate(tile_states): # Shared states opened from the tiles, unlinked by their workers unless they were terminated
+        if state is not None:
+            tile_states[index] = None
+            state[1].close()
+            try:
+                state[1].unlink()
+            except FileNotFoundError:
+                pass
+
+class PartitionedEngine:
+    '''
+    Partitioned stepping engine. Splits the map in tiles, each one stepped by its own worker process like VectorizedEngine, so large maps use several cores.
+    The car layer of the occupancy index, the routing table and the traffic lights are in shared memory, every worker only changes the cells of its tile while the tiles are stepped.
+    Each tile writes its cars and its arrivals to a shared state of its own, so the pipes only carry the cars crossing between tiles and a few counters.
+    Cars whose next cell is on another tile are handed off once every tile finished: they cross if the cell is still free, and when several cars want the same cell the one with the lowest handoff_priority() crosses.
+    A car starting a detour of a traffic light crosses even onto a taken cell.
+    So a car never follows another car across a border on the same step, and a run with the same seed and number of tiles is always the same.
+    It isn't a faster engine than VectorizedEngine yet: on a 350x350 map with about 9000 cars the tiles took about as long as the vectorized engine even counting a core per tile,
+    and the rest of the step (signals, demand and metrics) runs on the model's process anyway. benchmarks/bench_partitioned.py measures it, "vectorized" is the engine to use for speed.
+    Attributes:
+    - model: model the engine belongs to, its car layer is moved to shared memory.
+    - tiles: number of tiles and worker processes.
+    - cell_tile: int16 array with the tile that owns every cell, flattened like the occupancy layers.
+    - pending: list with the record arrays of the cars each tile receives on the next step (placed cars and cars that crossed into it).
+    - departed: list with the ids of the cars that left each tile on the last step.
+    - refused: list with the ids of the cars of each tile that couldn't cross on the last step, they try the detours of a blocked car inside their tile before asking again.
+    - tile_seconds: list with the CPU seconds each tile took to step on the last step, without the time spent on the pipes.
+    - tile_states: list with the name, block and TILE_STATE array of the shared state of each tile, opened when the tile sends its name.
+    - state_counts: list with the number of cars on the shared state of each tile after the last step, they are only read by write_states().
+    - crossed: records of the cars that crossed to another tile on the last step sorted by id, on their new cell. Their old tile wrote them on the cell they left.
+    - count: number of cars in the engine.
+    '''
+    def __init__(self, model, tiles: int | None = None):
+        tiles = tiles or os.cpu_count() or 1
+        if tiles < 1:
+            raise ValueError("The partitioned engine needs at least one tile")
+        self.model = model
+        self.tiles = tiles
+        table = model.routing_table
+        occupancy = model.occupancy
+        self.node_x = np.asarray(table.street_graph.node_x, dtype=np.int32)
+        self.node_y = np.asarray(table.street_graph.node_y, dtype=np.int32)
+        self.node_cell = self.node_x * occupancy.height + self.node_y
+        self.cell_tile = split_tiles(occupancy, self.node_cell, tiles)
+
+        # Shared arrays, the car layer replaces the one of the occupancy index so the model reads the cells the workers change
+        shared = {
+            "next_hop": table.next_hop,
+            "distance": table.distance,
+            "goal_node": np.array([table.street_graph.node_id(goal) for goal in table.goal_index], dtype=np.int32),
+            "node_x": self.node_x,
+            "node_y": self.node_y,
+            "node_cell": self.node_cell,
+            "offsets": table.street_graph.offsets,
+            "neighbors": table.street_graph.neighbors,
+            "node_of_cell": table.street_graph.node_of_cell,
+            "cell_cars": occupancy.cars.reshape(-1),
+            "cell_light": occupancy.light_id.reshape(-1),
+            "cell_destination": occupancy.is_destination.reshape(-1),
+            "cell_road": occupancy.road_direction.reshape(-1),
+            "cell_tile": self.cell_tile,
+            "red_lights": np.zeros(len(model.signals.is_red), dtype=bool),
+            "blocked_lights": np.zeros(len(model.signals.is_red), dtype=bool),
+        }
+        self.blocks, specs = [], {}
+        for name, array in shared.items():
+            block, shared_array = share_array(np.ascontiguousarray(array))
+            self.blocks.append(block)
+            specs[name] = (block.name, shared_array.shape, shared_array.dtype)
+            if name == "cell_cars":
+                self.cell_cars = shared_array
+                occupancy.cars = shared_array.reshape(occupancy.width, occupancy.height)
+            elif name in ("red_lights", "blocked_lights"):
+                setattr(self, name, shared_array)
+
+        seed = model.random.getrandbits(64)
+        context = multiprocessing.get_context("spawn") # Workers only import NumPy and this module, and don't inherit the threads of a server
+        self.connections, self.processes = [], []
+        for tile in range(tiles):
+            connection, worker_connection = context.Pipe()
+            process = context.Process(target=tile_worker, args=(worker_connection, tile, specs, (occupancy.width, occupancy.height), seed), daemon=True)
+            process.start()
+            worker_connection.close()
+            self.connections.append(connection)
+            self.processes.append(process)
+        self.tile_states = [None] * tiles
+        self.closer = weakref.finalize(self, close_workers, self.processes, self.connections, self.blocks, self.tile_states)
+
+        self.pending = [[] for _ in range(tiles)]
+        self.departed = [np.zeros(0, dtype=np.int32) for _ in range(tiles)]
+        self.refused = [np.zeros(0, dtype=np.int32) for _ in range(tiles)]
+        self.count = 0
+        self.tile_seconds = [0.0] * tiles
+        self.state_counts = [0] * tiles
+        self.crossed = np.zeros(0, dtype=CAR_RECORD)
+
+
+    def close(self):
+        '''Stops the workers and frees the shared memory, the model can't be stepped afterwards.'''
+        if not self.closer.alive:
+            return
+        occupancy = self.model.occupancy
+        occupancy.cars = self.cell_cars.reshape(occupancy.width, occupancy.height).copy() # The model can still be read
+        self.closer()
+
+
+    def spawn(self, car_ids, positions: list[tuple[int, int]], destinations: list[tuple[int, int]]):
+        '''Places cars on the given positions heading to the given destinations, they are sent to the tile of their cell on the next step.'''
+        table = self.model.routing_table
+        records = np.zeros(len(positions), dtype=CAR_RECORD)
+        records["car_id"] = car_ids
+        records["node"] = [table.street_graph.node_id(pos) for pos in positions]
+        records["destination"] = [table.goal_index[goal] for goal in destinations]
+        records["status"] = CALCULATING_ROUTE
+        records["spawn_step"] = self.model.metrics.current_step
+        cells = self.node_cell[records["node"]]
+        np.add.at(self.cell_cars, cells, 1)
+        self.queue(records, self.cell_tile[cells])
+        self.count += len(records)
+
+
+    def queue(self, records: np.ndarray, tiles: np.ndarray):
+        '''Queues cars for the tiles they are on, they are sent with the next step.'''
+        for tile in np.unique(tiles).tolist():
+            self.pending[tile].append(records[tiles == tile])
+
+
+    def step(self):
+        '''Steps every tile on its worker, then hands off the cars crossing between tiles.'''
+        model = self.model
+        np.copyto(self.red_lights, model.signals.is_red)
+        np.logical_or(model.signals.is_red, model.signals.is_yellow, out=self.blocked_lights)
+        for tile, connection in enumerate(self.connections):
+            incoming = np.concatenate(self.pending[tile]) if self.pending[tile] else np.zeros(0, dtype=CAR_RECORD)
+            connection.send(("step", self.departed[tile], self.refused[tile], incoming))
+        results = [connection.recv() for connection in self.connections]
+        self.tile_seconds = [result["seconds"] for result in results]
+
+        arrived = []
+        for tile, result in enumerate(results):
+            state, count, arrivals = self.read_state(tile, result["state"])
+            self.state_counts[tile] = count
+            arrived.append(state[count:count + arrivals])
+        arrived = np.concatenate(arrived)
+        if len(arrived):
+            model.total_cars_at_destination += len(arrived)
+            model.metrics.record_arrivals(arrived["spawn_step"], arrived["light_wait"], arrived["reroutes"])
+        undeliverable = sum(result["undeliverable"] for result in results)
+        model.metrics.step_undeliverable += undeliverable
+        model.current_car_number -= len(arrived) + undeliverable
+        self.count -= len(arrived) + undeliverable
+        model.metrics.step_waiting_at_lights += sum(result["waiting"] for result in results)
+        model.metrics.step_reroutes += sum(result["reroutes"] for result in results)
+        self.hand_off([handoff for result in results for handoff in result["handoffs"]])
+
+
+    def read_state(self, tile: int, spec: tuple) -> tuple[np.ndarray, int, int]:
+        '''Returns the shared state of a tile with its number of cars and of arrivals, opening it again if the tile moved it to a larger block.'''
+        name, capacity, count, arrivals = spec
+        current = self.tile_states[tile]
+        if current is None or current[0] != name:
+            block, state = attach_array((name, (capacity,), TILE_STATE))
+            self.tile_states[tile] = (name, block, state)
+            if current is not None:
+                current[1].close() # The tile already unlinked it
+        return self.tile_states[tile][2], count, arrivals
+
+
+    def hand_off(self, handoffs: list[tuple]):
+        '''
+        Moves the cars that cross to another tile into the cells they asked for, and queues them for the tile they enter.
+        A forced handoff always crosses, the others only cross into a free cell and one car per cell.
+        '''
+        self.pending = [[] for _ in range(self.tiles)]
+        self.departed = [np.zeros(0, dtype=np.int32) for _ in range(self.tiles)]
+        self.refused = [np.zeros(0, dtype=np.int32) for _ in range(self.tiles)]
+        records = np.concatenate([records for records, _, _ in handoffs] or [np.zeros(0, dtype=CAR_RECORD)])
+        next_node = np.concatenate([next_node for _, next_node, _ in handoffs] or [np.zeros(0, dtype=np.int32)])
+        force = np.concatenate([force for _, _, force in handoffs] or [np.zeros(0, dtype=bool)])
+        next_cell = self.node_cell[next_node]
+        candidates = np.flatnonzero(~force & (self.cell_cars[next_cell] == 0) & ~np.isin(next_cell, next_cell[force]))
+        priority = handoff_priority(records["car_id"][candidates], self.model.metrics.current_step)
+        candidates = candidates[np.lexsort((records["car_id"][candidates], priority, next_cell[candidates]))]
+        first = np.ones(len(candidates), dtype=bool)
+        first[1:] = next_cell[candidates][1:] != next_cell[candidates][:-1]
+        winners = np.concatenate([np.flatnonzero(force), candidates[first]])
+        np.subtract.at(self.cell_cars, self.node_cell[records["node"][winners]], 1)
+        np.add.at(self.cell_cars, next_cell[winners], 1)
+        refused = np.ones(len(records), dtype=bool)
+        refused[winners] = False
+
+        refused_records = records[refused]
+        refused_tile = self.cell_tile[self.node_cell[refused_records["node"]]]
+        for tile in range(self.tiles):
+            self.refused[tile] = refused_records["car_id"][refused_tile == tile]
+
+        crossing = records[winners]
+        to_node = next_node[winners]
+        from_tile = self.cell_tile[self.node_cell[crossing["node"]]]
+        crossing["direction_x"] = np.sign(self.node_x[to_node] - self.node_x[crossing["node"]])
+        crossing["direction_y"] = np.sign(self.node_y[to_node] - self.node_y[crossing["node"]])
+        crossing["node"] = to_node
+        crossing["cursor"] += 1
+        crossing["detour"] = np.maximum(crossing["detour"] - 1, 0)
+        for tile in range(self.tiles):
+            self.departed[tile] = crossing["car_id"][from_tile == tile]
+        self.queue(crossing, self.cell_tile[self.node_cell[to_node]])
+
+        self.crossed = crossing[np.argsort(crossing["car_id"])]
+
+
+    def write_states(self, car_states):
+        '''
+        Copies the id, position and direction of every car from the shared states of the tiles to the model's car state buffer, with the cars that crossed on their new cell.
+        The shared states are only read here, the tiles don't write them again until the next step.
+        '''
+        states = [tile_state[2][:count] for tile_state, count in zip(self.tile_states, self.state_counts) if tile_state is not None]
+        cars = np.concatenate(states) if states else np.zeros(0, dtype=TILE_STATE)
+        if len(self.crossed):
+            position = np.minimum(np.searchsorted(self.crossed["car_id"], cars["car_id"]), len(self.crossed) - 1)
+            crossed = self.crossed["car_id"][position] == cars["car_id"]
+            for name in ("node", "direction_x", "direction_y"):
+                cars[name][crossed] = self.crossed[name][position[crossed]]
+        node = cars["node"]
+        car_states.write_all(cars["car_id"], self.node_x[node], self.node_y[node], cars["direction_x"], cars["direction_y"])
@@ -0,0 +1,130 @@
+# Marcos Dayan Mann A01782876
+# José Manuel García Zumaya A01784238
+# 20 noviembre 2024
+
+from collections import defaultdict
+from time import perf_counter_ns
+
+class StepProfiler:
+    '''
+    Step profiler. Measures the time spent on every phase of CityModel.step and counts the calls of the hot paths (routes, searches, grid lookups...).
+    It works by replacing the methods of the model, its components and its cars with timed wrappers while it is attached, so a model that is not being profiled runs its original methods without any check.
+    Phases can be nested, the time of every stack of phases is kept so it can be dumped in the folded format used by flamegraph tools.
+    Attributes:
+    - phases: dictionary with the calls and total nanoseconds of every phase, including the time of the phases nested on it.
+    - folded: dictionary with the nanoseconds spent on every stack of phases ("step;schedule;car"), excluding the time of the nested phases.
+    - counters: dictionary with the calls and nodes counted by the wrappers (e.g. "route_cache_calls" for the routes asked by the cars, "route_calls" and "route_nodes" for the ones the router made), "step_calls" is the number of model steps profiled.
+    '''
+    def __init__(self):
+        self.phases = defaultdict(lambda: [0, 0])
+        self.folded = defaultdict(int)
+        self.counters = defaultdict(int)
+        self.stack = [] # Names of the phases being measured
+        self.child_time = [] # Time spent on nested phases, for every phase being measured
+        self.wrapped = [] # Objects and method names replaced by wrappers
+
+
+    def wrap(self, obj, method_name: str, phase: str, counter: str | None = None, count_nodes=None):
+        '''
+        Replaces a method of the object with a wrapper that measures it as the given phase.
+        If counter is given, every call is counted as "<counter>_calls", and count_nodes(obj, result) is added to "<counter>_nodes".
+        '''
+        original = getattr(obj, method_name)
+        stack, child_time, phases, folded, counters = self.stack, self.child_time, self.phases, self.folded, self.counters
+
+        def wrapper(*args, **kwargs):
+            stack.append(phase)
+            child_time.append(0)
+            start = perf_counter_ns()
+            result = None
+            try:
+                result = original(*args, **kwargs)
+                return result
+            finally:
+                elapsed = perf_counter_ns() - start
+                folded[";".join(stack)] += elapsed - child_time.pop()
+                stack.pop()
+                if child_time:
+                    child_time[-1] += elapsed
+                stats = phases[phase]
+                stats[0] += 1
+                stats[1] += elapsed
+                if counter is not None:
+                    counters[f"{counter}_calls"] += 1
+                    if count_nodes is not None:
+                        counters[f"{counter}_nodes"] += count_nodes(obj, result)
+
+        setattr(obj, method_name, wrapper) # Instance attribute, it hides the method of the class
+
+
+    def attach(self, model):
+        '''Wraps the phases of the model's step and the hot paths of its components and cars.'''
+        targets = [
+            (model, "step", "step", "step", None),
+            (model, "place_cars", "place_cars", None, None),
+            (model, "move_car", "move_car", None, None),
+            (model, "terminal_report", "terminal_report", None, None),
+            (model.signals, "step", "signals", None, None),
+            (model.events if model.events is not None else model.schedule, "step", "schedule", None, None),
+            (model.metrics, "end_step", "metrics", None, None),
+            (model.route_cache, "route", "route_cache", "route_cache", None), # Every route asked by a car
+            (model.router, "route", "route", "route", lambda router, route: len(route or [])), # Routes missing from the cache, the cells walked on the routing table with the bfs router
+        ]
+        if hasattr(model.router, "search"): # A* router
+            targets.append((model.router, "search", "astar", "astar", lambda router, result: router.nodes_expanded))
+        for method_name in ("get_road_direction", "get_traffic_light", "has_destination", "has_car"):
+            targets.append((model.occupancy, method_name, "grid_lookup", "grid_lookup", None))
+        if model.vector_engine is not None:
+            targets.append((model.vector_engine, "step", "vector_engine", None, None))
+
+        for obj, method_name, phase, counter, count_nodes in targets:
+            self.wrap(obj, method_name, phase, counter, count_nodes)
+            self.wrapped.append((obj, method_name))
+        for car in model.cars.values():
+            self.attach_car(car)
+
+
+    def attach_car(self, car):
+        '''Wraps the methods of a car, called for every car placed while the profiler is attached.'''
+        self.wrap(car, "step", "car")
+        self.wrap(car, "calculating_route", "calculating_route")
+        self.wrap(car, "handle_traffic_ahead", "handle_traffic_ahead")
+        self.wrap(car, "avoid_bottleneck_on_traffic_light", "avoid_bottleneck")
+
+
+    def detach_car(self, car):
+        '''Restores the original methods of a car, called for every car that arrives so the model's pool doesn't keep its wrappers.'''
+        for method_name in ("step", "calculating_route", "handle_traffic_ahead", "avoid_bottleneck_on_traffic_light"):
+            car.__dict__.pop(method_name, None)
+
+
+    def detach(self, model):
+        '''Restores the original methods of the model, its components and its cars.'''
+        for obj, method_name in self.wrapped:
+            obj.__dict__.pop(method_name, None)
+        self.wrapped.clear()
+        for car in model.cars.values():
+            self.detach_car(car)
+
+
+    def report(self) -> dict:
+        '''Returns the time of every phase and the counters, in total and per step.'''
+        steps = self.counters["step_calls"]
+        return {
+            "steps": steps,
+            "phases": {
+                phase: {
+                    "calls": calls,
+                    "total_ms": total / 1e6,
+                    "ms_per_step": total / 1e6 / max(steps, 1),
+                    "us_per_call": total / 1e3 / calls if calls else 0.0,
+                }
+                for phase, (calls, total) in sorted(self.phases.items(), key=lambda item: -item[1][1])
+            },
+            "counters": {name: {"total": value, "per_step": value / max(steps, 1)} for name, value in sorted(self.counters.items())},
+        }
+
+
+    def folded_stacks(self) -> str:
+        '''Returns the time of every stack of phases in the folded format ("step;schedule;car 1234" in microseconds), which flamegraph.pl and speedscope can read.'''
+        return "".join(f"{stack} {time // 1000}\n" for stack, time in sorted(self.folded.items()) if time >= 1000)
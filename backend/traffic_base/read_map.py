@@ -2,100 +2,278 @@
 # José Manuel García Zumaya A01784238
 # 20 noviembre 2024
 
-def build_graph(grid_file_path: str): 
-    if not grid_file_path:
-        print("No se ha especificado un archivo de mapa")
-        return None
-
-    with open(grid_file_path, 'r', encoding='utf-8') as file:
-        map_text = [line.rstrip('\n') for line in file]
-    grid = [list(line) for line in map_text] # Parsing the map text file into a 2D list
-
-    # map length
-    rows = len(grid)
-    cols = len(grid[0])
-
-    graph = {}  # Adjacency list dictionary (node -> list of neighbors) for representing the graph
-    grid_info = {
-        "destinations": [],
-    }
-
-    # Representing the direction each arrow or symbol points to
-    street_letters_direction = {
-        '>': (1, 0),
-        '<': (-1, 0),
-        '^': (0, 1),
-        'v': (0, -1),  # Inverting the direction of the arrow since the y-axis is inverted in the mesa grid
-        'S': (0, 0),
-        's': (0, 0),
-        'D': (0, 0),
-    }
-
-    corners = [  # Define explicitly the map corners
-        (0, 0), 
-        (0, rows - 1), 
-        (cols - 1, 0), 
-        (cols - 1, rows - 1)
-    ]
-
-    # Initializing the graph with each possible node on it, but without connections, for refering to neighbor graph nodes that might not be inicialized yet if this step wasn't included
-    for y in range(rows):
-        for x in range(cols):
-            symbol = grid[y][x]
-            mesa_y = rows - 1 - y
-            position = (x, mesa_y)
-            if symbol in ['>', '<', '^', 'v', 'S', 's', 'D']:
-                graph[position] = []
-                if symbol == 'D':
-                    grid_info["destinations"].append(position)  # Store destination positions
-
-    # Adding connections between the nodes
-    for y in range(rows):
-        for x in range(cols):
-            symbol = grid[y][x]
-            mesa_y = rows - 1 - y
-            position = (x, mesa_y)
-            if symbol in ['>', '<', '^', 'v', 'S', 's']: # From a street, we can move to any adjacent cell that does not have an arrow pointing towards us
-                for dir_x, dir_y in [(-1, 0), (1, 0), (0, -1), (0, 1)]:  # Check all neighbor cells
-                    neigh_x, neigh_y = x + dir_x, y + dir_y
-
-                    # Skip outgoing connections for corners
-                    if (neigh_x, neigh_y) in corners:
-                        continue
-
-                    if not (0 <= neigh_x < cols and 0 <= neigh_y < rows):
-                        continue  # Neighbor out of bounds
-                    
-                    neighbor_symbol = grid[neigh_y][neigh_x]
-                    if neighbor_symbol not in ['>', '<', '^', 'v', 'S', 's', 'D']:
-                        continue  # Skip symbols not relevant for the street graph
-
-                    mesa_neigh_y = rows - 1 - neigh_y
-                    neighbor_position = (neigh_x, mesa_neigh_y)
-                    neigh_direction_x, neigh_direction_y = street_letters_direction.get(neighbor_symbol, (0, 0))
-
-                    if not (neigh_x + neigh_direction_x == x and mesa_neigh_y + neigh_direction_y == mesa_y):
-                        # If the neighbor arrow is not pointing towards us
-                        graph[position].append(neighbor_position)
-
-            elif symbol == 'D':
-                for dir_x, dir_y in [(-1, 0), (1, 0), (0, -1), (0, 1)]:
-                    neigh_x, neigh_y = x + dir_x, y + dir_y
-                    if not (0 <= neigh_x < cols and 0 <= neigh_y < rows):
-                        continue
-
-                    # Skip outgoing connections for corners
-                    if (neigh_x, neigh_y) in corners:
-                        continue
-
-                    neighbor_symbol = grid[neigh_y][neigh_x]
-                    if neighbor_symbol in ['>', '<', '^', 'v', 'S', 's']: # Adding the destination as a neighbor of the street or traffic light
-                        mesa_neigh_y = rows - 1 - neigh_y
-                        neighbor_position = (neigh_x, mesa_neigh_y)
-                        graph[neighbor_position].append(position)
-
-    for node, neighbors in graph.items():
-        if set(neighbors).intersection(set(corners)):
-            print(f"Node {node} -> Neighbors: {neighbors}")
-
-    return graph, grid, grid_info
+from collections.abc import Mapping
+import hashlib
+import os
+import shutil
+import tempfile
+import numpy as np
+
+CACHE_VERSION = 1 # Changed whenever the compiled arrays change, so old caches are not used
+STREET_SYMBOLS = b"><^vSs"
+NODE_SYMBOLS = STREET_SYMBOLS + b"D"
+
+# Direction each arrow points to on mesa's grid, where the y-axis is inverted respect the rows of the map file
+SYMBOL_DIRECTIONS = {ord('>'): (1, 0), ord('<'): (-1, 0), ord('^'): (0, 1), ord('v'): (0, -1)}
+
+# Neighbor cells checked from every cell as (column, row) offsets on the map file, in the order they are added to the graph
+NEIGHBOR_OFFSETS = [(-1, 0), (1, 0), (0, -1), (0, 1)]
+
+class StreetGraph(Mapping):
+    '''
+    Street graph in compressed sparse row (CSR) form. Every street, traffic light and destination cell is a node with an int32 id, and the neighbors of all the nodes are kept in one array.
+    It can also be used as the dictionary of coordinates to lists of neighbor coordinates it replaces, building the lists when they are asked for.
+    Attributes:
+    - width: int representing the width of the grid.
+    - height: int representing the height of the grid.
+    - node_x, node_y: int32 arrays with the coordinates of every node, indexed by node id. Nodes are numbered in the order they appear on the map file.
+    - offsets: int32 array with nodes + 1 entries, the neighbors of node n are neighbors[offsets[n]:offsets[n + 1]].
+    - neighbors: int32 array with the node ids of the neighbors of every node, in the order routes are searched.
+    - node_of_cell: int32 array with the node id of every cell, indexed by x * height + y like the flattened occupancy layers, -1 where there is no node.
+    - coords: list with the coordinate tuple of every node, None until coord_table is first called.
+    '''
+    ARRAYS = ("node_x", "node_y", "offsets", "neighbors", "node_of_cell")
+
+    def __init__(self, width: int, height: int, node_x: np.ndarray, node_y: np.ndarray, offsets: np.ndarray, neighbors: np.ndarray, node_of_cell: np.ndarray):
+        self.width = width
+        self.height = height
+        self.node_x = node_x
+        self.node_y = node_y
+        self.offsets = offsets
+        self.neighbors = neighbors
+        self.node_of_cell = node_of_cell
+        self.coords = None
+
+
+    def node_id(self, coord: tuple[int, int]) -> int:
+        '''Returns the node id of the coordinate, or -1 if it isn't a node.'''
+        x, y = coord
+        if not (0 <= x < self.width and 0 <= y < self.height):
+            return -1
+        return int(self.node_of_cell[x * self.height + y])
+
+
+    def coord(self, node: int) -> tuple[int, int]:
+        return (int(self.node_x[node]), int(self.node_y[node]))
+
+
+    def coord_table(self) -> list[tuple[int, int]]:
+        '''Returns the coordinate tuple of every node by node id, built once so the routes and the routers share the same tuples.'''
+        if self.coords is None:
+            self.coords = list(self)
+        return self.coords
+
+
+    def neighbor_ids(self, node: int) -> np.ndarray:
+        return self.neighbors[self.offsets[node]:self.offsets[node + 1]]
+
+
+    def edge_sources(self) -> np.ndarray:
+        '''Returns the node every entry of the neighbors array comes from.'''
+        return np.repeat(np.arange(len(self), dtype=np.int32), np.diff(self.offsets))
+
+
+    def reverse(self) -> tuple[np.ndarray, np.ndarray]:
+        '''Returns the offsets and the neighbors of the reversed graph, the nodes that lead to every node, keeping the order of the node ids.'''
+        order = np.argsort(self.neighbors, kind="stable")
+        offsets = np.zeros(len(self) + 1, dtype=np.int32)
+        np.cumsum(np.bincount(self.neighbors, minlength=len(self)), out=offsets[1:])
+        return offsets, self.edge_sources()[order]
+
+
+    # Dictionary interface, used where the graph is read one cell at a time
+
+    def __getitem__(self, coord: tuple[int, int]) -> list[tuple[int, int]]:
+        node = self.node_id(coord)
+        if node < 0:
+            raise KeyError(coord)
+        neighbors = self.neighbor_ids(node)
+        return list(zip(self.node_x[neighbors].tolist(), self.node_y[neighbors].tolist()))
+
+
+    def __contains__(self, coord) -> bool:
+        return isinstance(coord, tuple) and len(coord) == 2 and self.node_id(coord) >= 0
+
+
+    def __iter__(self):
+        return zip(self.node_x.tolist(), self.node_y.tolist())
+
+
+    def __len__(self) -> int:
+        return len(self.node_x)
+
+
+class CompiledMap:
+    '''
+    Map compiled from a map file: the symbols of every cell, the street graph and the destinations, kept as NumPy arrays.
+    The arrays are cached as .npy files under the hash of the map file and loaded memory-mapped, so repeated loads of the same map are instant and processes using it share the same pages.
+    Other arrays that only depend on the map (e.g. the routing table) can be cached with it.
+    Attributes:
+    - map_hash: SHA-256 of the map file.
+    - symbols: uint8 array (rows x columns) with the symbol of every cell, the first row is the top of the map like on the file.
+    - graph: street graph of the map.
+    - destinations: int32 array (destinations x 2) with the coordinates of the destinations in the order they appear on the file.
+    - cache_folder: folder where the arrays of this map are cached, None if they are not cached.
+    '''
+    def __init__(self, map_hash: str, symbols: np.ndarray, graph: StreetGraph, destinations: np.ndarray, cache_folder: str | None = None):
+        self.map_hash = map_hash
+        self.symbols = symbols
+        self.graph = graph
+        self.destinations = destinations
+        self.cache_folder = cache_folder
+
+
+    @property
+    def width(self) -> int:
+        return self.symbols.shape[1]
+
+
+    @property
+    def height(self) -> int:
+        return self.symbols.shape[0]
+
+
+    def grid(self) -> list[str]:
+        '''Returns the rows of the map as strings, so grid[y][x] is the symbol on the column x of the row y of the file.'''
+        return [row.tobytes().decode("ascii") for row in self.symbols]
+
+
+    def destination_list(self) -> list[tuple[int, int]]:
+        return [(x, y) for x, y in self.destinations.tolist()]
+
+
+    def load_arrays(self, name: str) -> dict[str, np.ndarray] | None:
+        '''Returns the arrays cached with the given name, memory-mapped and read only, or None if they aren't cached.'''
+        if self.cache_folder is None:
+            return None
+        folder = os.path.join(self.cache_folder, name)
+        if not os.path.isdir(folder):
+            return None
+        return {file_name.removesuffix(".npy"): np.load(os.path.join(folder, file_name), mmap_mode="r") for file_name in sorted(os.listdir(folder)) if file_name.endswith(".npy")}
+
+
+    def save_arrays(self, name: str, arrays: dict[str, np.ndarray]):
+        '''
+        Caches the arrays with the given name. They are written on a temporary folder that is renamed at the end, so other processes never load half written arrays.
+        Caching is skipped if the cache can't be written.
+        '''
+        if self.cache_folder is None:
+            return
+        try:
+            os.makedirs(self.cache_folder, exist_ok=True)
+            temporary = tempfile.mkdtemp(prefix=f".{name}-", dir=self.cache_folder)
+        except OSError: # Read only folder
+            return
+        try:
+            for key, array in arrays.items():
+                np.save(os.path.join(temporary, f"{key}.npy"), np.ascontiguousarray(array))
+            os.rename(temporary, os.path.join(self.cache_folder, name))
+        except OSError: # Another process cached the same arrays first, or the disk is full
+            shutil.rmtree(temporary, ignore_errors=True)
+
+
+def compile_map(map_text: str) -> tuple[np.ndarray, StreetGraph, np.ndarray]:
+    '''
+    Compiles the text of a map file into the symbols of every cell, the street graph and the destinations.
+    From a street or traffic light we can move to any adjacent node whose arrow doesn't point towards us, and a destination is reached from every adjacent street or traffic light.
+    The corners of the map, where the cars are placed, are never added as neighbors. Neighbors are added in the same order as the map was always read, since it decides which of the shortest routes is taken.
+    '''
+    rows = map_text.split('\n')
+    if map_text.endswith('\n'):
+        rows.pop()
+    if not rows or not rows[0]:
+        raise ValueError("The map file is empty")
+    if any(len(row) != len(rows[0]) for row in rows):
+        raise ValueError("Every row of the map file must have the same length")
+    try:
+        symbols = np.frombuffer("".join(rows).encode("ascii"), dtype=np.uint8).reshape(len(rows), len(rows[0]))
+    except UnicodeEncodeError:
+        raise ValueError("The map file can only contain the map symbols") from None
+
+    height, width = symbols.shape # Rows and columns of the file, the same as mesa's height and width
+    row, column = np.indices(symbols.shape)
+    is_node = np.isin(symbols, np.frombuffer(NODE_SYMBOLS, dtype=np.uint8))
+    is_street = np.isin(symbols, np.frombuffer(STREET_SYMBOLS, dtype=np.uint8))
+    is_corner = ((row == 0) | (row == height - 1)) & ((column == 0) | (column == width - 1))
+
+    # Nodes are numbered in the order they appear on the file, and mesa's y-axis is inverted respect the rows
+    node_of_row = np.full(symbols.shape, -1, dtype=np.int32)
+    node_of_row[is_node] = np.arange(int(is_node.sum()), dtype=np.int32)
+    node_x = column[is_node].astype(np.int32)
+    node_y = (height - 1 - row[is_node]).astype(np.int32)
+    node_of_cell = np.full(width * height, -1, dtype=np.int32)
+    node_of_cell[node_x * height + node_y] = node_of_row[is_node]
+
+    arrow_x = np.zeros(symbols.shape, dtype=np.int8)
+    arrow_y = np.zeros(symbols.shape, dtype=np.int8)
+    for symbol, (direction_x, direction_y) in SYMBOL_DIRECTIONS.items():
+        arrow_x[symbols == symbol] = direction_x
+        arrow_y[symbols == symbol] = direction_y
+
+    # Every edge is added while a cell is visited: a street adds its neighbors to its own list, and a destination adds itself to the list of its neighbors.
+    # The visit number of the cell and the offset it was added from give the position of the edge on the neighbor list.
+    sources, targets, order = [], [], []
+    visit = row * width + column
+    for offset_index, (offset_x, offset_row) in enumerate(NEIGHBOR_OFFSETS):
+        neighbor_row, neighbor_column = row + offset_row, column + offset_x
+        in_bounds = (neighbor_row >= 0) & (neighbor_row < height) & (neighbor_column >= 0) & (neighbor_column < width)
+        cells = in_bounds.nonzero()
+        neighbors = (neighbor_row[cells], neighbor_column[cells])
+        valid = ~is_corner[neighbors]
+
+        # From a street, to any neighbor node whose arrow doesn't point back to it
+        points_back = (arrow_x[neighbors] == -offset_x) & (arrow_y[neighbors] == offset_row)
+        from_street = valid & is_street[cells] & is_node[neighbors] & ~points_back
+        sources.append(node_of_row[cells][from_street])
+        targets.append(node_of_row[neighbors][from_street])
+        order.append(visit[cells][from_street] * len(NEIGHBOR_OFFSETS) + offset_index)
+
+        # From a street next to a destination, to the destination
+        to_destination = valid & (symbols[cells] == ord('D')) & is_street[neighbors]
+        sources.append(node_of_row[neighbors][to_destination])
+        targets.append(node_of_row[cells][to_destination])
+        order.append(visit[cells][to_destination] * len(NEIGHBOR_OFFSETS) + offset_index)
+
+    sources, targets, order = np.concatenate(sources), np.concatenate(targets), np.concatenate(order)
+    edges = np.lexsort((order, sources))
+    offsets = np.zeros(len(node_x) + 1, dtype=np.int32)
+    np.cumsum(np.bincount(sources, minlength=len(node_x)), out=offsets[1:])
+    graph = StreetGraph(width, height, node_x, node_y, offsets, targets[edges].astype(np.int32), node_of_cell)
+
+    is_destination = node_of_row[symbols == ord('D')]
+    destinations = np.stack([node_x[is_destination], node_y[is_destination]], axis=1).astype(np.int32)
+    return symbols, graph, destinations
+
+def default_cache_folder(map_file: str) -> str:
+    return os.path.join(os.path.dirname(os.path.abspath(map_file)), ".map_cache")
+
+def load_map(map_file: str, cache_folder: str | None = None, use_cache: bool = True) -> CompiledMap:
+    '''
+    Returns the compiled map of the map file. It is loaded from the cache if the same map was already compiled, and compiled and cached otherwise.
+    The cache is kept on cache_folder, by default a .map_cache folder next to the map file.
+    '''
+    if not map_file:
+        raise ValueError("No map file was given")
+    with open(map_file, 'rb') as file:
+        content = file.read()
+    map_hash = hashlib.sha256(content).hexdigest()
+    folder = None
+    if use_cache:
+        folder = os.path.join(cache_folder or default_cache_folder(map_file), f"{map_hash[:32]}-v{CACHE_VERSION}")
+
+    compiled = CompiledMap(map_hash, None, None, None, folder)
+    arrays = compiled.load_arrays("map")
+    if arrays is None:
+        symbols, graph, destinations = compile_map(content.decode("utf-8").replace('\r\n', '\n'))
+        arrays = {"symbols": symbols, "destinations": destinations, **{name: getattr(graph, name) for name in StreetGraph.ARRAYS}}
+        compiled.save_arrays("map", arrays)
+    height, width = arrays["symbols"].shape
+    compiled.symbols = arrays["symbols"]
+    compiled.destinations = arrays["destinations"]
+    compiled.graph = StreetGraph(width, height, *(arrays[name] for name in StreetGraph.ARRAYS))
+    return compiled
+
+def build_graph(grid_file_path: str):
+    '''Reads the map file and returns the street graph, the rows of the map and a dictionary with the destinations, using the compiled map cache.'''
+    compiled = load_map(grid_file_path)
+    return compiled.graph, compiled.grid(), {"destinations": compiled.destination_list()}
@@ -0,0 +1,370 @@
+# Marcos Dayan Mann A01782876
+# José Manuel García Zumaya A01784238
+# 20 noviembre 2024
+
+from collections import OrderedDict, deque
+import copy
+import heapq
+import numpy as np
+
+# Direction tuples by code (direction x + 1) * 3 + direction y + 1, so every route shares the same nine tuples
+DIRECTIONS = [(dx, dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1)]
+
+class Route:
+    '''
+    Compact route. Keeps the cells of a route and the direction the car faces on each of them in two tuples, whose items are the coordinate tuples of the street graph and the shared direction tuples, so a route takes 16 bytes per cell instead of two new tuples per cell.
+    Routes are never changed once created, so a route can be shared by every car following it and each car keeps the index of its next cell.
+    Attributes:
+    - cells: tuple with the coordinate of every cell.
+    - directions: tuple with the direction the car faces on every cell.
+    '''
+    __slots__ = ("cells", "directions")
+
+    def __init__(self, cells: tuple = (), directions: tuple = ()):
+        self.cells = cells
+        self.directions = directions
+
+    @classmethod
+    def from_nodes(cls, street_graph, start: tuple[int, int], nodes: list[int]) -> "Route":
+        '''Creates the route that goes through the given nodes of the street graph after leaving start, the direction on each cell is the one of the move that reached it.'''
+        cells = tuple(map(street_graph.coord_table().__getitem__, nodes))
+        nodes = np.asarray(nodes, dtype=np.int64)
+        x, y = street_graph.node_x[nodes], street_graph.node_y[nodes]
+        codes = (np.sign(np.diff(x, prepend=start[0])) + 1) * 3 + np.sign(np.diff(y, prepend=start[1])) + 1
+        return cls(cells, tuple(map(DIRECTIONS.__getitem__, codes.tolist())))
+
+    @classmethod
+    def from_steps(cls, steps: list[tuple[tuple[int, int], tuple[int, int]]]) -> "Route":
+        '''Creates a route from a list of coordinates and the direction the car faces on each of them.'''
+        return cls(tuple(cell for cell, _ in steps), tuple(DIRECTIONS[(dx + 1) * 3 + dy + 1] for _, (dx, dy) in steps))
+
+    @classmethod
+    def from_array(cls, steps: np.ndarray) -> "Route":
+        '''Creates a route from an array with a row (x, y, direction x, direction y) per cell.'''
+        x, y, dx, dy = (column.tolist() for column in np.asarray(steps).reshape(-1, 4).T)
+        return cls(tuple(zip(x, y)), tuple(DIRECTIONS[(step_x + 1) * 3 + step_y + 1] for step_x, step_y in zip(dx, dy)))
+
+    def __len__(self) -> int:
+        return len(self.cells)
+
+    def __getitem__(self, index: int) -> tuple[tuple[int, int], tuple[int, int]]:
+        '''Returns the coordinate of a cell of the route and the direction the car faces on it.'''
+        return self.cells[index], self.directions[index]
+
+    def to_array(self, start: int = 0) -> np.ndarray:
+        '''Returns the cells from the start index as an int32 array with a row (x, y, direction x, direction y) per cell.'''
+        if start >= len(self.cells):
+            return np.zeros((0, 4), dtype=np.int32)
+        return np.hstack([np.array(self.cells[start:], dtype=np.int32), np.array(self.directions[start:], dtype=np.int32)])
+
+EMPTY_ROUTE = Route() # Route of the cars that haven't calculated one, shared since it is never changed
+
+class RoutingTable:
+    '''
+    Routing table. Precomputes, for every destination, the next cell and the remaining distance from every street cell, so routes don't need a BFS per car.
+    The arrays only depend on the map, so they can be given from the compiled map cache instead of being calculated.
+    Attributes:
+    - street_graph: street graph of the map, its node ids index the routing arrays.
+    - goal_index: dictionary mapping every destination coordinate to its row in the routing arrays.
+    - next_hop: int32 array (destinations x nodes) with the node id of the next cell towards each destination, -1 if there is none.
+    - distance: int32 array (destinations x nodes) with the number of cells left to reach each destination, -1 if it is unreachable.
+    - corners: set of the map corners, cars can start on them but routes never go through them.
+    - is_static: True, the routes only depend on the map so they can be cached for as long as the model runs.
+    '''
+    is_static = True
+
+    def __init__(self, street_graph, destinations: list[tuple[int, int]], corners: set[tuple[int, int]], arrays: dict[str, np.ndarray] | None = None):
+        self.street_graph = street_graph
+        self.corners = corners
+
+        self.goal_index = {}
+        for goal in destinations: # The destinations list can contain repeated coordinates
+            if goal in street_graph and goal not in self.goal_index:
+                self.goal_index[goal] = len(self.goal_index)
+
+        if arrays is not None:
+            self.next_hop = arrays["next_hop"]
+            self.distance = arrays["distance"]
+            return
+
+        node_count = len(street_graph)
+        is_corner = np.zeros(node_count, dtype=bool)
+        for corner in corners:
+            if street_graph.node_id(corner) >= 0:
+                is_corner[street_graph.node_id(corner)] = True
+
+        # Edges of the graph, the neighbors of every node keep the order of the street graph since it decides which shortest path is taken
+        sources = street_graph.edge_sources()
+        targets = street_graph.neighbors
+        reverse_offsets, reverse_sources = street_graph.reverse()
+        reverse_offsets, reverse_sources, corner_list = reverse_offsets.tolist(), reverse_sources.tolist(), is_corner.tolist()
+
+        self.next_hop = np.full((len(self.goal_index), node_count), -1, dtype=np.int32)
+        self.distance = np.full((len(self.goal_index), node_count), -1, dtype=np.int32)
+
+        for goal, row in self.goal_index.items():
+            distance = np.array(self.reverse_bfs(reverse_offsets, reverse_sources, corner_list, street_graph.node_id(goal)), dtype=np.int32)
+            # The first neighbor one step closer is the one Car.bfs would have expanded first
+            closer = (distance[sources] >= 1) & (distance[targets] == distance[sources] - 1) & ~is_corner[targets]
+            edges = np.flatnonzero(closer)
+            first = np.ones(len(edges), dtype=bool)
+            first[1:] = sources[edges[1:]] != sources[edges[:-1]] # Edges are sorted by their source node
+            self.next_hop[row, sources[edges[first]]] = targets[edges[first]]
+            self.distance[row] = distance
+
+
+    def arrays(self) -> dict[str, np.ndarray]:
+        '''Returns the routing arrays, to be cached with the compiled map.'''
+        return {"next_hop": self.next_hop, "distance": self.distance}
+
+
+    def reverse_bfs(self, reverse_offsets: list[int], reverse_sources: list[int], is_corner: list[bool], goal: int) -> list[int]:
+        '''Calculates the distance from every node to the goal by running the Breadth First Search algorithm backwards from the goal.'''
+        distance = [-1] * len(is_corner)
+        distance[goal] = 0
+        if is_corner[goal]: # Corners can't be reached by any route
+            return distance
+
+        queue = deque([goal])
+        while queue:
+            current = queue.popleft()
+            for previous in reverse_sources[reverse_offsets[current]:reverse_offsets[current + 1]]:
+                if distance[previous] == -1:
+                    distance[previous] = distance[current] + 1
+                    if not is_corner[previous]: # A corner can only be the start of a route, so we don't keep expanding from it
+                        queue.append(previous)
+        return distance
+
+
+    def route_length(self, start: tuple[int, int], goal: tuple[int, int]) -> int | None:
+        '''Returns the number of cells of the shortest route between start and goal, or None if there is no route.'''
+        if start == goal:
+            return 0
+        row = self.goal_index.get(goal)
+        node = self.street_graph.node_id(start)
+        if row is None or node < 0:
+            return None
+        distance = int(self.distance[row, node])
+        return distance if distance > 0 else None
+
+
+    def route_cost(self, start: tuple[int, int], goal: tuple[int, int]) -> int | None:
+        '''Returns the cost of the shortest route between start and goal, which for this table is its length.'''
+        return self.route_length(start, goal)
+
+
+    def path_cost(self, route: Route, start: int = 0) -> int:
+        '''Returns the cost of following the given route from its start index, which for this table is the number of cells left.'''
+        return len(route) - start
+
+
+    def route(self, start: tuple[int, int], goal: tuple[int, int]) -> Route | None:
+        '''Returns the same route Car.bfs would find, with the coordinates and the direction the car faces on each of them, or None if there is no route.'''
+        if start == goal:
+            return EMPTY_ROUTE
+        length = self.route_length(start, goal)
+        if length is None:
+            return None
+
+        next_hop = self.next_hop[self.goal_index[goal]]
+        node = self.street_graph.node_id(start)
+        nodes = []
+        for _ in range(length): # Following the next hops until the goal is reached
+            node = int(next_hop[node])
+            nodes.append(node)
+        return Route.from_nodes(self.street_graph, start, nodes)
+
+
+class CongestionRouter:
+    '''
+    Congestion aware router. Finds routes with the A* algorithm over the street graph, where the cost of entering a cell depends on the live state of the grid.
+    Attributes:
+    - occupancy: occupancy index of the model, used to calculate the cost of each cell.
+    - street_graph: street graph of the map, its neighbor arrays are copied to lists once since A* reads them one node at a time.
+    - corners: set of the map corners, cars can start on them but routes never go through them.
+    - current_step: function returning the current step of the model, searches are only reused within the same step.
+    - car_cost: extra cost of entering a cell that is occupied by a car.
+    - light_cost: extra cost of entering a traffic light that is red or yellow.
+    - last_search: start, goal, step and route of the last cost query, so asking for the cost and then for the route of the same search doesn't run A* twice.
+    - nodes_expanded: number of nodes expanded by the last search.
+    - is_static: False, the routes depend on the traffic so they are only valid on the step they were found.
+    '''
+    is_static = False
+
+    def __init__(self, occupancy, street_graph, corners: set[tuple[int, int]], current_step, car_cost: float = 3, light_cost: float = 5):
+        self.occupancy = occupancy
+        self.street_graph = street_graph
+        self.offsets = street_graph.offsets.tolist()
+        self.neighbors = street_graph.neighbors.tolist()
+        self.coords = street_graph.coord_table() # Coordinates by node id
+        self.corner_nodes = {street_graph.node_id(corner) for corner in corners}
+        self.current_step = current_step
+        self.corners = corners
+        self.car_cost = car_cost
+        self.light_cost = light_cost
+        self.last_search = None
+        self.nodes_expanded = 0
+
+
+    def fork(self, occupancy, current_step) -> "CongestionRouter":
+        '''Returns a router for a forked model, sharing the street graph lists with this one and reading the given occupancy index.'''
+        router = copy.copy(self)
+        router.occupancy = occupancy
+        router.current_step = current_step
+        router.last_search = None
+        router.nodes_expanded = 0
+        return router
+
+
+    def cell_cost(self, cell: tuple[int, int]) -> float:
+        '''Returns the cost of entering a cell, every cell costs 1 plus the penalties for the cars and traffic lights on it.'''
+        cost = 1
+        if self.occupancy.has_car(cell):
+            cost += self.car_cost
+        traffic_light = self.occupancy.get_traffic_light(cell)
+        if traffic_light is not None and (traffic_light.is_red or traffic_light.is_yellow):
+            cost += self.light_cost
+        return cost
+
+
+    def search(self, start: tuple[int, int], goal: tuple[int, int]) -> tuple[Route, float] | tuple[None, None]:
+        '''
+        Finds the cheapest route between start and goal with the A* algorithm, using the Manhattan distance as heuristic.
+        Since entering any cell costs at least 1, the heuristic never overestimates and the route found is the cheapest one.
+        '''
+        if start == goal:
+            route, cost = EMPTY_ROUTE, 0
+        else:
+            route, cost = None, None
+            offsets, neighbors, coords, corner_nodes = self.offsets, self.neighbors, self.coords, self.corner_nodes
+            start_node, goal_node = self.street_graph.node_id(start), self.street_graph.node_id(goal)
+            counter = 0 # Tie breaker for the heap, so equal costs are expanded in insertion order
+            queue = [(abs(goal[0] - start[0]) + abs(goal[1] - start[1]), counter, start_node)]
+            best_cost = {start_node: 0}
+            parent = {}
+            closed = set()
+
+            while queue and start_node >= 0:
+                _, _, current = heapq.heappop(queue)
+                if current == goal_node:
+                    # Rebuild the path once the goal is reached
+                    path = []
+                    while current != start_node:
+                        path.append(current)
+                        current = parent[current]
+                    path.reverse()
+                    route = Route.from_nodes(self.street_graph, start, path)
+                    cost = best_cost[goal_node]
+                    break
+
+                if current in closed:
+                    continue
+                closed.add(current)
+
+                for neighbor in neighbors[offsets[current]:offsets[current + 1]]:
+                    if neighbor in corner_nodes or neighbor in closed:
+                        continue
+                    neighbor_coord = coords[neighbor]
+                    neighbor_cost = best_cost[current] + self.cell_cost(neighbor_coord)
+                    if neighbor_cost < best_cost.get(neighbor, float("inf")):
+                        best_cost[neighbor] = neighbor_cost
+                        parent[neighbor] = current
+                        counter += 1
+                        heapq.heappush(queue, (neighbor_cost + abs(goal[0] - neighbor_coord[0]) + abs(goal[1] - neighbor_coord[1]), counter, neighbor))
+            self.nodes_expanded = len(closed)
+
+        return route, cost
+
+
+    def route_cost(self, start: tuple[int, int], goal: tuple[int, int]) -> float | None:
+        '''Returns the cost of the cheapest route between start and goal with the current traffic, or None if there is no route.'''
+        route, cost = self.search(start, goal)
+        self.last_search = ((start, goal, self.current_step()), route) # Kept in case the car takes this route right away
+        return cost
+
+
+    def path_cost(self, route: Route, start: int = 0) -> float:
+        '''Returns the cost of following the given route from its start index with the current traffic.'''
+        return sum(self.cell_cost(cell) for cell in route.cells[start:])
+
+
+    def route(self, start: tuple[int, int], goal: tuple[int, int]) -> Route | None:
+        '''Returns the cheapest route between start and goal with the current traffic, with the coordinates and the direction the car faces on each of them, or None if there is no route.'''
+        if self.last_search and self.last_search[0] == (start, goal, self.current_step()):
+            route = self.last_search[1]
+        else:
+            route, _ = self.search(start, goal)
+        self.last_search = None # The grid changes once the car moves, so a search is never reused after this
+        return route
+
+
+class RouteCache:
+    '''
+    Route cache shared by every car of a model. Keeps the last routes found by the router by their start and goal, since the cars leave from the same four corners towards the same destinations and would otherwise search the same routes again.
+    Routes are never changed, every car keeps the index of its next cell on the route instead of copying it.
+    The routes of a static router (the routing table) are kept until they are the least recently used ones, the routes of a router that depends on the traffic are dropped at the beginning of every step.
+    Attributes:
+    - router: router that finds the routes that are not in the cache.
+    - capacity: maximum number of routes kept.
+    - routes: ordered dictionary of the routes by (start, goal), from the least to the most recently used, None when there is no route.
+    - hits: number of routes found in the cache.
+    - misses: number of routes asked to the router.
+    - evictions: number of routes dropped because the cache was full.
+    '''
+    def __init__(self, router, capacity: int = 4096):
+        if capacity < 1:
+            raise ValueError("The route cache must keep at least one route")
+        self.router = router
+        self.capacity = capacity
+        self.routes = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+
+    def route(self, start: tuple[int, int], goal: tuple[int, int]) -> Route | None:
+        '''Returns the route between start and goal, or None if there is no route.'''
+        key = (start, goal)
+        if key in self.routes:
+            self.hits += 1
+            self.routes.move_to_end(key)
+            return self.routes[key]
+        self.misses += 1
+        route = self.router.route(start, goal)
+        self.routes[key] = route
+        if len(self.routes) > self.capacity:
+            self.routes.popitem(last=False)
+            self.evictions += 1
+        return route
+
+
+    def begin_step(self):
+        '''Drops the routes found on the previous step when they depend on the traffic.'''
+        if not self.router.is_static:
+            self.routes.clear()
+
+
+    def fork(self, router) -> "RouteCache":
+        '''Returns a cache for the router of a forked model, starting with the same routes and counters, which can be shared since they are never changed.'''
+        cache = copy.copy(self)
+        cache.router = router
+        cache.routes = OrderedDict(self.routes)
+        return cache
+
+
+    def stats(self) -> dict:
+        requests = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions, "size": len(self.routes), "hit_rate": self.hits / requests if requests else 0.0}
+
+
+    def prometheus(self, prefix: str = "traffic_") -> str:
+        '''Returns the counters of the cache in the Prometheus text exposition format, to be added to the metrics of the model.'''
+        lines = []
+        for name, kind, help_text, value in [
+            ("route_cache_hits_total", "counter", "Routes found in the route cache.", self.hits),
+            ("route_cache_misses_total", "counter", "Routes asked to the router because they weren't in the route cache.", self.misses),
+            ("route_cache_evictions_total", "counter", "Routes dropped from the full route cache.", self.evictions),
+            ("route_cache_size", "gauge", "Routes kept in the route cache.", len(self.routes)),
+        ]:
+            lines += [f"# HELP {prefix}{name} {help_text}", f"# TYPE {prefix}{name} {kind}", f"{prefix}{name} {value}"]
+        return "\n".join(lines) + "\n"
@@ -5,6 +5,7 @@
 
 from agent import *
 from model import CityModel
+from read_map import load_map
 from mesa.visualization import CanvasGrid, BarChartModule
 from mesa.visualization import ModularServer
 
@@ -38,15 +39,12 @@ def agent_portrayal(agent):
 
     return portrayal
 
-width = 0
-height = 0
+map_file = '../map_files/2024_base.txt'
+compiled_map = load_map(map_file) # Getting the map dimensions from the compiled map, which the model loads from the same cache
+width = compiled_map.width
+height = compiled_map.height
 
-with open('../map_files/2024_base.txt') as baseFile: # Getting the map dimensions
-    lines = baseFile.readlines()
-    width = len(lines[0])-1
-    height = len(lines)
-
-model_params = {"place_cars_interval": 1}  # Interval for placing cars
+model_params = {"place_cars_interval": 1, "map_file": map_file}  # Interval for placing cars
 
 print(width, height)
 grid = CanvasGrid(agent_portrayal, width, height, 500, 500)
@@ -0,0 +1,180 @@
+# Marcos Dayan Mann A01782876
+# José Manuel García Zumaya A01784238
+# 20 noviembre 2024
+
+from collections import OrderedDict
+from concurrent.futures import Future
+from traffic_base.checkpoint import CheckpointWriter, load_checkpoint
+import os
+import re
+import threading
+import uuid
+import numpy as np
+
+CAR_MEMORY = 2048 # Estimated bytes of a Car agent with its route, used for the memory estimate of a model
+CELL_MEMORY = 150 # Estimated bytes of a cell of the MultiGrid and the street graph
+
+class Session:
+    '''
+    Simulation session. Holds one model and everything the server keeps for it.
+    Attributes:
+    - session_id: string identifying the session, sent by the clients on every request.
+    - model: model of the session.
+    - lock: lock held while the model is stepped or read, so the requests and the stream of the session don't step it at the same time.
+    - stream: simulation stream of the model (a SteppingLoop on the asyncio server), or None.
+    - static_layers: serialized static layers of the model, filled by the server.
+    - current_step: number of steps requested with /update.
+    - checkpoint_interval: the model is checkpointed every this many steps, 0 when it isn't.
+    '''
+    def __init__(self, session_id: str, model):
+        self.session_id = session_id
+        self.model = model
+        self.lock = threading.Lock()
+        self.stream = None
+        self.static_layers = {}
+        self.current_step = 0
+        self.checkpoint_interval = 0
+
+
+    def memory_usage(self) -> int:
+        '''
+        Estimates the bytes used by the model alone: the NumPy arrays it keeps plus a fixed amount per grid cell and per car.
+        Arrays mapped from the map cache are left out, every model of the same map shares them (see shared_arrays).
+        '''
+        model = self.model
+        arrays = [
+            model.routing_table.next_hop, model.routing_table.distance,
+            model.occupancy.road_direction, model.occupancy.light_id, model.occupancy.is_destination, model.occupancy.is_obstacle, model.occupancy.cars,
+        ]
+        if model.vector_engine is not None: # The partitioned engine keeps its cars on its worker processes
+            arrays += [getattr(model.vector_engine, name, None) for name in ("car_id", "node", "destination", "cursor")]
+        array_bytes = sum(array.nbytes for array in arrays if isinstance(array, np.ndarray) and not isinstance(array, np.memmap))
+        return array_bytes + len(model.car_states.buffer) + CELL_MEMORY * model.width * model.height + CAR_MEMORY * len(model.cars)
+
+
+    def shared_arrays(self) -> dict[str, int]:
+        '''Returns the bytes of the routing table arrays the model maps from the map cache, by file name, so the registry counts each file once.'''
+        arrays = (self.model.routing_table.next_hop, self.model.routing_table.distance)
+        return {array.filename: array.nbytes for array in arrays if isinstance(array, np.memmap)}
+
+
+class SessionRegistry:
+    '''
+    Session registry. Keeps several independent models in one server process, identified by their session id.
+    When there are more than max_sessions sessions or their estimated memory goes over memory_limit, the least recently used sessions are evicted.
+    The routing tables mapped from the map cache are counted once, however many sessions use the same map.
+    Models are stepped on the thread of the request or stream that asks for the step, with the lock of their session held, so different sessions step at the same time.
+    Attributes:
+    - max_sessions: maximum number of sessions kept.
+    - memory_limit: maximum estimated bytes of all the models together.
+    - sessions: ordered dictionary of the sessions by id, from the least to the most recently used.
+    - latest: id of the last session created, used by clients that don't send a session id.
+    - checkpoint_folder: folder where the checkpoints are saved, one per session named by its id.
+    - checkpoints: writer that saves the checkpoints on a background thread.
+    '''
+    def __init__(self, max_sessions: int = 8, memory_limit: int = 1024 * 1024 * 1024, checkpoint_folder: str = "checkpoints"):
+        if max_sessions < 1:
+            raise ValueError("The registry must keep at least one session")
+        self.max_sessions = max_sessions
+        self.memory_limit = memory_limit
+        self.sessions = OrderedDict()
+        self.lock = threading.Lock()
+        self.latest = None
+        self.checkpoint_folder = checkpoint_folder
+        self.checkpoints = CheckpointWriter()
+
+
+    def create(self, model, session_id: str | None = None) -> Session:
+        '''Adds a session for the given model, evicting the least recently used sessions if the limits are exceeded. A new id is used unless one is given.'''
+        session = Session(session_id or uuid.uuid4().hex, model)
+        with self.lock:
+            self.sessions[session.session_id] = session
+            self.latest = session.session_id
+            evicted = self.evict(keep=session.session_id)
+        for old_session in evicted:
+            self.close(old_session)
+        return session
+
+
+    def get(self, session_id: str | None) -> Session | None:
+        '''Returns the session with the given id, or the latest one if no id is given, and marks it as recently used.'''
+        with self.lock:
+            session_id = session_id or self.latest
+            session = self.sessions.get(session_id)
+            if session is not None:
+                self.sessions.move_to_end(session_id)
+            return session
+
+
+    def remove(self, session_id: str) -> bool:
+        with self.lock:
+            session = self.sessions.pop(session_id, None)
+            if self.latest == session_id:
+                self.latest = next(reversed(self.sessions), None)
+        if session is None:
+            return False
+        self.close(session)
+        return True
+
+
+    def evict(self, keep: str) -> list[Session]:
+        '''Removes the least recently used sessions until the limits are met, never removing the session being kept. Must be called with the lock held.'''
+        evicted = []
+        for session_id in list(self.sessions):
+            if len(self.sessions) <= self.max_sessions and self.total_memory() <= self.memory_limit:
+                break
+            if session_id == keep:
+                continue
+            evicted.append(self.sessions.pop(session_id))
+        return evicted
+
+
+    def total_memory(self) -> int:
+        '''Estimates the bytes used by the models of every session, with each shared file of the map cache counted once. Must be called with the lock held.'''
+        shared = {}
+        total = 0
+        for session in self.sessions.values():
+            total += session.memory_usage()
+            shared.update(session.shared_arrays())
+        return total + sum(shared.values())
+
+
+    def close(self, session: Session):
+        if session.stream is not None:
+            session.stream.stop()
+        with session.lock:
+            session.model.close()
+
+
+    def step(self, session: Session):
+        '''Steps the model of the session on the calling thread and checkpoints it when it's due, the caller must hold the session lock.'''
+        session.model.step()
+        if session.checkpoint_interval and session.model.schedule.steps % session.checkpoint_interval == 0:
+            self.checkpoint(session)
+
+
+    def checkpoint_path(self, session_id: str) -> str:
+        if not re.fullmatch(r"[0-9a-f]{32}", session_id): # Only ids made by the registry, so they can't point outside the folder
+            raise ValueError(f"Invalid session id '{session_id}'")
+        return os.path.join(self.checkpoint_folder, f"{session_id}.npz")
+
+
+    def checkpoint(self, session: Session) -> Future:
+        '''Starts saving the state of the session's model, the caller must hold the session lock. The file is written on a background thread.'''
+        os.makedirs(self.checkpoint_folder, exist_ok=True)
+        return self.checkpoints.submit(session.model, self.checkpoint_path(session.session_id), {"current_step": session.current_step})
+
+
+    def restore(self, session_id: str) -> Session:
+        '''Creates a session from the checkpoint of the given session, keeping its id if there is no session with it, e.g. after the server restarted.'''
+        model, metadata = load_checkpoint(self.checkpoint_path(session_id))
+        with self.lock:
+            is_used = session_id in self.sessions
+        session = self.create(model, None if is_used else session_id)
+        session.current_step = metadata.get("current_step", 0)
+        return session
+
+
+    def memory_usage(self) -> int:
+        with self.lock:
+            return self.total_memory()
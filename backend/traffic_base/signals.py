@@ -0,0 +1,187 @@
+# Marcos Dayan Mann A01782876
+# José Manuel García Zumaya A01784238
+# 20 noviembre 2024
+
+from collections import deque
+import copy
+import numpy as np
+
+class SignalController:
+    '''
+    Traffic light controller. Keeps the state of every traffic light in NumPy arrays, groups the lights of each intersection and advances all of them at once every step.
+    Every light follows the same cycle as before (green, yellow, red, green...), the lights that start red ("s") and the ones that start green ("S") of an intersection alternate.
+    Attributes:
+    - mode: string with the timing mode, "fixed" keeps the configured interval and "adaptive" shortens or extends the green phase of an intersection depending on the cars waiting on its approaches.
+    - is_red: bool array flagging the red lights.
+    - is_yellow: bool array flagging the yellow lights.
+    - time_interval: int32 array with the time interval each light takes to change.
+    - time_to_change: int32 array with the time left to change each light.
+    - group: int32 array with the intersection of each light, lights on touching cells (diagonals included) belong to the same intersection.
+    - positions: list of the position of each light.
+    - min_green: number of steps a green phase lasts at least before the adaptive mode can cut it.
+    - max_extension: number of steps the adaptive mode can extend a green phase.
+    - queue_depth: number of cells before a light where waiting cars are counted as its queue.
+    - queue_length: int32 array with the cars waiting before each light on the last step.
+    - approach: int32 array with the approach of each light, the lights of an intersection that start with the same color are one approach (e.g. the lanes of a street) and are green at the same time.
+    - approach_cells: int64 array with the queue cells of every approach, each cell once even if it leads to several of its lights.
+    - approach_of_cell: int32 array with the approach of every cell of approach_cells.
+    - changed: int64 array with the ids of the lights that changed color on the last step, read by the event engine to wake the cars waiting for them.
+    '''
+    def __init__(self, mode: str = "fixed", min_green: int = 3, max_extension: int = 10, queue_depth: int = 3):
+        if mode not in ("fixed", "adaptive"):
+            raise ValueError(f"Unknown signal mode '{mode}', expected 'fixed' or 'adaptive'")
+        self.mode = mode
+        self.min_green = min_green
+        self.max_extension = max_extension
+        self.queue_depth = queue_depth
+        self.positions = []
+        self.initial_red = []
+        self.initial_interval = []
+
+
+    def add_light(self, pos: tuple[int, int], is_red: bool, time_interval: int) -> int:
+        '''Adds a light to the controller while the map is read and returns its light id.'''
+        self.positions.append(pos)
+        self.initial_red.append(is_red)
+        self.initial_interval.append(time_interval)
+        return len(self.positions) - 1
+
+
+    def build(self, street_graph, occupancy):
+        '''Creates the state arrays once every light was added, groups the lights by intersection and finds the cells where their queues are counted.'''
+        light_count = len(self.positions)
+        self.is_red = np.array(self.initial_red, dtype=bool)
+        self.is_yellow = np.zeros(light_count, dtype=bool)
+        self.time_interval = np.array(self.initial_interval, dtype=np.int32)
+        self.time_to_change = self.time_interval.copy()
+        self.queue_length = np.zeros(light_count, dtype=np.int32)
+        self.changed = np.zeros(0, dtype=np.int64)
+        self.cell_cars = occupancy.cars.reshape(-1)
+
+        # Grouping the lights with a BFS over the touching light cells
+        light_ids = {pos: light_id for light_id, pos in enumerate(self.positions)}
+        self.group = np.full(light_count, -1, dtype=np.int32)
+        group_count = 0
+        for light_id, pos in enumerate(self.positions):
+            if self.group[light_id] >= 0:
+                continue
+            self.group[light_id] = group_count
+            queue = deque([pos])
+            while queue:
+                x, y = queue.popleft()
+                for dx in (-1, 0, 1):
+                    for dy in (-1, 0, 1):
+                        neighbor = light_ids.get((x + dx, y + dy))
+                        if neighbor is not None and self.group[neighbor] < 0:
+                            self.group[neighbor] = group_count
+                            queue.append(self.positions[neighbor])
+            group_count += 1
+        self.group_count = group_count
+
+        # Every light of an intersection changes at the same time, so they must share the interval
+        for group in range(group_count):
+            members = self.group == group
+            self.time_interval[members] = self.time_interval[members].max()
+        self.time_to_change = self.time_interval.copy()
+        self.extension = np.zeros(group_count, dtype=np.int32)
+
+        # Queue cells of every light: the street cells that lead to it, up to queue_depth cells away
+        reverse_offsets, reverse_sources = street_graph.reverse()
+        reverse_offsets, reverse_sources = reverse_offsets.tolist(), reverse_sources.tolist()
+        node_cell = (street_graph.node_x.astype(np.int64) * occupancy.height + street_graph.node_y).tolist() # Index of every node on the flattened occupancy layers
+        light_nodes = {street_graph.node_id(pos) for pos in self.positions}
+        queue_cells, queue_lights = [], []
+        for light_id, pos in enumerate(self.positions):
+            node = street_graph.node_id(pos)
+            visited = {node}
+            frontier = [node]
+            for _ in range(self.queue_depth):
+                frontier = [previous for current in frontier for previous in reverse_sources[reverse_offsets[current]:reverse_offsets[current + 1]] if previous not in visited and previous not in light_nodes]
+                visited.update(frontier)
+                for previous in frontier:
+                    queue_cells.append(node_cell[previous])
+                    queue_lights.append(light_id)
+        self.queue_cells = np.array(queue_cells, dtype=np.int64)
+        self.queue_lights = np.array(queue_lights, dtype=np.int32)
+
+        # Approaches, a cell next to two lanes of a street is counted once on their approach
+        self.approach = self.group * 2 + np.array(self.initial_red, dtype=np.int32)
+        approach_cells = np.unique(np.stack([self.approach[self.queue_lights], self.queue_cells]).reshape(2, -1), axis=1)
+        self.approach_of_cell = approach_cells[0].astype(np.int32)
+        self.approach_cells = approach_cells[1]
+
+
+    def step(self):
+        '''Advances every light one step.'''
+        self.queue_length = np.bincount(self.queue_lights, weights=self.cell_cars[self.queue_cells], minlength=len(self.positions)).astype(np.int32)
+        if self.mode == "adaptive":
+            self.adapt_timings()
+
+        # Same transitions Traffic_Light.step used to make, for every light at once
+        changing = self.time_to_change < 1
+        to_red = ~self.is_red & changing
+        to_green = self.is_red & changing
+        to_yellow = ~self.is_red & ~changing & (self.time_to_change < 2)
+        self.changed = np.flatnonzero(to_red | to_green | (to_yellow & ~self.is_yellow))
+
+        self.is_red[to_red] = True
+        self.is_yellow[to_red] = False
+        self.is_red[to_green] = False
+        self.time_to_change[changing] = self.time_interval[changing]
+        self.is_yellow[to_yellow] = True
+        self.time_to_change -= 1
+
+        if self.mode == "adaptive":
+            self.extension[np.unique(self.group[changing])] = 0 # A new phase starts without extensions
+
+
+    def adapt_timings(self):
+        '''
+        Changes the time left of every intersection depending on the queues of its approaches. The lights of an intersection share their timer, so the changes are made by group.
+        A green phase ends early, after min_green steps, when more cars wait on the red approaches than on the green ones, and a green phase about to end is extended while more cars wait on the green approaches.
+        '''
+        green = ~self.is_red & ~self.is_yellow
+        approach_count = self.group_count * 2
+        approach_queue = np.bincount(self.approach_of_cell, weights=self.cell_cars[self.approach_cells], minlength=approach_count)
+        green_approach = np.bincount(self.approach, weights=green, minlength=approach_count) > 0
+        red_approach = np.bincount(self.approach, weights=self.is_red, minlength=approach_count) > 0
+        green_queue = (approach_queue * green_approach).reshape(-1, 2).sum(axis=1)
+        red_queue = (approach_queue * red_approach).reshape(-1, 2).sum(axis=1)
+        has_green = green_approach.reshape(-1, 2).any(axis=1)
+
+        time_to_change = np.zeros(self.group_count, dtype=np.int32)
+        time_to_change[self.group] = self.time_to_change # Same value for every light of a group
+        interval = np.zeros(self.group_count, dtype=np.int32)
+        interval[self.group] = self.time_interval
+        green_time = interval - time_to_change
+
+        cut = has_green & (red_queue > green_queue) & (green_time >= self.min_green) & (time_to_change > 1)
+        extend = has_green & (green_queue > red_queue) & (time_to_change == 2) & (self.extension < self.max_extension)
+
+        time_to_change[cut] = 1 # The green lights turn yellow on this step
+        time_to_change[extend] += 1
+        self.extension[extend] += 1
+        self.time_to_change = time_to_change[self.group]
+
+
+    def fork(self, occupancy) -> "SignalController":
+        '''Returns a controller with a copy of the state of every light, sharing the groups and queue cells with this one and counting the cars of the given occupancy index.'''
+        controller = copy.copy(self)
+        controller.is_red = self.is_red.copy()
+        controller.is_yellow = self.is_yellow.copy()
+        controller.time_to_change = self.time_to_change.copy()
+        controller.queue_length = self.queue_length.copy()
+        controller.cell_cars = occupancy.cars.reshape(-1)
+        controller.extension = self.extension.copy()
+        return controller
+
+
+    def color_codes(self) -> np.ndarray:
+        '''Returns the color code of every light: 0 green, 1 yellow and 2 red.'''
+        return (2 * self.is_red + self.is_yellow).astype(np.int8)
+
+
+    def get_color(self, light_id: int) -> str:
+        if self.is_red[light_id]:
+            return "red"
+        return "yellow" if self.is_yellow[light_id] else "green"
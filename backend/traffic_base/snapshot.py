@@ -0,0 +1,163 @@
+# Marcos Dayan Mann A01782876
+# José Manuel García Zumaya A01784238
+# 20 noviembre 2024
+
+import numpy as np
+
+HEADER_SIZE = 16 # uint32 count, uint32 capacity, uint32 step and uint32 reserved
+
+class CarStateBuffer:
+    '''
+    Car state buffer. Keeps the id, position and orientation of every car packed in one binary buffer, updated every time a car is placed, moved or removed, so it can be sent to the client as it is.
+    Layout of the buffer (little endian), every column has room for capacity cars and only the first count values are valid:
+    - header: uint32 count, uint32 capacity, uint32 step, uint32 reserved.
+    - ids: int32 column with the unique id of each car, sent as "c_<id>".
+    - x, z: int16 columns with the position of each car.
+    - orientation_x, orientation_z: int8 columns with the direction each car is facing.
+    Attributes:
+    - buffer: bytearray with the whole layout, the columns are NumPy views over it.
+    - slots: dictionary mapping the unique id of every car to its position in the columns.
+    - keys: list of the unique id of the car on each position of the columns.
+    '''
+    def __init__(self, capacity: int = 256):
+        self.slots = {}
+        self.keys = []
+        self.count = 0
+        self.allocate(capacity)
+
+
+    def allocate(self, capacity: int):
+        '''Creates a buffer with room for capacity cars, copying the cars of the current one.'''
+        old_columns = None if self.count == 0 else [column[:self.count].copy() for column in self.columns()]
+        self.capacity = capacity
+        self.buffer = bytearray(HEADER_SIZE + 10 * capacity)
+        self.header = np.frombuffer(self.buffer, dtype='<u4', count=4)
+        self.ids = np.frombuffer(self.buffer, dtype='<i4', count=capacity, offset=HEADER_SIZE)
+        self.x = np.frombuffer(self.buffer, dtype='<i2', count=capacity, offset=HEADER_SIZE + 4 * capacity)
+        self.z = np.frombuffer(self.buffer, dtype='<i2', count=capacity, offset=HEADER_SIZE + 6 * capacity)
+        self.orientation_x = np.frombuffer(self.buffer, dtype='<i1', count=capacity, offset=HEADER_SIZE + 8 * capacity)
+        self.orientation_z = np.frombuffer(self.buffer, dtype='<i1', count=capacity, offset=HEADER_SIZE + 9 * capacity)
+        if old_columns:
+            for column, values in zip(self.columns(), old_columns):
+                column[:self.count] = values
+        self.header[0] = self.count
+        self.header[1] = capacity
+
+
+    def copy(self) -> "CarStateBuffer":
+        '''Returns a buffer with the same cars, used when a model is forked.'''
+        states = CarStateBuffer(self.capacity)
+        states.buffer[:] = self.buffer # Same size, so the columns keep viewing the new buffer
+        states.slots = dict(self.slots)
+        states.keys = list(self.keys)
+        states.count = self.count
+        return states
+
+
+    def columns(self) -> list[np.ndarray]:
+        return [self.ids, self.x, self.z, self.orientation_x, self.orientation_z]
+
+
+    def add(self, key, car_id: int, pos: tuple[int, int], direction: tuple[int, int]):
+        '''Adds a car at the end of the columns.'''
+        if self.count == self.capacity:
+            self.allocate(2 * self.capacity)
+        slot = self.count
+        self.slots[key] = slot
+        self.keys.append(key)
+        self.ids[slot] = car_id
+        self.count += 1
+        self.header[0] = self.count
+        self.update(key, pos, direction)
+
+
+    def update(self, key, pos: tuple[int, int], direction: tuple[int, int]):
+        slot = self.slots[key]
+        self.x[slot], self.z[slot] = pos
+        self.orientation_x[slot], self.orientation_z[slot] = direction
+
+
+    def remove(self, key):
+        '''Removes a car, moving the last car of the columns to its place so they stay packed.'''
+        slot = self.slots.pop(key)
+        last = self.count - 1
+        if slot != last:
+            for column in self.columns():
+                column[slot] = column[last]
+            self.keys[slot] = self.keys[last]
+            self.slots[self.keys[slot]] = slot
+        self.keys.pop()
+        self.count = last
+        self.header[0] = self.count
+
+
+    def write_all(self, ids: np.ndarray, x: np.ndarray, z: np.ndarray, orientation_x: np.ndarray, orientation_z: np.ndarray):
+        '''Replaces every car at once, used by the vectorized engine which already keeps its cars in arrays.'''
+        count = len(ids)
+        if count > self.capacity:
+            self.count = 0
+            self.allocate(max(count, 2 * self.capacity))
+        self.slots.clear()
+        self.keys.clear()
+        for column, values in zip(self.columns(), (ids, x, z, orientation_x, orientation_z)):
+            column[:count] = values
+        self.count = count
+        self.header[0] = count
+
+
+    def set_step(self, step: int):
+        self.header[2] = step
+
+
+    def payload(self) -> memoryview:
+        '''Returns a view of the whole buffer, without copying it.'''
+        return memoryview(self.buffer)
+
+
+    def states(self) -> list[tuple[str, tuple[int, int], tuple[int, int]]]:
+        '''Returns the id, position and direction of every car.'''
+        count = self.count
+        return list(zip(
+            [f"c_{car_id}" for car_id in self.ids[:count].tolist()],
+            zip(self.x[:count].tolist(), self.z[:count].tolist()),
+            zip(self.orientation_x[:count].tolist(), self.orientation_z[:count].tolist()),
+        ))
+
+def read_payload(payload: bytes) -> list[np.ndarray]:
+    '''Returns the valid part of every column of a car state payload (ids, x, z, orientation x and orientation z), as views over it.'''
+    count, capacity = np.frombuffer(payload, dtype='<u4', count=2).tolist()
+    return [
+        np.frombuffer(payload, dtype='<i4', count=count, offset=HEADER_SIZE),
+        np.frombuffer(payload, dtype='<i2', count=count, offset=HEADER_SIZE + 4 * capacity),
+        np.frombuffer(payload, dtype='<i2', count=count, offset=HEADER_SIZE + 6 * capacity),
+        np.frombuffer(payload, dtype='<i1', count=count, offset=HEADER_SIZE + 8 * capacity),
+        np.frombuffer(payload, dtype='<i1', count=count, offset=HEADER_SIZE + 9 * capacity),
+    ]
+
+class StepSnapshot:
+    '''
+    Step snapshot. Copy of what the clients read of a model after a step, taken while the model is locked and read afterwards without the lock, so reads never wait for the step being run.
+    Nothing on it changes after it is created, except the cache of the responses built from it.
+    Attributes:
+    - step: step of the model's scheduler.
+    - payload: bytes of the car state buffer, with its layout.
+    - light_states: tuple with the color code of every traffic light (0 green, 1 yellow, 2 red).
+    - cache: dictionary with the responses already built from the snapshot, by name, so each one is built once.
+    '''
+    __slots__ = ("step", "payload", "light_states", "cache")
+
+    def __init__(self, model):
+        self.step = model.schedule.steps
+        self.payload = bytes(model.car_states.payload())
+        self.light_states = tuple(model.signals.color_codes().tolist())
+        self.cache = {}
+
+
+    def car_states(self) -> list[tuple[str, tuple[int, int], tuple[int, int]]]:
+        '''Returns the id, position and direction of every car, like CarStateBuffer.states().'''
+        ids, x, z, orientation_x, orientation_z = read_payload(self.payload)
+        return list(zip(
+            [f"c_{car_id}" for car_id in ids.tolist()],
+            zip(x.tolist(), z.tolist()),
+            zip(orientation_x.tolist(), orientation_z.tolist()),
+        ))
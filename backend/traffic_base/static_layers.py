@@ -0,0 +1,53 @@
+# Marcos Dayan Mann A01782876
+# José Manuel García Zumaya A01784238
+# 20 noviembre 2024
+
+from traffic_base.agent import Road, Obstacle, Destination
+import hashlib
+import json
+
+def build_static_layers(model) -> dict[str, tuple[bytes, str]]:
+    '''
+    Serializes once the layers that don't change after the model is created: roads, buildings, destinations, obstacles (always empty, like /getObstacles always returned) and the geometry of the traffic lights.
+    Returns every layer by its name as JSON bytes with its ETag, the hash of the contents, so the same map always has the same ETag. Used by both servers.
+    '''
+    # Orientations:
+    # (1, 0, 0) -> Right
+    # (-1, 0, 0) -> Left
+    # (0, 0, 1) -> Up
+    # (0, 0, -1) -> Down
+    road_positions = []
+    for road_id, (x, z), agent in model.get_static_cells(Road):
+        road_positions.append({
+            "id": road_id,
+            "position": {
+                "x": x,
+                "y": 1,  # Altura constante para WebGL
+                "z": z
+            },
+            "orientation": {
+                "x": agent.orientation[0],
+                "y": 0,
+                "z": agent.orientation[1]
+            }
+        })
+
+    building_positions = [{"id": building_id, "x": x, "y": 1, "z": z} for building_id, (x, z), _ in model.get_static_cells(Obstacle)]
+    destination_positions = [{"id": destination_id, "x": x, "y": 1, "z": z} for destination_id, (x, z), _ in model.get_static_cells(Destination)]
+
+    # Solo la geometría de los semáforos, en el orden de su light id, que es el mismo del vector de estados de /getTrafficLightStates
+    traffic_light_positions = [{"id": str(agent.unique_id), "x": agent.pos[0], "y": 1, "z": agent.pos[1]} for agent in model.occupancy.traffic_lights]
+
+    layers = {
+        'road': {'positions': road_positions},
+        'buildings': {'positions': building_positions},
+        'destinations': {'positions': destination_positions},
+        'obstacles': {'positions': []}, # Siempre vacía, como antes: coord_iter da las listas de cada celda y no los agentes, así que ningún obstáculo pasaba el filtro
+        'trafficLights': {'positions': traffic_light_positions},
+    }
+
+    serialized = {}
+    for name, layer in layers.items():
+        body = json.dumps(layer, separators=(',', ':')).encode()
+        serialized[name] = (body, hashlib.sha1(body).hexdigest())
+    return serialized
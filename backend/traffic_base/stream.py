@@ -0,0 +1,355 @@
+# Marcos Dayan Mann A01782876
+# José Manuel García Zumaya A01784238
+# 20 noviembre 2024
+
+import asyncio
+import json
+import queue
+import threading
+import time
+import numpy as np
+from traffic_base.snapshot import StepSnapshot, read_payload
+
+class StateDiffer:
+    '''
+    State differ. Compares the cars and traffic lights of the model with the ones of the last step that was sent, so only what changed is sent to the clients.
+    Cars are read from the model's car state buffer and lights from the signal controller, both as arrays, so a step is compared without going through the agents.
+    Attributes:
+    - model: model whose state is compared.
+    - light_ids: list of the unique id of every traffic light, indexed by its light id.
+    - car_ids: int32 array with the sorted ids of the cars on the last step that was sent.
+    - car_rows: int16 array (cars x 4) with the x, z, orientation x and orientation z of those cars.
+    - light_codes: int8 array with the color code of every traffic light on that step (0 green, 1 yellow, 2 red).
+    - step: number of that step.
+    '''
+    def __init__(self, model):
+        self.model = model
+        self.light_ids = [str(light.unique_id) for light in model.occupancy.traffic_lights]
+        self.car_ids = np.zeros(0, dtype=np.int32)
+        self.car_rows = np.zeros((0, 4), dtype=np.int16)
+        self.light_codes = np.zeros(len(self.light_ids), dtype=np.int8)
+        self.light_codes[:] = -1 # So the first delta sends every light
+        self.step = model.schedule.steps
+
+
+    def read_cars(self) -> tuple[np.ndarray, np.ndarray]:
+        '''Returns the ids of the cars on the grid, sorted, and their rows.'''
+        car_states = self.model.car_states
+        count = car_states.count
+        ids = car_states.ids[:count]
+        rows = np.stack([car_states.x[:count], car_states.z[:count], car_states.orientation_x[:count], car_states.orientation_z[:count]], axis=1).astype(np.int16)
+        order = np.argsort(ids, kind="stable")
+        return ids[order], rows[order]
+
+
+    def read_lights(self) -> np.ndarray:
+        return self.model.signals.color_codes()
+
+
+    def car_list(self, ids: np.ndarray, rows: np.ndarray) -> list:
+        return [[f"c_{car_id}", *row] for car_id, row in zip(ids.tolist(), rows.tolist())]
+
+
+    def light_list(self, light_ids: np.ndarray, codes: np.ndarray) -> list:
+        return [[self.light_ids[light_id], code == 2, code == 1] for light_id, code in zip(light_ids.tolist(), codes[light_ids].tolist())]
+
+
+    def delta(self) -> dict:
+        '''
+        Returns what changed since the last call: cars that were placed, cars that moved or turned, cars that arrived and traffic lights that changed.
+        Cars are sent as [id, x, z, orientation x, orientation z] and lights as [id, is_red, is_yellow].
+        '''
+        ids, rows = self.read_cars()
+        light_codes = self.read_lights()
+
+        _, current, previous = np.intersect1d(ids, self.car_ids, assume_unique=True, return_indices=True)
+        moved = current[(rows[current] != self.car_rows[previous]).any(axis=1)]
+        is_new = np.ones(len(ids), dtype=bool)
+        is_new[current] = False
+        has_arrived = np.ones(len(self.car_ids), dtype=bool)
+        has_arrived[previous] = False
+        changed_lights = np.flatnonzero(light_codes != self.light_codes)
+
+        step = self.model.schedule.steps
+        delta = {
+            "step": step,
+            "spawned": self.car_list(ids[is_new], rows[is_new]),
+            "moved": self.car_list(ids[moved], rows[moved]),
+            "arrived": [f"c_{car_id}" for car_id in self.car_ids[has_arrived].tolist()],
+            "lights": self.light_list(changed_lights, light_codes),
+        }
+        self.car_ids, self.car_rows, self.light_codes, self.step = ids, rows, light_codes, step
+        return delta
+
+
+    def rebase(self):
+        '''Takes the current state as the last one sent without building a delta, so the next delta only has the changes of one step.'''
+        self.car_ids, self.car_rows = self.read_cars()
+        self.light_codes = self.read_lights()
+        self.step = self.model.schedule.steps
+
+
+    def snapshot_of(self, step_snapshot: StepSnapshot) -> dict:
+        '''Returns every car and traffic light of a step snapshot, in the same format as snapshot(). It doesn't read the model, so the lock isn't needed.'''
+        ids, x, z, orientation_x, orientation_z = read_payload(step_snapshot.payload)
+        order = np.argsort(ids, kind="stable")
+        rows = np.stack([x, z, orientation_x, orientation_z], axis=1).astype(np.int16)
+        return {
+            "step": step_snapshot.step,
+            "cars": self.car_list(ids[order], rows[order]),
+            "lights": self.light_list(np.arange(len(self.light_ids)), np.array(step_snapshot.light_states, dtype=np.int8)),
+        }
+
+
+    def snapshot(self) -> dict:
+        '''Returns every car and traffic light as they were on the last delta, for clients that just subscribed.'''
+        return {
+            "step": self.step,
+            "cars": self.car_list(self.car_ids, self.car_rows),
+            "lights": self.light_list(np.arange(len(self.light_ids)), self.light_codes),
+        }
+
+
+class SimulationStream:
+    '''
+    Simulation stream. Advances the model on a background thread at a fixed tick rate while there are subscribers, and pushes the delta of every step to each of them as a Server-Sent Event.
+    A new subscriber first gets a snapshot of the whole state and then the deltas. Subscribers that fall behind are dropped, their client reconnects and starts again from a snapshot.
+    Attributes:
+    - model: model advanced by the stream.
+    - lock: lock held while the model is stepped or read, shared with the HTTP endpoints that use the same model.
+    - tick_rate: number of steps per second.
+    - max_pending: number of messages a subscriber can have waiting before it is dropped.
+    - subscribers: list with the message queue of every subscriber.
+    - step: function that advances the model one step, called with the lock held.
+    '''
+    def __init__(self, model, lock: threading.Lock, tick_rate: float = 2, max_pending: int = 64, step=None):
+        if tick_rate <= 0:
+            raise ValueError("The tick rate must be positive")
+        self.model = model
+        self.lock = lock
+        self.tick_rate = tick_rate
+        self.max_pending = max_pending
+        self.step = step if step is not None else model.step
+        self.differ = StateDiffer(model)
+        self.subscribers = []
+        self.thread = None
+        self.running = False
+        with self.lock:
+            self.differ.delta() # Baseline for the first delta
+
+
+    @staticmethod
+    def encode(event: str, data: dict) -> bytes:
+        '''Encodes a message once, so it is shared by every subscriber.'''
+        return f"event: {event}\ndata: {json.dumps(data, separators=(',', ':'))}\n\n".encode()
+
+
+    def subscribe(self) -> queue.Queue:
+        '''Adds a subscriber and starts the ticking thread if it was stopped, returns the queue its messages are pushed to.'''
+        messages = queue.Queue(self.max_pending)
+        with self.lock:
+            messages.put(self.encode("snapshot", self.differ.snapshot()))
+            self.subscribers.append(messages)
+            if not self.running:
+                self.running = True
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+        return messages
+
+
+    def unsubscribe(self, messages: queue.Queue):
+        with self.lock:
+            if messages in self.subscribers:
+                self.subscribers.remove(messages)
+
+
+    def stop(self):
+        '''Stops the ticking thread and closes every subscriber, used when the model is replaced.'''
+        with self.lock:
+            self.running = False
+            for messages in self.subscribers:
+                self.close(messages)
+            self.subscribers.clear()
+
+
+    def close(self, messages: queue.Queue):
+        '''Ends the stream of a subscriber, dropping its pending messages so the end marker fits.'''
+        while True:
+            try:
+                messages.get_nowait()
+            except queue.Empty:
+                break
+        messages.put(None)
+
+
+    def publish(self, message: bytes):
+        for messages in list(self.subscribers):
+            try:
+                messages.put_nowait(message)
+            except queue.Full: # The client is too slow, it will reconnect and get a new snapshot
+                self.subscribers.remove(messages)
+                self.close(messages)
+
+
+    def run(self):
+        '''Ticking loop, steps the model and publishes its delta until there are no subscribers left.'''
+        interval = 1 / self.tick_rate
+        next_tick = time.monotonic()
+        while True:
+            with self.lock:
+                if not self.running or not self.subscribers:
+                    self.running = False
+                    return
+                self.step()
+                self.publish(self.encode("delta", self.differ.delta()))
+
+            next_tick += interval
+            delay = next_tick - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                next_tick = time.monotonic() # Stepping is slower than the tick rate, so we don't try to catch up
+
+
+class SteppingLoop:
+    '''
+    Stepping loop of the asyncio server. A task on the event loop advances the model on a worker thread, at a fixed tick rate or as fast as possible, and publishes a step snapshot after every step.
+    Reads are answered from the last snapshot without taking the lock, so they don't wait for the step being run. Subscribers get the delta of every step as a Server-Sent Event, like with SimulationStream.
+    Every method but step_once() and stop() must be called on the event loop.
+    Attributes:
+    - model: model advanced by the loop.
+    - lock: lock held while the model is stepped or read, shared with the endpoints that use the model directly.
+    - tick_rate: number of steps per second, 0 steps as fast as possible.
+    - max_pending: number of messages a subscriber can have waiting before it is dropped.
+    - step: function that advances the model one step, called on a worker thread with the lock held.
+    - snapshot: step snapshot of the last step that was completed.
+    - subscribers: list with the message queue of every subscriber.
+    - running: whether the loop is stepping the model, it is paused when False.
+    - closed: True once stop() was called, the model isn't stepped again because the session may close it.
+    - task: asyncio task running the loop, or None before it is started.
+    '''
+    def __init__(self, model, lock: threading.Lock, tick_rate: float = 2, max_pending: int = 64, step=None):
+        if tick_rate < 0:
+            raise ValueError("The tick rate can't be negative")
+        self.model = model
+        self.lock = lock
+        self.tick_rate = tick_rate
+        self.max_pending = max_pending
+        self.step = step if step is not None else model.step
+        self.differ = StateDiffer(model)
+        self.subscribers = []
+        self.running = False
+        self.closed = False
+        self.task = None
+        self.event_loop = None
+        self.stepping = asyncio.Lock() # Held from a step until its snapshot is published, so snapshots and deltas are published in order
+        with self.lock:
+            self.differ.rebase()
+            self.snapshot = StepSnapshot(model)
+
+
+    def start(self):
+        '''Starts the loop if it is paused.'''
+        if self.closed:
+            return
+        self.running = True
+        if self.task is None or self.task.done():
+            self.event_loop = asyncio.get_running_loop()
+            self.task = self.event_loop.create_task(self.run())
+
+
+    def pause(self):
+        '''Stops stepping once the current step is published, the last snapshot and the subscribers are kept.'''
+        self.running = False # The task isn't cancelled, a step cancelled on its worker thread would still be run but never published
+
+
+    def stop(self):
+        '''
+        Pauses the loop and closes every subscriber, used when the session is removed. It can be called from any thread.
+        A step already running finishes, the ones that take the lock afterwards are skipped, so the model can be closed once the lock is taken.
+        '''
+        self.closed = True
+        if self.event_loop is None:
+            return
+        try:
+            self.event_loop.call_soon_threadsafe(self.close_all)
+        except RuntimeError: # The event loop is already closed
+            pass
+
+
+    def close_all(self):
+        self.pause()
+        for messages in self.subscribers:
+            self.close(messages)
+        self.subscribers.clear()
+
+
+    def step_once(self) -> tuple[StepSnapshot, bytes | None]:
+        '''Advances the model one step on the calling thread, returns its snapshot and its delta already encoded, or None if nobody is subscribed.'''
+        with self.lock:
+            if self.closed: # The session was removed and its model may be closed, the last snapshot is kept
+                return self.snapshot, None
+            self.step()
+            message = None
+            if self.subscribers:
+                message = SimulationStream.encode("delta", self.differ.delta())
+            else:
+                self.differ.rebase() # Keeps the baseline on the last step, for the first delta of the next subscriber
+            return StepSnapshot(self.model), message
+
+
+    async def advance(self) -> StepSnapshot:
+        '''Runs one step on a worker thread and publishes it.'''
+        async with self.stepping:
+            snapshot, message = await asyncio.to_thread(self.step_once)
+            self.snapshot = snapshot
+            if message is not None:
+                self.publish(message)
+            return snapshot
+
+
+    async def run(self):
+        '''Stepping loop, waits between steps to keep the tick rate, or only lets the other tasks run when it steps as fast as possible.'''
+        next_tick = time.monotonic()
+        while self.running and not self.closed:
+            await self.advance()
+            if self.tick_rate == 0:
+                await asyncio.sleep(0)
+                continue
+            next_tick += 1 / self.tick_rate
+            delay = next_tick - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            else:
+                next_tick = time.monotonic() # Stepping is slower than the tick rate, so we don't try to catch up
+
+
+    async def subscribe(self) -> asyncio.Queue:
+        '''Adds a subscriber, whose first message is the snapshot of the last step. Returns the queue its messages are pushed to.'''
+        messages = asyncio.Queue(self.max_pending)
+        self.event_loop = asyncio.get_running_loop()
+        async with self.stepping: # Between steps the baseline of the differ is the last snapshot, so the next delta follows it
+            messages.put_nowait(SimulationStream.encode("snapshot", self.differ.snapshot_of(self.snapshot)))
+            self.subscribers.append(messages)
+        return messages
+
+
+    def unsubscribe(self, messages: asyncio.Queue):
+        if messages in self.subscribers:
+            self.subscribers.remove(messages)
+
+
+    def close(self, messages: asyncio.Queue):
+        '''Ends the stream of a subscriber, dropping its pending messages so the end marker fits.'''
+        while not messages.empty():
+            messages.get_nowait()
+        messages.put_nowait(None)
+
+
+    def publish(self, message: bytes):
+        for messages in list(self.subscribers):
+            try:
+                messages.put_nowait(message)
+            except asyncio.QueueFull: # The client is too slow, it will reconnect and get a new snapshot
+                self.subscribers.remove(messages)
+                self.close(messages)
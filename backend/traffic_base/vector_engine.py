@@ -0,0 +1,414 @@
+# Marcos Dayan Mann A01782876
+# José Manuel García Zumaya A01784238
+# 20 noviembre 2024
+
+import copy
+import numpy as np
+from traffic_base.occupancy import ROAD_DIRECTIONS
+
+# Status codes of the cars in the vectorized engine
+CALCULATING_ROUTE = 0
+FOLLOWING_ROUTE = 1
+AVOIDING_BOTTLENECK = 2
+
+DETOUR_CELLS = 5 # Road cells a car goes straight through to get out of a traffic light, like Car.avoid_bottleneck_on_traffic_light
+
+# Main direction of the roads by the code of the occupancy road layer, (0, 0) where there is no road
+ROAD_X = np.array([0 if direction is None else direction[0] for direction in ROAD_DIRECTIONS], dtype=np.int8)
+ROAD_Y = np.array([0 if direction is None else direction[1] for direction in ROAD_DIRECTIONS], dtype=np.int8)
+
+def light_flags(flags: np.ndarray, light: np.ndarray) -> np.ndarray:
+    '''Returns the flag of the light on every cell, False where there is no light.'''
+    if len(flags) == 0:
+        return np.zeros(len(light), dtype=bool)
+    return (light >= 0) & flags[np.maximum(light, 0)]
+
+class VectorizedEngine:
+    '''
+    Vectorized stepping engine. Keeps the cars as a structure of arrays and moves all of them on each step with NumPy operations, instead of calling step() on one Car agent at a time.
+    Cars follow the routes of the model's routing table: they wait for red and yellow traffic lights, wait behind other cars and leave the grid when they reach their destination.
+    The cars are activated in a random order every step, like with RandomActivation: a car can only enter a cell that was left by a car activated before it.
+    Cars behind another car take the detours of the agents (see unblock), and cars stuck on a traffic light go straight through the next road cells like the agents do (see start_detours), so the traffic doesn't lock up where the agents would have gone around.
+    Differences with the agents engine that remain:
+    - After a sidestep a car follows the routing table from its new cell, the agents go back to their old route when the new one is longer.
+    - A car doesn't sidestep to a cell from where its route goes back to the cell it left, instead of remembering the cells of its last lane changes (Car.previous_cells_after_change).
+    Attributes:
+    - model: model the engine belongs to, the occupancy index and the metrics of the model are updated by the engine.
+    - count: number of cars in the engine, the cars are stored in the first count positions of every array.
+    - car_id: int32 array with the id of every car.
+    - node: int32 array with the node of the routing table where every car is.
+    - direction_x, direction_y: int8 arrays with the direction every car is facing.
+    - destination: int32 array with the row of the routing table of the destination of every car.
+    - cursor: int32 array with the number of cells of its route every car has advanced.
+    - status: int8 array with the status code of every car (CALCULATING_ROUTE, FOLLOWING_ROUTE or AVOIDING_BOTTLENECK).
+    - spawn_step: int32 array with the step when every car was placed.
+    - light_wait: int32 array with the number of steps every car has waited for traffic lights.
+    - reroutes: int32 array with the number of detours every car has taken to avoid traffic.
+    - detour: int8 array with the cells of its detour every car avoiding a bottleneck hasn't reached yet.
+    '''
+    ARRAYS = ("car_id", "node", "direction_x", "direction_y", "destination", "cursor", "status", "spawn_step", "light_wait", "reroutes", "detour") # Arrays with a value per car
+
+    def __init__(self, model, capacity: int = 1024):
+        self.model = model
+        table = model.routing_table
+        occupancy = model.occupancy
+
+        # Routing table data by node id
+        self.next_hop = table.next_hop
+        self.distance = table.distance
+        self.goal_node = np.array([table.street_graph.node_id(goal) for goal in table.goal_index], dtype=np.int32) # Node of the destination of every row
+        self.node_x = np.asarray(table.street_graph.node_x, dtype=np.int32)
+        self.node_y = np.asarray(table.street_graph.node_y, dtype=np.int32)
+        self.node_cell = self.node_x * occupancy.height + self.node_y # Index of the node on the flattened occupancy layers
+        self.offsets = table.street_graph.offsets
+        self.neighbors = table.street_graph.neighbors
+        self.node_of_cell = table.street_graph.node_of_cell
+
+        # Flattened views of the occupancy layers, so the car layer is shared with the rest of the model
+        self.cell_cars = occupancy.cars.reshape(-1)
+        self.cell_light = occupancy.light_id.reshape(-1)
+        self.cell_destination = occupancy.is_destination.reshape(-1)
+        self.cell_road = occupancy.road_direction.reshape(-1)
+        self.width = occupancy.width
+        self.height = occupancy.height
+        self.signals = model.signals
+        self.freed_by = np.full(self.cell_cars.shape, -1, dtype=np.int64) # Activation order of the car that left each cell during the current step, -1 if it was already free
+
+        self.rng = np.random.default_rng(model.random.getrandbits(64)) # Seeded from the model so runs can be reproduced
+        self.count = 0
+        self.car_id = np.zeros(capacity, dtype=np.int32)
+        self.node = np.zeros(capacity, dtype=np.int32)
+        self.direction_x = np.zeros(capacity, dtype=np.int8)
+        self.direction_y = np.zeros(capacity, dtype=np.int8)
+        self.destination = np.zeros(capacity, dtype=np.int32)
+        self.cursor = np.zeros(capacity, dtype=np.int32)
+        self.status = np.zeros(capacity, dtype=np.int8)
+        self.spawn_step = np.zeros(capacity, dtype=np.int32)
+        self.light_wait = np.zeros(capacity, dtype=np.int32)
+        self.reroutes = np.zeros(capacity, dtype=np.int32)
+        self.detour = np.zeros(capacity, dtype=np.int8)
+
+
+    def fork(self, model) -> "VectorizedEngine":
+        '''Returns an engine for a forked model with a copy of every car and of the random generator, sharing the routing table and the static layers with this one.'''
+        engine = copy.copy(self)
+        engine.model = model
+        engine.cell_cars = model.occupancy.cars.reshape(-1)
+        engine.signals = model.signals
+        engine.freed_by = self.freed_by.copy()
+        engine.rng = copy.deepcopy(self.rng)
+        for name in self.ARRAYS:
+            setattr(engine, name, getattr(self, name).copy())
+        return engine
+
+
+    def ensure_capacity(self, capacity: int):
+        '''Grows every car array so they can hold at least the given number of cars.'''
+        if capacity <= len(self.car_id):
+            return
+        new_capacity = max(capacity, 2 * len(self.car_id))
+        for name in self.ARRAYS:
+            array = getattr(self, name)
+            grown = np.zeros(new_capacity, dtype=array.dtype)
+            grown[:self.count] = array[:self.count]
+            setattr(self, name, grown)
+
+
+    def spawn(self, car_ids, positions: list[tuple[int, int]], destinations: list[tuple[int, int]]):
+        '''Adds cars on the given positions heading to the given destinations, their route is calculated on their first step.'''
+        table = self.model.routing_table
+        size = len(positions)
+        self.ensure_capacity(self.count + size)
+        new = slice(self.count, self.count + size)
+        self.car_id[new] = car_ids
+        self.node[new] = [table.street_graph.node_id(pos) for pos in positions]
+        self.direction_x[new] = 0
+        self.direction_y[new] = 0
+        self.destination[new] = [table.goal_index[goal] for goal in destinations]
+        self.cursor[new] = 0
+        self.status[new] = CALCULATING_ROUTE
+        self.spawn_step[new] = self.model.metrics.current_step
+        self.light_wait[new] = 0
+        self.reroutes[new] = 0
+        self.detour[new] = 0
+        np.add.at(self.cell_cars, self.node_cell[self.node[new]], 1)
+        self.count += size
+
+
+    def step(self):
+        '''Advances every car one step.'''
+        if self.count == 0:
+            return
+        model = self.model
+        touched_cells = []
+        arrived_cars, undeliverable_cars, waiting, reroutes = self.step_cars(self.rng.permutation(self.count), self.signals.is_red, self.signals.is_red | self.signals.is_yellow, touched_cells)
+        for cells in touched_cells: # Resetting only the cells used on this step
+            self.freed_by[cells] = -1
+        model.metrics.step_waiting_at_lights += waiting
+        model.metrics.step_reroutes += reroutes
+        model.metrics.step_undeliverable += len(undeliverable_cars)
+
+        if len(arrived_cars):
+            model.total_cars_at_destination += len(arrived_cars)
+            model.metrics.record_arrivals(self.spawn_step[arrived_cars], self.light_wait[arrived_cars], self.reroutes[arrived_cars])
+        leaving = np.concatenate([arrived_cars, undeliverable_cars])
+        if len(leaving):
+            model.current_car_number -= len(leaving)
+            self.remove(leaving)
+
+
+    def step_cars(self, order: np.ndarray, red_lights: np.ndarray, blocked_lights: np.ndarray, touched_cells: list) -> tuple[np.ndarray, np.ndarray, int, int]:
+        '''
+        Moves every car one step in the given activation order, with the red lights and the lights cars wait for (red and yellow).
+        Returns the cars that arrived, the cars that left the grid because there is no route to their destination, the number of cars that waited for a light and the number of reroutes.
+        '''
+        count = self.count
+        status = self.status[:count]
+
+        # Cars that were just placed start following their route on the next step, like the agents do after calculating it
+        calculating = np.flatnonzero(status == CALCULATING_ROUTE)
+        active = np.flatnonzero(status != CALCULATING_ROUTE)
+        status[calculating] = FOLLOWING_ROUTE
+
+        # Like Car.calculating_route, cars without a route to their destination (e.g. a destination on a map corner) leave the grid without arriving
+        calculating_cell = self.node_cell[self.node[calculating]]
+        undeliverable = (self.next_hop[self.destination[calculating], self.node[calculating]] < 0) & ~self.cell_destination[calculating_cell]
+        undeliverable_cells = calculating_cell[undeliverable]
+        np.subtract.at(self.cell_cars, undeliverable_cells, 1)
+        self.freed_by[undeliverable_cells] = order[calculating[undeliverable]]
+        touched_cells.append(undeliverable_cells)
+
+        # Cars on a destination cell or at the end of their detour leave the grid
+        next_node = self.next_nodes(active)
+        current_cell = self.node_cell[self.node[active]]
+        arrived = self.cell_destination[current_cell] | (next_node < 0)
+        arrived_cells = current_cell[arrived]
+        np.subtract.at(self.cell_cars, arrived_cells, 1) # A cell can have several cars after a car got out of a traffic light
+        self.freed_by[arrived_cells] = order[active[arrived]]
+        touched_cells.append(arrived_cells)
+
+        # Cars on a traffic light in front of another light that isn't red go straight ahead, like Car.following_route
+        movers = active[~arrived]
+        next_node = next_node[~arrived]
+        next_cell = self.node_cell[next_node]
+        next_light = self.cell_light[next_cell]
+        bottleneck = (self.cell_light[current_cell[~arrived]] >= 0) & (next_light >= 0) & ~light_flags(red_lights, next_light)
+        reroutes = self.start_detours(movers[bottleneck], order, touched_cells)
+        movers, next_node, next_cell, next_light = movers[~bottleneck], next_node[~bottleneck], next_cell[~bottleneck], next_light[~bottleneck]
+
+        # Cars facing a red or yellow traffic light wait for it to turn green
+        can_go = ~light_flags(blocked_lights, next_light)
+        waiting = movers[~can_go]
+        self.light_wait[waiting] += 1
+        movers, next_node, next_cell = movers[can_go], next_node[can_go], next_cell[can_go]
+
+        kept = self.split_leaving(movers, next_node, next_cell)
+        movers, next_node, next_cell = movers[kept], next_node[kept], next_cell[kept]
+        local = self.local(next_cell)
+        blocked, blocked_node, _ = self.move(movers[local], next_node[local], next_cell[local], order, touched_cells)
+        if not local.all(): # Cars held back on the border of the engine take the same detours as the blocked ones
+            blocked, blocked_node = np.concatenate([blocked, movers[~local]]), np.concatenate([blocked_node, next_node[~local]])
+        reroutes += self.unblock(blocked, blocked_node, order, red_lights, touched_cells) # The rest wait on this step
+        return active[arrived], calculating[undeliverable], len(waiting), reroutes
+
+
+    def next_nodes(self, cars: np.ndarray) -> np.ndarray:
+        '''
+        Returns the next node of the given cars, -1 for the cars that have nowhere to go. Cars following their route take the next hop of the routing table,
+        and cars avoiding a bottleneck take the cell in front of them while they are on the traffic light and then follow the direction of the road, like the detours of the agents.
+        '''
+        node = self.node[cars]
+        next_node = self.next_hop[self.destination[cars], node]
+        avoiding = np.flatnonzero(self.status[cars] == AVOIDING_BOTTLENECK)
+        if len(avoiding):
+            cars, node = cars[avoiding], node[avoiding]
+            road = self.cell_road[self.node_cell[node]]
+            x = self.node_x[node] + np.where(road == 0, self.direction_x[cars], ROAD_X[road])
+            y = self.node_y[node] + np.where(road == 0, self.direction_y[cars], ROAD_Y[road])
+            inside = (self.detour[cars] > 0) & (x >= 0) & (x < self.width) & (y >= 0) & (y < self.height) # A detour also ends where the road does
+            next_node[avoiding] = np.where(inside, self.node_of_cell[np.where(inside, x * self.height + y, 0)], -1)
+        return next_node
+
+
+    def split_leaving(self, movers: np.ndarray, next_node: np.ndarray, next_cell: np.ndarray) -> np.ndarray:
+        '''
+        Hands the cars whose next cell belongs to another engine to cross(), none for an engine with the whole map.
+        Returns a mask of the cars this engine keeps: the cars whose next cell is local, and the ones held back that only try the detours of unblock() on this step.
+        '''
+        return np.ones(len(movers), dtype=bool)
+
+
+    def local(self, cells: np.ndarray) -> np.ndarray:
+        '''Flags the cells this engine can read and move cars into, every cell of the map. The cars heading to other cells are handed to cross().'''
+        return np.ones(len(cells), dtype=bool)
+
+
+    def move(self, movers: np.ndarray, next_node: np.ndarray, next_cell: np.ndarray, order: np.ndarray, touched_cells: list) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        '''
+        Moves the given cars to their next node in rounds: a car can enter its next cell if it was free, or if it was left by a car activated before it.
+        When several cars can enter the same cell, the one activated first takes it. The cells left by the cars are added to touched_cells.
+        Returns the cars that couldn't move, with their next node and cell.
+        '''
+        while len(movers):
+            mover_order = order[movers]
+            can_enter = (self.cell_cars[next_cell] == 0) & (self.freed_by[next_cell] < mover_order)
+            if not can_enter.any():
+                break
+            candidates = np.flatnonzero(can_enter)
+            candidates = candidates[np.lexsort((mover_order[candidates], next_cell[candidates]))]
+            first = np.ones(len(candidates), dtype=bool)
+            first[1:] = next_cell[candidates][1:] != next_cell[candidates][:-1]
+            winners = candidates[first]
+
+            cars = movers[winners]
+            from_cell = self.node_cell[self.node[cars]]
+            np.subtract.at(self.cell_cars, from_cell, 1)
+            self.cell_cars[next_cell[winners]] += 1
+            self.freed_by[from_cell] = mover_order[winners]
+            touched_cells.append(from_cell)
+            self.advance(cars, next_node[winners])
+
+            still_waiting = np.ones(len(movers), dtype=bool)
+            still_waiting[winners] = False
+            movers, next_node, next_cell = movers[still_waiting], next_node[still_waiting], next_cell[still_waiting]
+        return movers, next_node, next_cell
+
+
+    def advance(self, cars: np.ndarray, to_node: np.ndarray):
+        '''Puts the given cars on their new nodes, facing the direction of the move. The car layer is updated by the caller.'''
+        self.direction_x[cars] = np.sign(self.node_x[to_node] - self.node_x[self.node[cars]])
+        self.direction_y[cars] = np.sign(self.node_y[to_node] - self.node_y[self.node[cars]])
+        self.node[cars] = to_node
+        self.cursor[cars] += 1
+        self.detour[cars] = np.maximum(self.detour[cars] - 1, 0)
+
+
+    def start_detours(self, cars: np.ndarray, order: np.ndarray, touched_cells: list) -> int:
+        '''
+        Makes the given cars, which are on a traffic light, avoid the bottleneck like Car.avoid_bottleneck_on_traffic_light: their detour is the road cell in front of them and the next ones following the road, DETOUR_CELLS at most.
+        A full detour starts with a move to its first cell even if there is a car on it, a shorter one waits for that cell to be free. Like the agents, a car leaves the grid at the end of its detour.
+        The cars whose first cell belongs to another engine are handed to cross() to be moved there.
+        Returns the number of reroutes, one per car.
+        '''
+        if len(cars) == 0:
+            return 0
+        node = self.node[cars]
+        x = self.node_x[node] + self.direction_x[cars]
+        y = self.node_y[node] + self.direction_y[cars]
+        first_cell = None
+        length = np.zeros(len(cars), dtype=np.int8)
+        going = np.ones(len(cars), dtype=bool)
+        for _ in range(DETOUR_CELLS):
+            inside = (x >= 0) & (x < self.width) & (y >= 0) & (y < self.height)
+            cell = np.where(inside, x * self.height + y, 0)
+            going &= inside & (self.cell_road[cell] != 0)
+            length += going
+            if first_cell is None:
+                first_cell = cell
+            road = np.where(going, self.cell_road[cell], 0)
+            x, y = x + ROAD_X[road], y + ROAD_Y[road]
+
+        self.status[cars] = AVOIDING_BOTTLENECK
+        self.reroutes[cars] += 1
+        self.detour[cars] = length
+        full = length == DETOUR_CELLS
+        crossing = full & ~self.local(first_cell)
+        if crossing.any():
+            self.cross(cars[crossing], self.node_of_cell[first_cell[crossing]], force=True)
+            full &= ~crossing
+        if full.any():
+            moving = cars[full]
+            from_cell, to_cell = self.node_cell[node[full]], first_cell[full]
+            np.subtract.at(self.cell_cars, from_cell, 1)
+            np.add.at(self.cell_cars, to_cell, 1)
+            self.freed_by[from_cell] = np.where(self.cell_cars[from_cell] == 0, order[moving], self.freed_by[from_cell])
+            touched_cells.append(from_cell)
+            self.advance(moving, self.node_of_cell[to_cell])
+        return len(cars)
+
+
+    def unblock(self, blocked: np.ndarray, next_node: np.ndarray, order: np.ndarray, red_lights: np.ndarray, touched_cells: list) -> int:
+        '''
+        Moves the cars that are still behind another car with the detours the agents take, in activation order like move():
+        - Like Car.handle_traffic_ahead, a car on a road moves to the first neighbor cell that is free, isn't its next cell, backwards, a red light, a traffic light entered from the side or a destination that isn't its own.
+          A car following its route only takes a cell from where its destination can be reached without going back to the cell it left, and follows the routing table from there.
+          A car avoiding a bottleneck keeps going along the road from the new cell, unless the route from it isn't longer than the rest of its detour.
+        - A car on a traffic light that isn't red avoids the bottleneck (see start_detours).
+        Returns the number of reroutes, counted like the agents count them.
+        '''
+        if len(blocked) == 0:
+            return 0
+        reroutes = 0
+
+        # Free neighbor cells of every blocked car on a road (cars that are not on a road don't take alternative moves), in the order of the street graph
+        on_road = np.flatnonzero(self.cell_road[self.node_cell[self.node[blocked]]] != 0)
+        node = self.node[blocked[on_road]]
+        starts = self.offsets[node]
+        counts = self.offsets[node + 1] - starts
+        owner = np.repeat(on_road, counts)
+        edges = np.arange(counts.sum()) + np.repeat(starts - (np.cumsum(counts) - counts), counts)
+        target = self.neighbors[edges]
+        target_cell = self.node_cell[target]
+        free = (target != next_node[owner]) & (self.cell_cars[target_cell] == 0) & (self.freed_by[target_cell] < order[blocked[owner]]) & self.local(target_cell)
+        owner, target, target_cell = owner[free], target[free], target_cell[free]
+
+        # The moves the agents wouldn't take, checked only on the free cells
+        owner_car = blocked[owner]
+        from_node, row = self.node[owner_car], self.destination[owner_car]
+        move_x = np.sign(self.node_x[target] - self.node_x[from_node])
+        move_y = np.sign(self.node_y[target] - self.node_y[from_node])
+        road = self.cell_road[self.node_cell[from_node]]
+        target_light = self.cell_light[target_cell]
+        is_goal = target == self.goal_node[row]
+        hop = self.next_hop[row, target]
+        target_road = self.cell_road[target_cell]
+        after_x, after_y = self.node_x[target] + ROAD_X[target_road], self.node_y[target] + ROAD_Y[target_road]
+        inside = (after_x >= 0) & (after_x < self.width) & (after_y >= 0) & (after_y < self.height)
+        keeps_going = (target_road != 0) & inside & (self.node_of_cell[np.where(inside, after_x * self.height + after_y, 0)] >= 0) # The detour can go on along the road from the cell
+        possible = (
+            (~self.cell_destination[target_cell] | is_goal)
+            & ((target_light < 0) | ((move_x == ROAD_X[road]) & (move_y == ROAD_Y[road]) & ~light_flags(red_lights, target_light)))
+            & ~((move_x == -self.direction_x[owner_car]) & (move_y == -self.direction_y[owner_car]))
+            & np.where(self.status[owner_car] == AVOIDING_BOTTLENECK, keeps_going, is_goal | ((hop >= 0) & (hop != from_node)))
+        )
+        candidates = np.flatnonzero(possible)
+        cars, first = np.unique(owner[candidates], return_index=True)
+        if len(cars):
+            chosen = candidates[first]
+            sidestepping = blocked[cars]
+            avoiding = self.status[sidestepping] == AVOIDING_BOTTLENECK
+            left_before = np.where(avoiding, self.detour[sidestepping], self.distance[row[chosen], from_node[chosen]]) # Cells of the route the car was following
+            still_blocked, _, _ = self.move(sidestepping, target[chosen], target_cell[chosen], order, touched_cells)
+            moved = ~np.isin(sidestepping, still_blocked)
+            new_length = self.distance[row[chosen], target[chosen]]
+            rerouted = sidestepping[moved & (new_length > 0) & (new_length <= left_before)] # Like the agents, only a route that isn't longer replaces the one the car had
+            self.reroutes[rerouted] += 1
+            reroutes += len(rerouted)
+            self.status[rerouted] = FOLLOWING_ROUTE
+            self.detour[rerouted] = 0
+            left = np.ones(len(blocked), dtype=bool)
+            left[cars[moved]] = False
+            blocked = blocked[left]
+
+        # Cars stuck on a traffic light that isn't red avoid the bottleneck
+        light = self.cell_light[self.node_cell[self.node[blocked]]]
+        escaping = (light >= 0) & ~light_flags(red_lights, light)
+        reroutes += self.start_detours(blocked[escaping], order, touched_cells)
+        return reroutes
+
+
+    def remove(self, cars: np.ndarray):
+        '''Removes the given cars from the arrays, keeping the remaining cars packed at the beginning.'''
+        keep = np.ones(self.count, dtype=bool)
+        keep[cars] = False
+        remaining = int(keep.sum())
+        for name in self.ARRAYS:
+            array = getattr(self, name)
+            array[:remaining] = array[:self.count][keep]
+        self.count = remaining
+
+
+    def write_states(self, car_states):
+        '''Copies the id, position and direction of every car in the engine to the model's car state buffer.'''
+        node = self.node[:self.count]
+        car_states.write_all(self.car_id[:self.count], self.node_x[node], self.node_y[node], self.direction_x[:self.count], self.direction_y[:self.count])
@@ -13,6 +13,17 @@ import {
 
 const agent_server_uri = "http://localhost:8585/";
 
+// Id of the session created by /init, the server keeps a separate model for every session
+let session_id = null;
+
+// Returns the url of an endpoint of the agent server for the current session
+export function serverUrl(endpoint) {
+  if (session_id === null) {
+    return agent_server_uri + endpoint;
+  }
+  return `${agent_server_uri}${endpoint}?session=${encodeURIComponent(session_id)}`;
+}
+
 export async function initAgentsModel(data) {
   try {
     // Send a POST request to the agent server to initialize the model
@@ -28,6 +39,7 @@ export async function initAgentsModel(data) {
       let result = await response.json();
       let GlobalWidth = result.width;
       let GlobalHeight = result.height;
+      session_id = result.session ?? null;
       console.log(result.message);
 
       // Return the correct object
@@ -47,7 +59,7 @@ export async function initAgentsModel(data) {
 export async function getRoad(agents) {
   try {
     // Send a GET request to the agent server to retrieve the road positions
-    let response = await fetch(agent_server_uri + "getRoad");
+    let response = await fetch(serverUrl("getRoad"));
 
     // Check if the response was successful
     if (response.ok) {
@@ -129,7 +141,7 @@ function calculateRotation(orientation) {
 
 export async function getCars(cars) {
   try {
-    let response = await fetch(agent_server_uri + "getCars");
+    let response = await fetch(serverUrl("getCars"));
 
     if (response.ok) {
       let result = await response.json();
@@ -12,7 +12,7 @@ import GUI from "lil-gui";
 import vsGLSL from "../shaders/vs.glsl?raw";
 import fsGLSL from "../shaders/fs.glsl?raw";
 
-import { initAgentsModel, getRoad } from "./client_functions.js";
+import { initAgentsModel, getRoad, serverUrl } from "./client_functions.js";
 
 import {
   CarObject,
@@ -52,9 +52,6 @@ class Object3D {
   }
 }
 
-// Define the agent server URI
-const agent_server_uri = "http://localhost:8585/";
-
 // Initialize arrays to store agents and obstacles
 const cars = [];
 const agents = [];
@@ -117,6 +114,10 @@ const cameraPosition = {
 // Initialize the frame count
 let frameCount = 0;
 
+// Whether the cars and traffic lights are being updated by the simulation stream, and whether a polling update is in progress
+let streaming = false;
+let updating = false;
+
 // Define the data object
 const data = {
   NAgents: 500,
@@ -204,6 +205,8 @@ async function main() {
 
   await getDestinations();
   await getTrafficLights();
+  await getTrafficLightStates();
+  startStream();
   // Set up the user interface
   setupUI();
 
@@ -383,80 +386,102 @@ const calculateRotation = (previousOrientation, newOrientation, id) => {
   return angle; // Devuelve en radianes para WebGL
 };
 
+// Reads the columnar car snapshot sent by the server (see CarStateBuffer in the backend):
+// a header with uint32 count, capacity, step and reserved, followed by the columns
+// int32 ids, int16 x, int16 z, int8 orientation x and int8 orientation z, each with room for capacity cars
+function parseCarSnapshot(buffer) {
+  const header = new DataView(buffer, 0, 16);
+  const count = header.getUint32(0, true);
+  const capacity = header.getUint32(4, true);
+  const ids = new Int32Array(buffer, 16, count);
+  const xs = new Int16Array(buffer, 16 + 4 * capacity, count);
+  const zs = new Int16Array(buffer, 16 + 6 * capacity, count);
+  const orientationsX = new Int8Array(buffer, 16 + 8 * capacity, count);
+  const orientationsZ = new Int8Array(buffer, 16 + 9 * capacity, count);
+
+  const positions = new Array(count);
+  for (let i = 0; i < count; i++) {
+    positions[i] = {
+      id: `c_${ids[i]}`,
+      position: { x: xs[i], y: 1, z: zs[i] },
+      orientation: { x: orientationsX[i], y: 0, z: orientationsZ[i] },
+    };
+  }
+  return { positions: positions };
+}
+
+// Updates the position and orientation of a car, or creates it if it did not exist
+function updateCar(car) {
+  const currentCar = cars.find((CarObject) => CarObject.id === car.id);
+
+  if (currentCar !== undefined) {
+    // Calcula la rotación basada en la orientación previa y nueva
+    const previousOrientation = currentCar.orientation;
+    const newOrientation = [
+      car.orientation.x,
+      car.orientation.y,
+      car.orientation.z,
+    ];
+    currentCar.rotation = [
+      0,
+      calculateRotation(previousOrientation, newOrientation, currentCar.id),
+      0,
+    ];
+
+    // Actualiza la posición y orientación del coche
+    currentCar.position = [car.position.x, car.position.y, car.position.z];
+    // Error de nueva instancia ????
+    currentCar.orientation = [0, 0, -1];
+  } else {
+    // Crea un nuevo coche si no existía
+    const newCar = new CarObject(
+      car.id,
+      [car.position.x, car.position.y, car.position.z],
+      undefined,
+      undefined,
+      [car.orientation.x, car.orientation.y, car.orientation.z],
+      getRandomColor()
+    );
+    cars.push(newCar);
+  }
+}
+
+function removeCar(id) {
+  const index = cars.findIndex((car) => car.id === id);
+  if (index > -1) {
+    cars.splice(index, 1);
+  }
+}
+
 async function getCars() {
   try {
-    let response = await fetch(agent_server_uri + "getCars");
+    // Asks for the binary snapshot, servers that only send JSON are still supported
+    let response = await fetch(serverUrl("getCars"), {
+      headers: { Accept: "application/octet-stream, application/json;q=0.5" },
+    });
 
     if (response.ok) {
-      let result = await response.json();
+      const contentType = response.headers.get("Content-Type") || "";
+      let result = contentType.includes("application/octet-stream")
+        ? parseCarSnapshot(await response.arrayBuffer())
+        : await response.json();
 
       if (cars.length === 0) {
         for (const car of result.positions) {
-          const newCar = new CarObject(
-            car.id,
-            [car.position.x, car.position.y, car.position.z],
-            undefined,
-            undefined,
-            [car.orientation.x, car.orientation.y, car.orientation.z],
-            getRandomColor()
-          );
-          cars.push(newCar);
+          updateCar(car);
         }
       } else {
-        for (const car of cars) {
-          const currentIdCar = car.id;
-          const found = result.positions.find((car) => car.id === currentIdCar);
+        for (const car of [...cars]) {
+          const found = result.positions.find((newCar) => newCar.id === car.id);
 
           if (found === undefined) {
             // If the id does not exist in the new data, remove it from the array
-            const index = cars.findIndex((car) => car.id === currentIdCar);
-            if (index > -1) {
-              cars.splice(index, 1);
-            }
+            removeCar(car.id);
           }
         }
 
         for (const car of result.positions) {
-          const currentCar = cars.find((CarObject) => CarObject.id === car.id);
-
-          if (currentCar !== undefined) {
-            // Calcula la rotación basada en la orientación previa y nueva
-            const previousOrientation = currentCar.orientation;
-            const newOrientation = [
-              car.orientation.x,
-              car.orientation.y,
-              car.orientation.z,
-            ];
-            currentCar.rotation = [
-              0,
-              calculateRotation(
-                previousOrientation,
-                newOrientation,
-                currentCar.id
-              ),
-              0,
-            ];
-
-            // Actualiza la posición y orientación del coche
-            currentCar.position = [
-              car.position.x,
-              car.position.y,
-              car.position.z,
-            ];
-            // Error de nueva instancia ????
-            currentCar.orientation = [0, 0, -1];
-          } else {
-            // Crea un nuevo coche si no existía
-            const newCar = new CarObject(
-              car.id,
-              [car.position.x, car.position.y, car.position.z],
-              undefined,
-              undefined,
-              [car.orientation.x, car.orientation.y, car.orientation.z],
-              getRandomColor()
-            );
-            cars.push(newCar);
-          }
+          updateCar(car);
         }
       }
     } else {
@@ -470,7 +495,7 @@ async function getCars() {
 async function getObstacles() {
   try {
     // Send a GET request to the agent server to retrieve the obstacle positions
-    let response = await fetch(agent_server_uri + "getBuildings");
+    let response = await fetch(serverUrl("getBuildings"));
 
     // Check if the response was successful
     if (response.ok) {
@@ -498,7 +523,7 @@ async function getObstacles() {
 async function getDestinations() {
   try {
     // Send a GET request to the agent server to retrieve the obstacle positions
-    let response = await fetch(agent_server_uri + "getDestinations");
+    let response = await fetch(serverUrl("getDestinations"));
 
     // Check if the response was successful
     if (response.ok) {
@@ -523,54 +548,66 @@ async function getDestinations() {
   }
 }
 
+// Updates the state of a traffic light, or creates it if it did not exist
+function updateTrafficLight(traffic_light) {
+  const existingTrafficLight = traffic_lights.find(
+    (t) => t.id === traffic_light.id
+  );
+
+  if (existingTrafficLight) {
+    // Actualizar el semáforo existente
+    existingTrafficLight.is_red = traffic_light.is_red;
+    existingTrafficLight.is_yellow = traffic_light.is_yellow;
+    if (traffic_light.x !== undefined) {
+      existingTrafficLight.position = [
+        traffic_light.x,
+        traffic_light.y,
+        traffic_light.z,
+      ];
+    }
+  } else {
+    // Crear un nuevo semáforo
+    const newTrafficLight = new TrafficLightObject(
+      traffic_light.id,
+      [traffic_light.x, traffic_light.y, traffic_light.z],
+      undefined,
+      undefined,
+      undefined,
+      traffic_light.is_red,
+      traffic_light.is_yellow
+    );
+    traffic_lights.push(newTrafficLight);
+  }
+}
+
+// Separar los semáforos en los arrays correspondientes
+function sortTrafficLights() {
+  red_traffic_lights.length = 0;
+  yellow_traffic_lights.length = 0;
+  for (const trafficLight of traffic_lights) {
+    if (trafficLight.is_red) {
+      red_traffic_lights.push(trafficLight);
+    } else if (trafficLight.is_yellow) {
+      yellow_traffic_lights.push(trafficLight);
+    }
+  }
+}
+
+// Ids of the traffic lights in the order of the state vector sent by the server
+let traffic_light_ids = [];
+
+// Gets the geometry of the traffic lights, which doesn't change, so the browser keeps it cached
 async function getTrafficLights() {
   try {
-    let response = await fetch(agent_server_uri + "getTrafficLights");
+    let response = await fetch(serverUrl("getTrafficLights"));
 
     if (response.ok) {
       let result = await response.json();
 
-      // Limpiar los arrays de colores antes de agregar los semáforos
-      red_traffic_lights.length = 0;
-      yellow_traffic_lights.length = 0;
-
-      // Crear o actualizar los semáforos
+      // Crear o actualizar los semáforos, empiezan en verde hasta que llegue su estado
+      traffic_light_ids = result.positions.map((traffic_light) => traffic_light.id);
       for (const traffic_light of result.positions) {
-        const existingTrafficLight = traffic_lights.find(
-          (t) => t.id === traffic_light.id
-        );
-
-        if (existingTrafficLight) {
-          // Actualizar el semáforo existente
-          existingTrafficLight.is_red = traffic_light.is_red;
-          existingTrafficLight.is_yellow = traffic_light.is_yellow;
-          existingTrafficLight.position = [
-            traffic_light.x,
-            traffic_light.y,
-            traffic_light.z,
-          ];
-        } else {
-          // Crear un nuevo semáforo
-          const newTrafficLight = new TrafficLightObject(
-            traffic_light.id,
-            [traffic_light.x, traffic_light.y, traffic_light.z],
-            undefined,
-            undefined,
-            undefined,
-            traffic_light.is_red,
-            traffic_light.is_yellow
-          );
-          traffic_lights.push(newTrafficLight);
-        }
-      }
-
-      // Separar los semáforos en los arrays correspondientes
-      for (const trafficLight of traffic_lights) {
-        if (trafficLight.is_red) {
-          red_traffic_lights.push(trafficLight);
-        } else if (trafficLight.is_yellow) {
-          yellow_traffic_lights.push(trafficLight);
-        }
+        updateTrafficLight({ is_red: false, is_yellow: false, ...traffic_light });
       }
     }
   } catch (error) {
@@ -578,18 +615,41 @@ async function getTrafficLights() {
   }
 }
 
+// Gets the color of every traffic light as a vector of codes (0 green, 1 yellow, 2 red)
+async function getTrafficLightStates() {
+  try {
+    let response = await fetch(serverUrl("getTrafficLightStates"));
+
+    if (response.ok) {
+      let result = await response.json();
+
+      result.states.forEach((state, index) => {
+        updateTrafficLight({
+          id: traffic_light_ids[index],
+          is_red: state === 2,
+          is_yellow: state === 1,
+        });
+      });
+
+      sortTrafficLights();
+    }
+  } catch (error) {
+    console.error("Error fetching traffic light states:", error);
+  }
+}
+
 /*
  * Updates the agent positions by sending a request to the agent server.
  */
 async function update() {
   try {
     // Send a request to the agent server to update the agent positions
-    let response = await fetch(agent_server_uri + "update");
+    let response = await fetch(serverUrl("update"));
     // console.log("Updating agents");
     // Check if the response was successful
     if (response.ok) {
       // Retrieve the updated agent positions
-      await getTrafficLights();
+      await getTrafficLightStates();
       await getCars();
       // Log a message indicating that the agents have been updated
       // console.log("Updated agents");
@@ -600,6 +660,68 @@ async function update() {
   }
 }
 
+/*
+ * Subscribes to the simulation stream of the agent server. The server advances the model on its own
+ * and sends a snapshot with every car and traffic light, followed by the changes of every step.
+ * While the stream is open the render loop doesn't poll the server.
+ */
+function startStream() {
+  if (typeof EventSource === "undefined") {
+    return;
+  }
+
+  const stream = new EventSource(serverUrl("stream"));
+
+  // Cars come as [id, x, z, orientation x, orientation z] and lights as [id, is_red, is_yellow]
+  const carFromRow = ([id, x, z, orientationX, orientationZ]) => ({
+    id: id,
+    position: { x: x, y: 1, z: z },
+    orientation: { x: orientationX, y: 0, z: orientationZ },
+  });
+  const lightFromRow = ([id, is_red, is_yellow]) => ({
+    id: id,
+    is_red: is_red,
+    is_yellow: is_yellow,
+  });
+
+  stream.addEventListener("snapshot", (event) => {
+    const snapshot = JSON.parse(event.data);
+    cars.length = 0;
+    for (const row of snapshot.cars) {
+      updateCar(carFromRow(row));
+    }
+    for (const row of snapshot.lights) {
+      updateTrafficLight(lightFromRow(row));
+    }
+    sortTrafficLights();
+    streaming = true;
+  });
+
+  stream.addEventListener("delta", (event) => {
+    const delta = JSON.parse(event.data);
+    for (const id of delta.arrived) {
+      removeCar(id);
+    }
+    for (const row of delta.spawned) {
+      updateCar(carFromRow(row));
+    }
+    for (const row of delta.moved) {
+      updateCar(carFromRow(row));
+    }
+    if (delta.lights.length > 0) {
+      for (const row of delta.lights) {
+        updateTrafficLight(lightFromRow(row));
+      }
+      sortTrafficLights();
+    }
+  });
+
+  // The browser reconnects on its own and the server sends a new snapshot, meanwhile we go back to polling
+  stream.onerror = () => {
+    streaming = false;
+  };
+}
+
 async function drawScene(
   gl,
   programInfo,
@@ -681,10 +803,15 @@ async function drawScene(
   // Increment the frame count
   frameCount++;
 
-  // Update the scene every 30 frames
+  // Update the scene every 30 frames when the stream is not available, without waiting for the server
   if (frameCount % 30 == 0) {
     frameCount = 0;
-    await update();
+    if (!streaming && !updating) {
+      updating = true;
+      update().finally(() => {
+        updating = false;
+      });
+    }
   }
 
   // Request the next frame